@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Asynchronous acquisition of the external data (World Bank API and the
+Nominatim geocoder). All requests go through one aiohttp session, so they
+share a single connection pool, and a notebook or service can await all
+sources at once:
+
+    async with OpenSession() as session:
+        wb_data, coordinates = await asyncio.gather(
+            fetch_wb(session, indicators, 2000, 2016),
+            geocode_many(session, countries))
+
+For tests, DataSources.LocalHTTPStandIn serves both APIs locally; pass its
+wb_url and geocode_url as base_url.
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import pandas as pd
+
+
+WB_URL = 'https://api.worldbank.org/v2'
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org'
+USER_AGENT = 'TrueEmissions'
+
+
+class AsyncRateLimiter(object):
+    """
+    -------
+
+    Rate limiter for coroutines: spaces the requests to every host at least
+    1/rate seconds apart. Meant to be used from a single event loop.
+
+    -------
+    Inputs:
+        - rates : dictionary from host to the maximum number of requests per
+                  second; other hosts are not limited
+    -------
+
+    """
+
+    def __init__(self, rates):
+        self.intervals = {host: 1.0/rate for host, rate in rates.items()}
+        self.next_time = {}
+
+    async def wait(self, host):
+        if host not in self.intervals:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_time.get(host, now))
+        self.next_time[host] = start+self.intervals[host]
+        if start > now:
+            await asyncio.sleep(start-now)
+
+
+# Nominatim allows one request per second
+DEFAULT_RATES = {'api.worldbank.org': 10.0, 'nominatim.openstreetmap.org': 1.0}
+
+
+class AcquisitionSession(object):
+    """
+    -------
+
+    The aiohttp session that all requests share, together with the rate
+    limiter. Create it with OpenSession() and use it with "async with".
+
+    -------
+
+    """
+
+    def __init__(self, limit=10, rates=None):
+        self.limit = limit
+        self.rate_limiter = AsyncRateLimiter(DEFAULT_RATES if rates is None else rates)
+        self.http = None
+
+    async def __aenter__(self):
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit),
+                                          headers={'User-Agent': USER_AGENT})
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.http.close()
+
+    async def get_json(self, url, params=None, retries=3, backoff=0.5):
+        """
+        Gets a JSON document. Requests that fail in transport (connection
+        errors, timeouts and 5xx server errors) are retried with exponential
+        backoff; other HTTP errors (e.g. 404) are raised at once.
+        """
+        for attempt in range(retries+1):
+            try:
+                await self.rate_limiter.wait(urlsplit(url).hostname)
+                async with self.http.get(url, params=params) as response:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError) as error:
+                if isinstance(error, aiohttp.ClientResponseError) and error.status < 500:
+                    raise
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(backoff*2**attempt)
+
+
+def OpenSession(limit=10, rates=None):
+    """
+    This function opens the session that all requests share. Use it with
+    "async with". The session keeps at most limit connections open and
+    spaces the requests per host (default: DEFAULT_RATES).
+    """
+    return AcquisitionSession(limit=limit, rates=rates)
+
+
+async def fetch_wb_indicator(session, code, year1, year2, base_url=WB_URL, per_page=20000):
+    """
+    This function retrieves one World Bank indicator for all countries and
+    all years from year1 up to and including year2. When the answer has more
+    than one page, the remaining pages are retrieved concurrently.
+
+    -------
+    Outputs
+    -------
+    series:     Series with a (country, year) MultiIndex
+    """
+    url = '%s/country/all/indicator/%s' % (base_url, code)
+    params = {'date': '%d:%d' % (year1, year2), 'format': 'json', 'per_page': per_page}
+
+    first = await session.get_json(url, dict(params, page=1))
+    if len(first) < 2:
+        raise RuntimeError('World Bank API error for %s: %s' % (code, first[0].get('message')))
+    pages = [first]
+    if first[0]['pages'] > 1:
+        pages += await asyncio.gather(*[session.get_json(url, dict(params, page=page))
+                                        for page in range(2, first[0]['pages']+1)])
+
+    rows = [row for page in pages for row in (page[1] or [])]
+    index = pd.MultiIndex.from_arrays([[row['country']['value'] for row in rows],
+                                       [int(row['date']) for row in rows]], names=['country', 'year'])
+    return pd.Series([row['value'] for row in rows], index=index, dtype=float)
+
+
+async def fetch_wb(session, indicators, year1, year2, base_url=WB_URL):
+    """
+    This function retrieves World Bank indicators for all years from year1
+    up to and including year2. All indicators are retrieved concurrently.
+
+    ------
+    Inputs
+    ------
+    session:        the session from OpenSession()
+    indicators:     dictionary from indicator code to column name
+    year1:          the first year
+    year2:          the last year
+    base_url:       the address of the API (default: WB_URL)
+
+    -------
+    Outputs
+    -------
+    dataframe:      dataframe with a (country, year) MultiIndex and one
+                    column per indicator, like DataSources.FetchRangeWB();
+                    use DataSources.LatestObservationsWB() to take the
+                    latest year
+    """
+    codes = list(indicators)
+    series = await asyncio.gather(*[fetch_wb_indicator(session, code, year1, year2, base_url)
+                                    for code in codes])
+    dataframe = pd.concat(series, axis=1)
+    dataframe.columns = [indicators[code] for code in codes]
+    return dataframe
+
+
+async def geocode(session, name, base_url=NOMINATIM_URL):
+    """
+    This function looks up the coordinates of a place. Returns a
+    (latitude, longitude) tuple, or None when nothing is found.
+    """
+    places = await session.get_json(base_url+'/search', {'q': name, 'format': 'json', 'limit': 1})
+    if not places:
+        return None
+    return (float(places[0]['lat']), float(places[0]['lon']))
+
+
+async def geocode_many(session, names, base_url=NOMINATIM_URL, cache=None):
+    """
+    This function looks up the coordinates of many places at once. Every
+    distinct name is requested only once. With a Geocoding.GeocodeCache,
+    cached places (also those that were not found before) are not requested
+    again and the new results are stored.
+
+    -------
+    Outputs
+    -------
+    coordinates:    dictionary from name to a (latitude, longitude) tuple,
+                    or None when nothing is found
+    """
+    unique = list(dict.fromkeys(names))
+    coordinates = {} if cache is None else cache.get_many(unique)
+    remaining = [name for name in unique if name not in coordinates]
+    results = dict(zip(remaining, await asyncio.gather(*[geocode(session, name, base_url)
+                                                           for name in remaining])))
+    if cache is not None:
+        cache.put_many(results)
+    coordinates.update(results)
+    return {name: coordinates[name] for name in unique}
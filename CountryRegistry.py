@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Country registry: resolves country names, ISO2/ISO3 codes and aliases from
+the different data sources (World Bank, WITS, IEA, TM_WORLD_BORDERS) to one
+canonical ISO3 code.
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import csv
+import os
+import struct
+
+import pandas as pd
+
+
+# Outdated or source specific codes, as used by WITS
+OUTDATED_CODES = {'SER': 'SRB',
+                  'SUD': 'SDN',
+                  'ROM': 'ROU',
+                  'TMP': 'TLS',
+                  'ZAR': 'COD',
+                  'MNT': 'MNE'}
+
+# Names used by the IEA (and others) that are not in any of the source files
+KNOWN_ALIASES = {"People's Republic of China": 'CHN',
+                 'Korea': 'KOR',
+                 'Hong Kong (China)': 'HKG',
+                 'Islamic Republic of Iran': 'IRN',
+                 'Russian Federation': 'RUS',
+                 'Slovak Republic': 'SVK',
+                 'United States': 'USA',
+                 'Venezuela': 'VEN',
+                 'Egypt': 'EGY',
+                 'Viet Nam': 'VNM'}
+
+_registries = {}
+
+
+def _blank(alias):
+    return alias is None or (not isinstance(alias, str) and pd.isnull(alias)) or not str(alias).strip()
+
+
+def _normalize(alias):
+    return ' '.join(str(alias).split()).casefold()
+
+
+class CountryRegistry(object):
+    """
+    -------
+
+    Lookup table from every known alias of a country (names, ISO2, ISO3 and
+    outdated codes) to its canonical ISO3 code. All lookups are dictionary
+    accesses; the comparison ignores case and repeated whitespace. When two
+    sources use the same alias for different countries, the first one wins.
+
+    Every ISO3 code also has a canonical name, which is the first name that
+    was registered for it (the World Bank name when the registry is built
+    with GetCountryRegistry).
+
+    -------
+
+    """
+
+    def __init__(self):
+        self.aliases = {}
+        self.names = {}
+        self.iso2 = {}
+
+    def add(self, iso3, name=None, aliases=(), iso2=None):
+        """
+        Registers a country. The name only becomes the canonical name if the
+        country did not have one yet.
+        """
+        iso3 = str(iso3).strip().upper()
+        if not iso3:
+            return
+        iso3 = OUTDATED_CODES.get(iso3, iso3)
+        self.aliases[_normalize(iso3)] = iso3
+        # blank names (e.g. of the WITS aggregates) are no aliases
+        if not _blank(name):
+            self.names.setdefault(iso3, str(name).strip())
+            self.aliases.setdefault(_normalize(name), iso3)
+        if not _blank(iso2):
+            self.iso2.setdefault(iso3, str(iso2).strip().upper())
+            self.aliases.setdefault(_normalize(iso2), iso3)
+        for alias in aliases:
+            if not _blank(alias):
+                self.aliases.setdefault(_normalize(alias), iso3)
+
+    def resolve(self, alias, default=None):
+        """
+        Returns the canonical ISO3 code of the alias, or default if the
+        alias is unknown.
+        """
+        if alias is None or (not isinstance(alias, str) and pd.isnull(alias)):
+            return default
+        return self.aliases.get(_normalize(alias), default)
+
+    def resolve_many(self, aliases):
+        """
+        Resolves a list of aliases at once. Every distinct alias is looked
+        up only once. Returns a Series with the ISO3 codes (NaN if unknown),
+        indexed by the aliases.
+        """
+        aliases = pd.Index(aliases)
+        unique = aliases.unique()
+        lookup = dict(zip(unique, (self.resolve(alias) for alias in unique)))
+        return pd.Series(aliases.map(lookup), index=aliases, dtype=object)
+
+    def name(self, iso3, default=None):
+        return self.names.get(iso3, default)
+
+    def canonical_names(self, aliases):
+        """
+        Translates a list of aliases into the canonical country names.
+        Unknown aliases (e.g. regions) are returned unchanged.
+        """
+        aliases = pd.Index(aliases)
+        unique = aliases.unique()
+        lookup = {}
+        for alias in unique:
+            lookup[alias] = self.names.get(self.resolve(alias), alias)
+        return pd.Series(aliases.map(lookup), index=aliases, dtype=object)
+
+    def __contains__(self, alias):
+        return self.resolve(alias) is not None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return 'CountryRegistry(%d countries, %d aliases)' % (len(self.names), len(self.aliases))
+
+
+def ReadBordersTable(file='TM_WORLD_BORDERS_SIMPL-0.3/TM_WORLD_BORDERS_SIMPL-0.3.dbf'):
+    """
+    This function reads the attribute table (.dbf) of the TM_WORLD_BORDERS
+    shapefile, without needing any GIS packages.
+
+    ------
+    Inputs
+    ------
+    file:       the .dbf file of the shapefile
+
+    -------
+    Outputs
+    -------
+    dataframe:  one row per country with the FIPS, ISO2, ISO3, UN, NAME,
+                AREA, POP2005, REGION, SUBREGION, LON and LAT columns
+    """
+    with open(file, 'rb') as dbf:
+        content = dbf.read()
+
+    records, header_length, record_length = struct.unpack('<4xIHH', content[:12])
+    fields = []
+    for position in range(32, header_length-1, 32):
+        descriptor = content[position:position+32]
+        name = descriptor[:11].split(b'\0')[0].decode('ascii')
+        fields.append((name, chr(descriptor[11]), descriptor[16]))
+
+    rows = []
+    for record in range(records):
+        start = header_length+record*record_length
+        if content[start:start+1] == b'*':          # deleted record
+            continue
+        position = start+1
+        row = []
+        for name, field_type, length in fields:
+            row.append(content[position:position+length].decode('latin-1').strip())
+            position += length
+        rows.append(row)
+
+    dataframe = pd.DataFrame(rows, columns=[name for name, field_type, length in fields])
+    for name, field_type, length in fields:
+        if field_type in 'NF':
+            dataframe[name] = pd.to_numeric(dataframe[name], errors='coerce')
+    return dataframe
+
+
+def ReadWITSReporters(directory='wits_en_trade_summary_allcountries_allyears'):
+    """
+    This function collects the reporter codes and names from the WITS trade
+    summary files (en_<ISO3>_AllYears_WITS_Trade_Summary.CSV). Only the first
+    data line of every file is read.
+
+    -------
+    Outputs
+    -------
+    reporters:  dictionary from WITS code to reporter name
+    """
+    reporters = {}
+    for filename in sorted(os.listdir(directory)):
+        parts = filename.split('_')
+        if len(parts) < 2 or not filename.upper().endswith('.CSV'):
+            continue
+        with open(os.path.join(directory, filename), encoding='ISO-8859-1', newline='') as summary:
+            reader = csv.reader(summary)
+            next(reader, None)
+            first_row = next(reader, None)
+        if first_row:
+            reporters[parts[1].upper()] = first_row[0]
+    return reporters
+
+
+def BuildCountryRegistry(regions_file=None, wits_dir=None, borders_file=None, trade_data=None):
+    """
+    This function builds a CountryRegistry from the available sources.
+    Names are registered in order of preference: World Bank (Regions.xlsx),
+    WITS, TM_WORLD_BORDERS and finally the built-in aliases. Sources that
+    are None are skipped.
+
+    ------
+    Inputs
+    ------
+    regions_file:   the World Bank region file (Regions.xlsx)
+    wits_dir:       the directory with the WITS trade summary files
+    borders_file:   the .dbf file of the TM_WORLD_BORDERS shapefile
+    trade_data:     a WITS trade dataframe with ReporterISO3 and ReporterName
+
+    -------
+    Outputs
+    -------
+    registry:       the resulting CountryRegistry
+    """
+    registry = CountryRegistry()
+
+    if regions_file is not None:
+        regions = pd.read_excel(regions_file)
+        for iso3, name in zip(regions['Country Code'], regions['country']):
+            registry.add(iso3, name)
+
+    if wits_dir is not None:
+        for code, name in ReadWITSReporters(wits_dir).items():
+            registry.add(code, name)
+
+    if trade_data is not None:
+        reporters = trade_data[['ReporterISO3', 'ReporterName']].drop_duplicates()
+        for code, name in zip(reporters['ReporterISO3'], reporters['ReporterName']):
+            registry.add(code, name)
+
+    if borders_file is not None:
+        borders = ReadBordersTable(borders_file)
+        for iso3, iso2, name in zip(borders['ISO3'], borders['ISO2'], borders['NAME']):
+            registry.add(iso3, name, iso2=iso2)
+
+    for alias, iso3 in KNOWN_ALIASES.items():
+        registry.add(iso3, alias)
+    for code, iso3 in OUTDATED_CODES.items():
+        registry.aliases[_normalize(code)] = iso3
+
+    return registry
+
+
+def GetCountryRegistry(regions_file='Regions.xlsx',
+                       wits_dir='wits_en_trade_summary_allcountries_allyears',
+                       borders_file='TM_WORLD_BORDERS_SIMPL-0.3/TM_WORLD_BORDERS_SIMPL-0.3.dbf'):
+    """
+    This function returns the shared CountryRegistry built from the files
+    shipped with the project. It is built once per set of files and then
+    reused, so every loader can call it. Files that do not exist are skipped.
+    """
+    key = (regions_file, wits_dir, borders_file)
+    if key not in _registries:
+        _registries[key] = BuildCountryRegistry(
+            regions_file=regions_file if regions_file and os.path.exists(regions_file) else None,
+            wits_dir=wits_dir if wits_dir and os.path.isdir(wits_dir) else None,
+            borders_file=borders_file if borders_file and os.path.exists(borders_file) else None)
+    return _registries[key]
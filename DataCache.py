@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk caches for the external data (World Bank, and Excel workbooks such
+as the IEA time series).
+
+Dataframes are stored in a simple columnar format: one directory per
+dataframe, with one .npy file per column (index levels included) and a
+meta.json file with the column names and types. Single columns can be read
+without touching the others, and numeric columns can be memory-mapped.
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from DataSources import DefaultSourceWB
+
+
+def WriteColumnar(dataframe, directory):
+    """
+    This function writes a dataframe to a directory in the columnar format.
+    The directory is written next to the target first and then moved into
+    place, so readers never see a half written dataframe.
+
+    Object columns are stored as text; columns that mix numbers and text are
+    therefore read back as text.
+
+    ------
+    Inputs
+    ------
+    dataframe:  the dataframe to write
+    directory:  the target directory (replaced if it exists)
+    """
+    flat = dataframe.reset_index()
+    # one temporary directory per process and thread, so concurrent writers
+    # of the same entry do not write into each other's files
+    temporary = '%s.tmp%d.%d' % (directory, os.getpid(), threading.get_ident())
+    if os.path.exists(temporary):
+        shutil.rmtree(temporary)
+    os.makedirs(temporary)
+
+    columns = []
+    for position, name in enumerate(flat.columns):
+        column = flat.iloc[:, position]
+        filename = 'c%d.npy' % position
+        if column.dtype == object or isinstance(column.dtype, pd.CategoricalDtype) \
+                or pd.api.types.is_string_dtype(column.dtype):
+            nulls = column.isnull().to_numpy()
+            values = np.array(['' if null else str(value) for value, null in zip(column, nulls)], dtype=str)
+            np.save(os.path.join(temporary, 'n%d.npy' % position), nulls)
+            kind = 'text'
+        else:
+            values = column.to_numpy()
+            kind = 'array'
+        np.save(os.path.join(temporary, filename), values, allow_pickle=False)
+        columns.append({'name': _json_name(name), 'file': filename, 'kind': kind})
+
+    meta = {'columns': columns,
+            'index_levels': dataframe.index.nlevels,
+            'index_names': [_json_name(name) for name in dataframe.index.names],
+            'created': time.time()}
+    with open(os.path.join(temporary, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+    try:
+        os.replace(temporary, directory)
+    except OSError:
+        # another writer put the same entry in place first
+        if not os.path.exists(os.path.join(directory, 'meta.json')):
+            raise
+        shutil.rmtree(temporary, ignore_errors=True)
+
+
+def ReadColumnar(directory, columns=None, mmap_mode=None):
+    """
+    This function reads a dataframe that was written with WriteColumnar.
+
+    ------
+    Inputs
+    ------
+    directory:  the directory of the dataframe
+    columns:    the columns to read (default: all). The index is always read.
+    mmap_mode:  passed to numpy.load, use 'r' to memory-map the numeric
+                columns instead of reading them (default: None)
+
+    -------
+    Outputs
+    -------
+    dataframe:  the dataframe
+    """
+    with open(os.path.join(directory, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+
+    levels = meta['index_levels']
+    wanted = None if columns is None else set(columns)
+
+    data = {}
+    order = []
+    for position, column in enumerate(meta['columns']):
+        name = _name(column['name'])
+        if wanted is not None and position >= levels and name not in wanted:
+            continue
+        if column['kind'] == 'text':
+            values = np.load(os.path.join(directory, column['file'])).astype(object)
+            values[np.load(os.path.join(directory, 'n%d.npy' % position))] = None
+        else:
+            values = np.load(os.path.join(directory, column['file']), mmap_mode=mmap_mode)
+        data[name] = values
+        order.append(name)
+
+    dataframe = pd.DataFrame(data, columns=order, copy=False).set_index(order[:levels])
+    dataframe.index.names = [_name(name) for name in meta['index_names']]
+    if columns is not None:
+        dataframe = dataframe[[column for column in columns if column in dataframe.columns]]
+    return dataframe
+
+
+def _json_name(name):
+    # JSON has no tuples or numpy scalars
+    if isinstance(name, np.generic):
+        return name.item()
+    return name
+
+
+def _name(name):
+    return tuple(name) if isinstance(name, list) else name
+
+
+def _directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, filename)) for filename in os.listdir(directory))
+
+
+class WBCache(object):
+    """
+    -------
+
+    Cache for World Bank pulls. It has the same get_dataframe method as
+    wbdata, so it can be passed to GetDataWB as the source. Every indicator
+    is stored on disk per year, so a pull only fetches the (indicator, year)
+    pairs that are not in the cache yet, with one request, and assembles the
+    rest from disk. Repeated runs and sweeps over year1/year2, workers or
+    batch_size are therefore served offline. Pulls without a date range are
+    passed on to the source without caching.
+
+    Entries older than ttl seconds are fetched again. When the cache grows
+    beyond max_bytes, the least recently used entries are removed. The cache
+    can be shared by the threads of a concurrent fetch.
+
+    -------
+    Inputs:
+        - directory : the cache directory (default: 'wb_cache')
+        - ttl       : the time to live of an entry in seconds, None to keep
+                      entries forever (default: one week)
+        - max_bytes : the maximum size of the cache (default: 100 MB)
+        - source    : where to fetch missing entries from, any object with a
+                      wbdata-like get_dataframe (default: wbdata, behind
+                      the lock of DataSources.DefaultSourceWB)
+    -------
+
+    """
+
+    def __init__(self, directory='wb_cache', ttl=7*24*3600, max_bytes=100*2**20, source=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.source = DefaultSourceWB(source)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, code, year, **kwargs):
+        """
+        Returns the cache key of one indicator in one year: a hash of the
+        indicator code, the year and any other arguments of the pull (e.g. 
+        country) that change its result.
+        """
+        description = json.dumps({'indicator': code,
+                                  'year': year,
+                                  'arguments': sorted((name, repr(value)) for name, value in kwargs.items())})
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def get_dataframe(self, indicators, date=None, keep_levels=False, **kwargs):
+        if date is None:
+            self.misses += 1
+            return self.source.get_dataframe(indicators, keep_levels=keep_levels, **kwargs)
+        first, last = (date if isinstance(date, (tuple, list)) else (date, date))
+        years = range(_date_year(first), _date_year(last)+1)
+
+        parts = {}
+        missing = []
+        for code in indicators:
+            for year in years:
+                part = self._read(self.key(code, year, **kwargs))
+                if part is None:
+                    missing.append((code, year))
+                else:
+                    parts[code, year] = part
+        self.hits += len(parts)
+        self.misses += len(missing)
+
+        if missing:
+            codes = list(dict.fromkeys(code for code, year in missing))
+            first_missing = min(year for code, year in missing)
+            last_missing = max(year for code, year in missing)
+            fetched = self.source.get_dataframe({code: code for code in codes},
+                                                date=(datetime.datetime(first_missing, 1, 1),
+                                                      datetime.datetime(last_missing, 1, 1)),
+                                                keep_levels=True, **kwargs)
+            fetched_years = np.array([_date_year(value) for value in fetched.index.get_level_values(1)])
+            for code, year in missing:
+                part = fetched.loc[fetched_years == year, [code]]
+                entry = os.path.join(self.directory, self.key(code, year, **kwargs))
+                WriteColumnar(part, entry)
+                parts[code, year] = part
+            self.evict()
+
+        columns = [pd.concat([parts[code, year] for year in reversed(years)])[code].rename(indicators[code])
+                   for code in indicators]
+        dataframe = pd.concat(columns, axis=1)
+        # like wbdata: drop the level that has only one value
+        if not keep_levels and len(set(dataframe.index.get_level_values(0))) == 1:
+            dataframe.index = dataframe.index.droplevel(0)
+        elif not keep_levels and len(set(dataframe.index.get_level_values(1))) == 1:
+            dataframe.index = dataframe.index.droplevel(1)
+        return dataframe
+
+    def _read(self, name):
+        # the entry, or None when it is not in the cache or expired
+        entry = os.path.join(self.directory, name)
+        meta = os.path.join(entry, 'meta.json')
+        try:
+            with open(meta) as meta_file:
+                created = json.load(meta_file)['created']
+            if self.ttl is not None and time.time()-created > self.ttl:
+                return None
+            os.utime(meta)
+            return ReadColumnar(entry)
+        except (OSError, ValueError):
+            return None
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache is smaller
+        than max_bytes. The entry given as keep is never removed.
+        """
+        with self.lock:
+            self._evict(keep)
+
+    def _evict(self, keep):
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            meta = os.path.join(entry, 'meta.json')
+            if os.path.isdir(entry) and os.path.exists(meta):
+                entries.append((os.path.getmtime(meta), _directory_size(entry), entry))
+
+        total = sum(size for used, size, entry in entries)
+        for used, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+
+def FileHash(file, chunk_size=2**20):
+    """
+    This function returns the sha1 of the content of a file.
+    """
+    digest = hashlib.sha1()
+    with open(file, 'rb') as content:
+        for chunk in iter(lambda: content.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cached_file_hash(file, cache_dir):
+    # the hash is only computed again when the mtime or size of the file changed
+    fingerprints_file = os.path.join(cache_dir, 'files.json')
+    fingerprints = {}
+    if os.path.exists(fingerprints_file):
+        with open(fingerprints_file) as fingerprints_json:
+            fingerprints = json.load(fingerprints_json)
+    status = os.stat(file)
+    path = os.path.abspath(file)
+    known = fingerprints.get(path)
+    if known is not None and known['mtime'] == status.st_mtime_ns and known['size'] == status.st_size:
+        return known['sha1']
+    sha1 = FileHash(file)
+    fingerprints[path] = {'mtime': status.st_mtime_ns, 'size': status.st_size, 'sha1': sha1}
+    temporary = fingerprints_file+'.tmp%d' % os.getpid()
+    with open(temporary, 'w') as fingerprints_json:
+        json.dump(fingerprints, fingerprints_json, indent=1)
+    os.replace(temporary, fingerprints_file)
+    return sha1
+
+
+def _code_hash(code, digest):
+    # the bytecode, constants and names of a function, nested functions included
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode('utf-8'))
+    for constant in code.co_consts:
+        if hasattr(constant, 'co_code'):
+            _code_hash(constant, digest)
+        else:
+            digest.update(repr(constant).encode('utf-8'))
+
+
+def PrepareVersion(prepare):
+    """
+    This function gives the version of a prepare step of ReadExcelCached: 
+    its name and a hash of its bytecode, constants and the names it uses. 
+    Editing the function therefore gives another cache entry. Functions it 
+    calls are not hashed, so a change in a helper of prepare still needs an
+    explicit prepare_version (or a cleared cache directory).
+    """
+    name = getattr(prepare, '__module__', '')+'.'+getattr(prepare, '__qualname__', repr(prepare))
+    code = getattr(prepare, '__code__', None)
+    if code is None:
+        return name
+    digest = hashlib.sha1()
+    _code_hash(code, digest)
+    return name+':'+digest.hexdigest()
+
+
+def ReadExcelCached(file, cache_dir='excel_cache', columns=None, mmap_mode=None, prepare=None,
+                    prepare_version=None, **kwargs):
+    """
+    This function reads a sheet of an Excel file through a columnar cache.
+    The first time the sheet is parsed with pandas.read_excel and written 
+    with WriteColumnar; later calls read only the requested columns from 
+    the cache (memory-mapping the numeric ones with mmap_mode='r'; such a 
+    dataframe is read-only). The cache entry is keyed on
+    the content hash of the file (recomputed only when its mtime or size 
+    changes) and the arguments, so an updated workbook is parsed again.
+
+    ------
+    Inputs
+    ------
+    file:       the Excel file
+    cache_dir:  the cache directory (default: 'excel_cache')
+    columns:    the columns to read (default: all)
+    mmap_mode:  passed to ReadColumnar (default: None, a normal writable
+                dataframe)
+    prepare:    function applied to the parsed dataframe before it is cached
+                (e.g. to turn placeholders into NaN); its version (see
+                PrepareVersion) is part of the key, so editing it parses
+                the sheet again
+    prepare_version: an explicit version of prepare for the key instead of
+                the bytecode hash, e.g. when prepare depends on helpers
+                (default: None)
+    kwargs:     passed to pandas.read_excel
+
+    -------
+    Outputs
+    -------
+    dataframe:  the sheet
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    description = json.dumps({'sha1': _cached_file_hash(file, cache_dir),
+                              'arguments': sorted((name, repr(value)) for name, value in kwargs.items()),
+                              'prepare': None if prepare is None else PrepareVersion(prepare),
+                              'prepare_version': prepare_version})
+    entry = os.path.join(cache_dir, hashlib.sha1(description.encode('utf-8')).hexdigest())
+    if not os.path.exists(os.path.join(entry, 'meta.json')):
+        dataframe = pd.read_excel(file, **kwargs)
+        if prepare is not None:
+            dataframe = prepare(dataframe)
+        WriteColumnar(dataframe, entry)
+    return ReadColumnar(entry, columns=columns, mmap_mode=mmap_mode)
+
+
+def _date_year(date):
+    if isinstance(date, (datetime.date, datetime.datetime, pd.Timestamp)):
+        return date.year
+    return int(str(date)[:4])
@@ -9,6 +9,11 @@ Created on Mon Oct 16 11:55:03 2017
 import pandas as pd
 import wbdata
 import datetime
+from CountryRegistry import GetCountryRegistry
+from DataSources import FetchRangeWB, LatestObservationsWB
+from IEAIndex import IEAIndex, YearColumns
+from DataCache import ReadExcelCached
+from Imputation import ImputeByGroups, WithSourceColumns, SplitSourceColumns, ProvenanceSummary
 
 
 # WORLD BANK DATA
@@ -69,10 +74,15 @@ def GetIndicatorsWB(file="Selected_Indicators.xlsx", sheet="Blad1" ):
     
 
 
-def GetDataWB(indicators, year1=2000, year2=2016):
+def GetDataWB(indicators, year1=2000, year2=2016, source=None, batched=True, batch_size=None, workers=1,
+              provenance=False):
     """
     This function first retrieves World Bank data from the latest year, and then
     fills any missing data in the dataframe with data from previous years (in the specified range).
+
+    By default all years are retrieved at once (one request per batch of 
+    indicators) and the latest available year is taken locally. With 
+    batched=False every year is retrieved with a separate request.
     
     ------
     Inputs
@@ -81,38 +91,62 @@ def GetDataWB(indicators, year1=2000, year2=2016):
                     function GetIndicatorsWB()
     year1:          The lower bound for time-period (default=2000)
     year2:          The upper bound for the time-period (default=2016)
+    source:         Where the data is retrieved from: wbdata (default), a 
+                    DataCache.WBCache to cache the pulls on disk, or a 
+                    DataSources.LocalWBSource to work offline
+    batched:        Retrieve all years at once (default=True)
+    batch_size:     The number of indicators per request when batched
+                    (default: all indicators in one request, or one per 
+                    request when workers > 1)
+    workers:        The number of requests that run concurrently when 
+                    batched (default=1)
+    provenance:     Return the sources as a separate categorical provenance
+                    dataframe instead of "<column> source" columns 
+                    (default=False)
     
     -------
     Outputs
     -------
     dataframe:      The resulting dataframe
+    provenance:     Only when provenance is True: the source of every value
     """
     
+    if source is None:
+        source=wbdata
+    
+    if batched:
+        # the years year1+1 up to and including year2, like the loop below;
+        # the loop always takes year2, also when year1 >= year2
+        return LatestObservationsWB(FetchRangeWB(indicators, min(year1+1, year2), year2, source, batch_size,
+                                                 workers=workers), provenance=provenance)
+    
     data_date=(datetime.datetime(year2,1,1), datetime.datetime(year2,1,1))
     
-    df_filled = wbdata.get_dataframe(indicators, data_date=data_date)
+    df_filled = source.get_dataframe(indicators, date=data_date)
     
     for column in df_filled:
         column_source= column + ' source'
         df_filled[column_source] = None
-        df_filled[column_source][df_filled[column].notnull()] = 'WB data ' + str(year2)                 
+        df_filled.loc[df_filled[column].notnull(), column_source] = 'WB data ' + str(year2)                 
                          
     year2range=year2-1
                          
     for year in range(year2range, year1, -1):
         data_date = (datetime.datetime(year,1,1), datetime.datetime(year,1,1))
-        df_year = wbdata.get_dataframe(indicators, data_date=data_date)
+        df_year = source.get_dataframe(indicators, date=data_date)
         
         for column in df_year:
             column_source = column + ' source'
             df_year[column_source] = None
-            df_year[column_source][df_year[column].notnull()] = 'WB data ' + str(year)
+            df_year.loc[df_year[column].notnull(), column_source] = 'WB data ' + str(year)
         df_filled = df_filled.combine_first(df_year)
-            
+    
+    if provenance:
+        return SplitSourceColumns(df_filled)
     return df_filled
 
 
-def FillByRegionAndIncomeWB(dataframe):
+def FillByRegionAndIncomeWB(dataframe, provenance=None):
     """
     This function fills missing values in the dataframe by taking the mean of 
     countries in the same region with the same income level. 
@@ -123,38 +157,26 @@ def FillByRegionAndIncomeWB(dataframe):
     dataframe:      a dataframe with the countries as index and a region and
                     income column. 
                     
+    provenance:     the provenance dataframe of the values (optional); when
+                    given, it is updated instead of the "<column> source"
+                    columns
+                    
     -------
     Outputs
     -------
     df_complete:    the resulting dataframe
+    provenance:     only when provenance is given: the updated provenance
     """
     
-    source_cols=[col for col in dataframe.columns if 'source' in col]
-    data=dataframe.drop(source_cols, axis=1)
+    if provenance is not None:
+        return ImputeByGroups(dataframe, levels=[['Region', 'IncomeGroup']], provenance=provenance)
     
-    filled_data=pd.DataFrame()
+    filled, provenance = ImputeByGroups(dataframe, levels=[['Region', 'IncomeGroup']])
+    df_complete = WithSourceColumns(filled, provenance)
     
-    # actions on data frame
-    for region in set(data['Region']):
-        for incomelevel in set(data['IncomeGroup']):
-            regional_data=data.loc[(data["Region"]==region) & (data["IncomeGroup"]==incomelevel)]
-            regional_data=regional_data.fillna(regional_data.mean())
-            filled_data=filled_data.append(regional_data)
-            
-    dont_include = ['Country Data', 'Region', 'IncomeGroup']
-            
-    for column in filled_data.columns[~filled_data.columns.isin(dont_include)]:
-            column_source = column + ' source'
-            filled_data[column_source] = None
-            filled_data[column_source][filled_data[column].notnull()] = 'Estimation based on region and income' 
-        
-        
-    df_complete = dataframe.combine_first(filled_data)
-            
     return df_complete
 
-
-def FillByIncomeWB(dataframe):
+def FillByIncomeWB(dataframe, provenance=None):
     """
     This function fills missing values in the dataframe by taking the mean of 
     countries with the same income level. 
@@ -165,35 +187,26 @@ def FillByIncomeWB(dataframe):
     dataframe:      a dataframe with the countries as index and an
                     income column. 
                     
+    provenance:     the provenance dataframe of the values (optional); when
+                    given, it is updated instead of the "<column> source"
+                    columns
+                    
     -------
     Outputs
     -------
     df_complete:    the resulting dataframe
+    provenance:     only when provenance is given: the updated provenance
     """
     
-    source_cols=[col for col in dataframe.columns if 'source' in col]
+    if provenance is not None:
+        return ImputeByGroups(dataframe, levels=[['IncomeGroup']], provenance=provenance)
     
-    data=dataframe.drop(source_cols, axis=1)
+    filled, provenance = ImputeByGroups(dataframe, levels=[['IncomeGroup']])
+    df_complete = WithSourceColumns(filled, provenance)
     
-    filled_data=pd.DataFrame()
-    
-    for incomelevel in set(data['IncomeGroup']):
-        income_data=data.loc[(data["IncomeGroup"]==incomelevel)]
-        income_data=income_data.fillna(income_data.mean())
-        filled_data=filled_data.append(income_data)
-    
-    dont_include = ['Country Data', 'Region', 'IncomeGroup']
-            
-    for column in filled_data.columns[~filled_data.columns.isin(dont_include)]:
-            column_source = column + ' source'
-            filled_data[column_source] = None
-            filled_data[column_source][filled_data[column].notnull()] = 'Estimation based on income' 
-    
-    df_complete = dataframe.combine_first(filled_data)
-        
     return df_complete
 
-def FillByRegionWB(dataframe):
+def FillByRegionWB(dataframe, provenance=None):
     """
     This function fills missing values in the dataframe by taking the mean of 
     countries in the same region. 
@@ -204,34 +217,26 @@ def FillByRegionWB(dataframe):
     dataframe:      a dataframe with the countries as index and a region and
                     income column. 
                     
+    provenance:     the provenance dataframe of the values (optional); when
+                    given, it is updated instead of the "<column> source"
+                    columns
+                    
     -------
     Outputs
     -------
     df_complete:    the resulting dataframe
+    provenance:     only when provenance is given: the updated provenance
     """
     
-    source_cols=[col for col in dataframe.columns if 'source' in col]
-    data=dataframe.drop(source_cols, axis=1)
-    
-    filled_data=pd.DataFrame()
-    
-    for region in set(data['Region']):
-        regional_data=data.loc[(data["Region"]==region)]
-        regional_data=regional_data.fillna(regional_data.mean())
-        filled_data=filled_data.append(regional_data)
+    if provenance is not None:
+        return ImputeByGroups(dataframe, levels=[['Region']], provenance=provenance)
     
-    dont_include = ['Country Data', 'Region', 'IncomeGroup']
-    
-    for column in filled_data.columns[~filled_data.columns.isin(dont_include)]:
-            column_source = column + ' source'
-            filled_data[column_source] = None
-            filled_data[column_source][filled_data[column].notnull()] = 'Estimation based on region'
-    
-    df_complete = dataframe.combine_first(filled_data)
+    filled, provenance = ImputeByGroups(dataframe, levels=[['Region']])
+    df_complete = WithSourceColumns(filled, provenance)
     
     return df_complete
 
-def FillWithMeanWB(dataframe):
+def FillWithMeanWB(dataframe, provenance=None):
     """
     
     This function fills any missing data with the mean of all the other countries. 
@@ -240,125 +245,152 @@ def FillWithMeanWB(dataframe):
     ------
     dataframe: The dataframe with missing data. 
     
+    provenance: The provenance dataframe of the values (optional); when
+                given, it is updated instead of the "<column> source" columns
+    
     -------
     Outputs
     -------
     df_complete:    The resulting dataframe
+    provenance:     Only when provenance is given: the updated provenance
     
     """
-
-    
-    source_cols=[col for col in dataframe.columns if 'source' in col]
-    
-    data=dataframe.drop(source_cols, axis=1)
-    
-    filled_data=pd.DataFrame()
-    
-    filled_data=data.fillna(data.mean())
-    
-    dont_include = ['Country Data', 'Region', 'IncomeGroup']
-    
-    for column in filled_data.columns[~filled_data.columns.isin(dont_include)]:
-            column_source = column + ' source'
-            filled_data[column_source] = None
-            filled_data[column_source][filled_data[column].notnull()] = 'Estimation based on region'
     
+    if provenance is not None:
+        return ImputeByGroups(dataframe, levels=[[]], provenance=provenance)
     
-    df_complete=dataframe.combine_first(filled_data)
+    filled, provenance = ImputeByGroups(dataframe, levels=[[]])
+    df_complete = WithSourceColumns(filled, provenance)
     
     return df_complete
 
-def PopulationRangesWB(dataframe, tabnames):
+# The population ranges needed for the model. Every range is the sum of:
+#   - 'total':      columns with absolute numbers
+#   - 'male':       columns with a percentage of the male population
+#   - 'female':     columns with a percentage of the female population
+#   - 'of_total':   columns with a percentage of the total population
+# Ranges with 'rescale' are scaled down when the ranges add up to more than
+# the total population.
+POPULATION_BUCKETS = {
+    'Population0to14': {'total': ["Population, ages 0-14, total"],
+                        'rescale': True},
+    'Population15to34': {'male': ["Population ages 15-19, male (% of male population)",
+                                  "Population ages 20-24, male (% of male population)",
+                                  "Population ages 25-29, male (% of male population)",
+                                  "Population ages 30-34, male (% of male population)"],
+                         'female': ["Population ages 15-19, female (% of female population)",
+                                    "Population ages 20-24, female (% of female population)",
+                                    "Population ages 25-29, female (% of female population)",
+                                    "Population ages 30-34, female (% of female population)"],
+                         'rescale': False},
+    'Population35to64': {'male': ["Population ages 35-39, male (% of male population)",
+                                  "Population ages 40-44, male (% of male population)",
+                                  "Population ages 45-49, male (% of male population)",
+                                  "Population ages 50-54, male (% of male population)",
+                                  "Population ages 55-59, male (% of male population)",
+                                  "Population ages 50-64, male (% of male population)"], # Note: the indicatorcode says 60-64
+                         'female': ["Population ages 35-39, female (% of female population)",
+                                    "Population ages 40-44, female (% of female population)",
+                                    "Population ages 45-49, female (% of female population)",
+                                    "Population ages 50-54, female (% of female population)",
+                                    "Population ages 55-59, female (% of female population)",
+                                    "Population ages 50-64, female (% of female population)"], # Note: the indicatorcode says 60-64
+                         'rescale': False},
+    'PopulationOver65': {'of_total': ["Population ages 65 and above (% of total)"],
+                         'rescale': True},
+    }
+
+def PopulationRangesWB(dataframe, tabnames, buckets=None, tolerance=10000, report=False):
     """
     This function translates the WB population data to the correct ranges needed
     for the model. 
     
+    All countries are done at once with column-wise operations. When the 
+    male and female population add up to more than the total population 
+    (by more than tolerance), they are scaled down to the total first. When 
+    the ranges that can be rescaled make the sum of the ranges exceed the 
+    total population, they are scaled down as well.
+    
+    Missing values are treated as in the original per-country code: missing 
+    male and female age percentages count as 0, so a country without any 
+    of them gets a range of 0, while a missing 'total' or 'of_total' 
+    column, or a missing male or female population, gives NaN.
+    
     ------
     Inputs
     ------
     dataframe:  The dataframe that contains the population data from WB
     tabnames:   The dictionary that contains the tabnames for each indicator
+    buckets:    The definition of the ranges (default: POPULATION_BUCKETS)
+    tolerance:  The allowed difference with the total population 
+                (default: 10000)
+    report:     Also return the report of the rescaled countries 
+                (default: False)
     
     -------
     Outputs
     -------
     new_df:     The dataframe with the correct population ranges
     tabnames:   The updated dictionary with the tabnames for each indicator
+    report:     Only when report is True: dataframe with the countries as 
+                index, whether the sexes and the ranges were rescaled and 
+                the remaining difference with the total population
     """
-    
-
+    if buckets is None:
+        buckets=POPULATION_BUCKETS
     
     new_df=dataframe.copy()
-    new_df["Population0to14"]=dataframe["Population, ages 0-14, total"]
-    male15to34columns=["Population ages 15-19, male (% of male population)",
-                       "Population ages 20-24, male (% of male population)",
-                       "Population ages 25-29, male (% of male population)",
-                       "Population ages 30-34, male (% of male population)"]
-    
-    female15to34columns=["Population ages 15-19, female (% of female population)",
-                         "Population ages 20-24, female (% of female population)",
-                         "Population ages 25-29, female (% of female population)",
-                         "Population ages 30-34, female (% of female population)"]
-    
-    male35to64columns=["Population ages 35-39, male (% of male population)",
-                      "Population ages 40-44, male (% of male population)",
-                      "Population ages 45-49, male (% of male population)",
-                      "Population ages 50-54, male (% of male population)",
-                      "Population ages 55-59, male (% of male population)",
-                      "Population ages 50-64, male (% of male population)"] # Note: the indicatorcode says 60-64
-    
-    female35to64columns=["Population ages 35-39, female (% of female population)",
-                      "Population ages 40-44, female (% of female population)",
-                      "Population ages 45-49, female (% of female population)",
-                      "Population ages 50-54, female (% of female population)",
-                      "Population ages 55-59, female (% of female population)",
-                      "Population ages 50-64, female (% of female population)"] # Note: the indicatorcode says 60-64
-
-    malepop15to34percentage=dataframe[male15to34columns].sum(axis=1)/100
-    femalepop15to34percentage=dataframe[female15to34columns].sum(axis=1)/100
-    malepop35to64percentage=dataframe[male35to64columns].sum(axis=1)/100
-    femalepop35to64percentage=dataframe[female35to64columns].sum(axis=1)/100
-
-    for country in new_df.index:
-        if (dataframe["Population, male"].loc[country]+dataframe["Population, female"].loc[country])-dataframe["Population, total"].loc[country]>10000:
-            print("Rescaling male and female populations for ",country)
-            new_df["Population, male"].loc[country]=dataframe["Population, male"].loc[country]*dataframe["Population, total"].loc[country]/(dataframe["Population, male"].loc[country]+dataframe["Population, female"].loc[country])
-            new_df["Population, female"].loc[country]=dataframe["Population, female"].loc[country]*dataframe["Population, total"].loc[country]/(dataframe["Population, male"].loc[country]+dataframe["Population, female"].loc[country])
-            
-    new_df["Population0to14"]=new_df["Population, ages 0-14, total"]
-    new_df["Population15to34"]=malepop15to34percentage*new_df["Population, male"]+femalepop15to34percentage*new_df["Population, female"]
-    new_df["Population35to64"]=malepop35to64percentage*new_df["Population, male"]+femalepop35to64percentage*new_df["Population, female"]
-    new_df["PopulationOver65"]=(dataframe["Population ages 65 and above (% of total)"]/100)*dataframe["Population, total"]
-
-    columns_to_drop=male15to34columns+female15to34columns+male35to64columns+female35to64columns+["Population, ages 0-14, total"]+["Population ages 65 and above (% of total)"]
-    source_list=[]
-    
-    for item in columns_to_drop:
-        source_list.append(item+" source")
-    columns_to_drop=columns_to_drop+source_list
-    
-    new_df.drop(columns_to_drop, axis=1, inplace=True)
-
-    totalpop=new_df[["Population0to14","Population15to34","Population35to64","PopulationOver65"]].sum(axis=1)
-    
-    for country in new_df.index:
-        if totalpop[country]-dataframe["Population, total"].loc[country]>10000:
-            print("Rescaling population ranges for ", country)
-            new_df["Population0to14"].loc[country]=new_df["Population0to14"].loc[country]/(totalpop[country]/new_df["Population, total"].loc[country])
-           # new_df["Population15to34"].loc[country]=new_df["Population15to34"].loc[country]/(totalpop[country]/new_df["Population, total"].loc[country])
-           # new_df["Population35to64"].loc[country]=new_df["Population35to64"].loc[country]/(totalpop[country]/new_df["Population, total"].loc[country])
-            new_df["PopulationOver65"].loc[country]=new_df["PopulationOver65"].loc[country]/(totalpop[country]/new_df["Population, total"].loc[country])
-            
-    newtotalpop=new_df[["Population0to14","Population15to34","Population35to64","PopulationOver65"]].sum(axis=1)        
-    tabnames['Population0to14']='Population0to14'
-    tabnames['Population15to34']='Population15to34'
-    tabnames['Population35to64']='Population35to64'
-    tabnames['PopulationOver65']='PopulationOver65'
-    diff=newtotalpop-dataframe["Population, total"]
-    x=diff>10000
-    print(x.sum(), "countries have their populations deviate significantly.")
-    #print(diff)
-
+    total=dataframe["Population, total"]
+    male=dataframe["Population, male"]
+    female=dataframe["Population, female"]
+    
+    sexes=male+female
+    sexes_rescaled=(sexes-total>tolerance).to_numpy()
+    male=male.where(~sexes_rescaled, male*total/sexes)
+    female=female.where(~sexes_rescaled, female*total/sexes)
+    new_df["Population, male"]=male
+    new_df["Population, female"]=female
+    
+    def percentage(columns, min_count):
+        return dataframe[columns].sum(axis=1, min_count=min_count)/100
+    
+    ranges=pd.DataFrame(index=dataframe.index)
+    for name, bucket in buckets.items():
+        parts=[]
+        if bucket.get('total'):
+            parts.append(dataframe[bucket['total']].sum(axis=1, min_count=1))
+        if bucket.get('male'):
+            parts.append(percentage(bucket['male'], 0)*male)
+        if bucket.get('female'):
+            parts.append(percentage(bucket['female'], 0)*female)
+        if bucket.get('of_total'):
+            parts.append(percentage(bucket['of_total'], 1)*total)
+        ranges[name]=sum(parts[1:], parts[0])
+    
+    totalpop=ranges.sum(axis=1)
+    ranges_rescaled=(totalpop-total>tolerance).to_numpy()
+    rescale=[name for name, bucket in buckets.items() if bucket.get('rescale')]
+    factor=(totalpop/total).to_numpy()
+    ranges.loc[ranges_rescaled, rescale]=ranges.loc[ranges_rescaled, rescale].div(factor[ranges_rescaled], axis=0)
+    
+    columns_to_drop=[column for bucket in buckets.values() 
+                     for kind in ('total', 'male', 'female', 'of_total') 
+                     for column in bucket.get(kind, [])]
+    columns_to_drop=list(dict.fromkeys(columns_to_drop))
+    columns_to_drop=columns_to_drop+[column+" source" for column in columns_to_drop]
+    new_df.drop(columns_to_drop, axis=1, inplace=True, errors='ignore')
+    for name in ranges.columns:
+        new_df[name]=ranges[name]
+        tabnames[name]=name
+    
+    diff=ranges.sum(axis=1)-total
+    if report:
+        rescaled=pd.DataFrame({'Sexes rescaled': sexes_rescaled,
+                               'Ranges rescaled': ranges_rescaled,
+                               'Difference': diff}, index=dataframe.index)
+        return new_df, tabnames, rescaled
+    
+    print((diff>tolerance).sum(), "countries have their populations deviate significantly.")
     return new_df, tabnames
     
 def SortData(dataframe):
@@ -379,7 +411,7 @@ def SortData(dataframe):
     data_sorted = dataframe.sort_values(['Region', 'Country Data'], axis=0)
     return data_sorted
 
-def DataCompleteness(dataframe):
+def DataCompleteness(dataframe, provenance=None):
     """
     Function to check how complete the dataset is. 
     
@@ -387,17 +419,24 @@ def DataCompleteness(dataframe):
     Inputs
     ------
     dataframe:      The dataframe to check
+    provenance:     The provenance dataframe of the values (optional)
     -------
     Outputs
     -------
     Prints the percentage of data available in the dataframe for each indicator
+    and, when the sources are known (provenance or "<column> source" columns),
+    the percentage of every indicator that comes from every source
     
     """
+    if provenance is None and any(str(col).endswith(' source') for col in dataframe.columns):
+        dataframe, provenance = SplitSourceColumns(dataframe)
     percentage = 100-(dataframe.isnull().sum()/len(dataframe))*100         # percentage of available data
     print(percentage)
+    if provenance is not None:
+        print(ProvenanceSummary(provenance).round(1))
 
 
-def WriteToExcelWB(dataframe, tabnames, filename='testdata1.xlsx'):
+def WriteToExcelWB(dataframe, tabnames, filename='testdata1.xlsx', provenance=None):
     """
     Function that writes the (complete) dataframe to Excel in the correct
     format, with a separate tab for each indicator. 
@@ -409,6 +448,8 @@ def WriteToExcelWB(dataframe, tabnames, filename='testdata1.xlsx'):
     dataframe:  The dataframe to write to Excel
     tabnames:   The dictionary that contains the tabnames of the indicators
     filename:   The name of the resulting Excel file
+    provenance: The provenance dataframe of the values (default: taken from 
+                the "<column> source" columns)
     
     -------
     Outputs
@@ -419,24 +460,26 @@ def WriteToExcelWB(dataframe, tabnames, filename='testdata1.xlsx'):
     
     """
     
-    writer = pd.ExcelWriter(filename)
     dont_include = ['Country Data', 'Region', 'IncomeGroup', 'Population0to14',
                     'Population15to34','Population35to64','PopulationOver65']
     
-    source_cols=[col for col in dataframe.columns if 'source' in col]
+    if provenance is None:
+        dataframe1, provenance = SplitSourceColumns(dataframe)
+    else:
+        source_cols=[col for col in dataframe.columns if str(col).endswith(' source')]
+        dataframe1=dataframe.drop(source_cols, axis=1)
     
-    dataframe1=dataframe.drop(source_cols, axis=1)
-    
-    regional_data=pd.DataFrame(index=list(set(dataframe['Region'])), columns=['Region'])
-    regional_data.to_excel(writer, 'Regional Data')
-    
-    for column in dataframe1.columns:
-        if column in dont_include:
-            df_to_write=pd.DataFrame(dataframe1[column])
-            df_to_write.to_excel(writer, tabnames[column][:31])
-        else:
-            df_to_write = dataframe[[column,column+" source"]]
-            df_to_write.to_excel(writer, tabnames[column][:31])
+    with pd.ExcelWriter(filename) as writer:
+        regional_data=pd.DataFrame(index=list(set(dataframe['Region'])), columns=['Region'])
+        regional_data.to_excel(writer, sheet_name='Regional Data')
+        
+        for column in dataframe1.columns:
+            if column in dont_include or column not in provenance.columns:
+                df_to_write=pd.DataFrame(dataframe1[column])
+            else:
+                df_to_write=pd.DataFrame({column: dataframe1[column],
+                                          column+" source": provenance[column].reindex(dataframe1.index)})
+            df_to_write.to_excel(writer, sheet_name=tabnames[column][:31])
             
 
 # WORLD BANK DATA
@@ -445,17 +488,58 @@ def WriteToExcelWB(dataframe, tabnames, filename='testdata1.xlsx'):
             
             
            
-def GetDataFromExcelEIA(file, indicatorfile):
-    
-    data=pd.read_excel(file,  sheetname='TimeSeries_1971-2015', header=0, skiprows=1, skip_footer=0, index_col=None, 
-                    parse_cols=None, parse_dates=False, date_parser=None, 
-                    na_values=None, thousands=None, convert_float=True, has_index_names=None, converters=None, dtype=None, 
-                    true_values=None, false_values=None, engine=None, squeeze=False)
+def CoerceYearsEIA(data):
+    """
+    This function turns the year columns of the IEA sheet into numbers; the
+    IEA placeholders ('..' not available, 'x' confidential, ...) become NaN.
+    """
+    data=data.copy()
+    for column in YearColumns(data).values():
+        data[column]=pd.to_numeric(data[column], errors='coerce')
+    return data
+
+def GetDataFromExcelEIA(file, indicatorfile, registry=None, cache_dir='iea_cache', columns=None, mmap_mode=None):
+    """
+    This function reads the IEA time series and the list of needed indicators.
+    The country names of the IEA are translated once into the names used in
+    the rest of the model (e.g. "People's Republic of China" becomes "China"),
+    with the CountryRegistry. Names that are not countries (IEA regions) are
+    kept as they are.
+    
+    The time series sheet is parsed only once: it is cached in a columnar
+    format in cache_dir (see DataCache.ReadExcelCached), with the IEA 
+    placeholders turned into NaN. Later calls read the cache and only the 
+    requested columns.
+    ------
+    Inputs
+    ------
+    file:             The IEA Excel file
+    indicatorfile:    The Excel file with the needed indicators (IEADATA.xlsx)
+    registry:         The CountryRegistry to use (default: GetCountryRegistry())
+    cache_dir:        The cache directory, None to always parse the Excel file
+                      (default: 'iea_cache')
+    columns:          The columns of the time series to read, e.g. the 
+                      Country, Product and Flow columns and some years 
+                      (default: all)
+    mmap_mode:        'r' to memory-map the year columns of the cache; the
+                      dataframe is then read-only (default: None)
+    """
     
-    data_needed=pd.read_excel(indicatorfile, sheetname=0, header=None, skiprows=None, skip_footer=0, 
-                        parse_cols=None, parse_dates=False, date_parser=None, na_values=None, thousands=None, 
-                        convert_float=True, has_index_names=None, converters=None, dtype=None, true_values=None, 
-                        false_values=None, engine=None, squeeze=False)
+    if cache_dir is None:
+        data=CoerceYearsEIA(pd.read_excel(file, sheet_name='TimeSeries_1971-2015', header=0, skiprows=1))
+        if columns is not None:
+            data=data[columns]
+    else:
+        data=ReadExcelCached(file, cache_dir=cache_dir, columns=columns, mmap_mode=mmap_mode,
+                             prepare=CoerceYearsEIA,
+                             sheet_name='TimeSeries_1971-2015', header=0, skiprows=1)
+    
+    data_needed=pd.read_excel(indicatorfile, sheet_name=0, header=None)
+    
+    if registry is None:
+        registry=GetCountryRegistry()
+    if 'Country' in data.columns:
+        data['Country']=registry.canonical_names(data['Country']).values
     return data, data_needed
             
 def CollectDataYearEIA(data, data_needed, countries, year=2014):
@@ -466,23 +550,17 @@ def CollectDataYearEIA(data, data_needed, countries, year=2014):
     ------
     Inputs
     ------
-    data:             Pandas Dataframe from the IEA Excel file
+    data:             Pandas Dataframe from the IEA Excel file, or an IEAIndex
+                      built from it (faster when called more than once)
     data_needed:      The indicators from IEADATA.xlsx
     countries:        The list of countries we want data for (from regions.xlsx)
     year:             The initial year we want the data from (default = 2014)
     """
+    index=data if isinstance(data, IEAIndex) else IEAIndex.from_frame(data)
     filled_dataframe=countries.copy()
-    for i in data_needed.index:
-        df=data.loc[(data['Product'] == data_needed[0][i]) & (data['Flow']== data_needed[1][i])]
-        df=df.replace("People's Republic of China", "China")
-        df=df.replace("Korea", "Korea, Rep.")
-        df=df.set_index('Country')
-        column_name=data_needed[2][i]
-        filled_dataframe[column_name]=None
-        for index in df.index:    
-            for index2 in countries.index:
-                if index==index2:
-                    filled_dataframe[column_name][index2]=df[year][index]
+    values=index.extract(data_needed, countries, year=year)
+    for column_name in values.columns:
+        filled_dataframe[column_name]=values[column_name]
     return filled_dataframe
 
 def GetRegionsEIA(data, countries):
@@ -503,57 +581,34 @@ def GetRegionsEIA(data, countries):
 def CollectRegionDataYearEIA(data, data_needed, regions, year=2014):
     """
     This function retrieves the indicators (specified in data_needed) from the IEA dataframe (data). 
-    The data is retrieved for all countries in countries that are also in the IEA data. 
+    The data is retrieved for all regions in regions that are also in the IEA data. 
     Default year is 2014. 
     ------
     Inputs
     ------
-    data:             Pandas Dataframe from the IEA Excel file
+    data:             Pandas Dataframe from the IEA Excel file, or an IEAIndex
     data_needed:      The indicators from IEADATA.xlsx
-    countries:        The list of countries we want data for (from regions.xlsx)
+    regions:          The list of regions we want data for (from GetRegionsEIA)
     year:             The initial year we want the data from (default = 2014)
     """
-    filled_dataframe=regions.copy()
-    for i in data_needed.index:
-        df=data.loc[(data['Product'] == data_needed[0][i]) & (data['Flow']== data_needed[1][i])]
-        df=df.replace("People's Republic of China", "China")
-        df=df.replace("Korea", "Korea, Rep.")
-        df=df.set_index('Country')
-        column_name=data_needed[2][i]
-        filled_dataframe[column_name]=None
-        for index in df.index:    
-            for index2 in regions.index:
-                if index==index2:
-                    filled_dataframe[column_name][index2]=df[year][index]
-    return filled_dataframe
+    return CollectDataYearEIA(data, data_needed, regions, year=year)
 
 def FillWithPreviousYearsEIA(dataframe, data, data_needed, countries, year1=1990, year2=2014):
     """
     This function fills any missing data in the dataframe with data from previous years 
-    (in the specified range).
+    (in the specified range). For every value the latest valid year is taken,
+    from year2 back to (but not including) year1, in one selection.
     --------------
     Inputs:
     dataframe
-    year1 (default=2010)
+    data:             Pandas Dataframe from the IEA Excel file, or an IEAIndex
+    data_needed:      The indicators from IEADATA.xlsx
+    countries:        The list of countries
+    year1 (default=1990)
     year2 (default=2014)
     --------------
     """
-    df_filled=dataframe
-    for year in range(year2, year1, -1):
-        df_year=pd.DataFrame(index=countries.index)
-        for i in range(len(data_needed)):
-            df=data.loc[(data['Product'] == data_needed[0][i]) & (data['Flow']== data_needed[1][i])]
-            df=df.replace("People's Republic of China", "China")
-            df=df.replace("Korea", "Korea, Rep.")
-            df=df.set_index('Country')
-            column_name=data_needed[2][i]
-            df_year[column_name]=None
-            for index in df.index:    
-                for index2 in countries.index:
-                    if index==index2:
-                        df_year[column_name][index2]=df[year][index]
-        df_filled=df_filled.combine_first(df_year)
+    index=data if isinstance(data, IEAIndex) else IEAIndex.from_frame(data)
+    latest=index.extract(data_needed, countries, year=year2, first_year=year1+1)
+    df_filled=dataframe.combine_first(latest)
     return df_filled
-
-
-
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sources for the external data, and local stand-ins for them that can be
+used offline (e.g. in tests).
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import requests
+import wbdata
+
+from Imputation import MakeProvenance
+
+
+class RateLimiter(object):
+    """
+    -------
+
+    Thread-safe rate limiter: spaces the requests to every host at least
+    1/rate seconds apart, over all threads that share the limiter.
+
+    -------
+    Inputs:
+        - rate : the maximum number of requests per second per host
+    -------
+
+    """
+
+    def __init__(self, rate=10.0):
+        self.interval = 1.0/rate
+        self.lock = threading.Lock()
+        self.next_time = {}
+
+    def wait(self, host):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time.get(host, now))
+            self.next_time[host] = start+self.interval
+        if start > now:
+            time.sleep(start-now)
+
+
+# shared by all fetches in this process, so the limit holds per host
+WB_RATE_LIMITER = RateLimiter(rate=10.0)
+
+
+# Errors of the connection, which are worth retrying; anything else (e.g. a
+# TypeError for a wrong argument, a 4xx answer or an error of a local file)
+# is raised at once
+TRANSPORT_ERRORS = (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout)
+
+
+def IsTransportError(error):
+    """
+    This function tells whether an exception is worth retrying: a
+    connection error, a timeout or a 5xx answer of the server.
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, TRANSPORT_ERRORS)
+
+
+def CallWithRetry(function, retries=3, backoff=0.5, exceptions=None):
+    """
+    This function calls function() and retries it when it raises one of the
+    given exceptions (default: the errors for which IsTransportError is 
+    true), waiting backoff, 2*backoff, 4*backoff, ... seconds in between.
+    The last exception is raised when all retries failed.
+    """
+    for attempt in range(retries+1):
+        try:
+            return function()
+        except Exception as error:
+            retry = isinstance(error, exceptions) if exceptions is not None else IsTransportError(error)
+            if not retry or attempt == retries:
+                raise
+            time.sleep(backoff*2**attempt)
+
+
+class SerializedSource(object):
+    """
+    -------
+
+    Wrapper of a source that is not thread-safe: its get_dataframe is
+    called by one thread at a time. The module-level client of wbdata
+    shares one requests.Session and one shelve cache, which must not be
+    used by several threads at once.
+
+    -------
+    Inputs:
+        - source : any object with a wbdata-like get_dataframe
+        - lock   : the lock to hold during a request (default: a new lock)
+    -------
+
+    """
+
+    def __init__(self, source, lock=None):
+        self.source = source
+        self.lock = threading.Lock() if lock is None else lock
+        self.host = getattr(source, 'host', 'api.worldbank.org')
+
+    def get_dataframe(self, *args, **kwargs):
+        with self.lock:
+            return self.source.get_dataframe(*args, **kwargs)
+
+
+# held by every request through the wbdata module in this process
+WBDATA_LOCK = threading.Lock()
+
+
+def DefaultSourceWB(source=None):
+    """
+    This function gives the source to use for the World Bank data: the 
+    given source, or, when it is None or the wbdata module itself, wbdata 
+    behind WBDATA_LOCK, so concurrent fetches never use its client at the 
+    same time.
+    """
+    if source is None or source is wbdata:
+        return SerializedSource(wbdata, WBDATA_LOCK)
+    return source
+
+
+def FetchRangeWB(indicators, year1, year2, source=None, batch_size=None, workers=1,
+                 rate_limiter=None, retries=3, backoff=0.5):
+    """
+    This function retrieves World Bank data for all years from year1 up to
+    and including year2, with one request per batch of indicators (instead
+    of one request per year).
+
+    With workers > 1 the batches are retrieved concurrently by a pool of 
+    threads, so the total time is set by the slowest batch instead of the 
+    sum of all batches. Requests to the same host are spaced by the rate 
+    limiter and failed requests are retried with exponential backoff. The 
+    result does not depend on the order in which the requests finish.
+    
+    The source must be thread-safe when workers > 1. The wbdata module is
+    not, so its requests are made one at a time (see DefaultSourceWB); only
+    the waits for the rate limiter and the retries overlap then. For 
+    concurrent requests to the World Bank use AsyncSources.fetch_wb.
+    
+    ------
+    Inputs
+    ------
+    indicators:     dictionary from indicator code to column name
+    year1:          the first year
+    year2:          the last year
+    source:         where the data is retrieved from (default: wbdata)
+    batch_size:     the number of indicators per request (default: all
+                    indicators in one request, or one indicator per request
+                    when workers > 1)
+    workers:        the number of concurrent requests (default: 1)
+    rate_limiter:   the RateLimiter to use (default: WB_RATE_LIMITER)
+    retries:        the number of retries of a failed request (default: 3)
+    backoff:        the wait before the first retry in seconds (default: 0.5)
+    
+    -------
+    Outputs
+    -------
+    dataframe:      dataframe with a (country, year) MultiIndex, with the 
+                    years as integers, and one column per indicator
+    """
+    source=DefaultSourceWB(source)
+    if rate_limiter is None:
+        rate_limiter=WB_RATE_LIMITER
+    host=getattr(source, 'host', 'api.worldbank.org')
+    
+    date=(datetime.datetime(year1,1,1), datetime.datetime(year2,1,1))
+    codes=list(indicators)
+    if batch_size is None:
+        batch_size=1 if workers > 1 else max(len(codes), 1)
+    batches=[{code: indicators[code] for code in codes[start:start+batch_size]}
+             for start in range(0, len(codes), batch_size)]
+    
+    def fetch(batch):
+        def request():
+            rate_limiter.wait(host)
+            return source.get_dataframe(batch, date=date, keep_levels=True)
+        return CallWithRetry(request, retries=retries, backoff=backoff)
+    
+    if workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            frames=list(pool.map(fetch, batches))
+    else:
+        frames=[fetch(batch) for batch in batches]
+    
+    dataframe=pd.concat(frames, axis=1)
+    dataframe=dataframe[[indicators[code] for code in codes]]
+    dataframe.index=dataframe.index.set_levels(dataframe.index.levels[1].astype(int), level=1)
+    dataframe.index.names=['country', 'year']
+    return dataframe
+
+
+def LatestObservationsWB(dataframe, provenance=False):
+    """
+    This function takes the latest available value of every indicator for
+    every country from a (country, year) dataframe, and adds a 
+    "<column> source" column with the year it comes from ('WB data <year>').
+    Everything is done with one grouped reduction over the whole dataframe.
+    
+    ------
+    Inputs
+    ------
+    dataframe:      dataframe with a (country, year) MultiIndex, e.g. from
+                    FetchRangeWB()
+    provenance:     return the sources as a separate categorical provenance
+                    dataframe (see Imputation) instead of as "<column> source" 
+                    columns (default: False)
+    
+    -------
+    Outputs
+    -------
+    df_filled:      dataframe with the countries as index
+    provenance:     only when provenance is True: the source of every value
+    """
+    ordered=dataframe.sort_index(level=1, ascending=False, sort_remaining=False)
+    years=ordered.index.get_level_values(1).to_numpy(dtype=np.float64)
+    
+    df_filled=ordered.groupby(level=0, sort=False).first()
+    
+    observed_years=pd.DataFrame(np.where(ordered.notnull(), years[:, np.newaxis], np.nan),
+                                index=ordered.index, columns=ordered.columns)
+    latest_years=observed_years.groupby(level=0, sort=False).first().reindex(df_filled.index)
+    
+    if provenance:
+        unique_years=np.unique(years)[::-1]
+        latest=latest_years.to_numpy()
+        codes=np.where(np.isnan(latest), -1,
+                       np.searchsorted(-unique_years, -np.nan_to_num(latest))).astype(np.int16)
+        labels=['WB data %d' % year for year in unique_years]
+        return df_filled, MakeProvenance(codes, labels, df_filled.index, df_filled.columns)
+    
+    labels=latest_years.apply(lambda column: ('WB data '+column.dropna().astype(int).astype(str))
+                              .reindex(column.index))
+    labels.columns=[column+' source' for column in labels.columns]
+    
+    return pd.concat([df_filled, labels], axis=1)
+
+
+class LocalWBSource(object):
+    """
+    -------
+
+    Local stand-in for the World Bank API, with the same get_dataframe method
+    as wbdata. The data is served from a dataframe instead of the internet,
+    and every request is recorded in calls, so it can be checked how often
+    the "endpoint" was hit.
+
+    -------
+    Inputs:
+        - data     : dataframe with a (country, date) MultiIndex, where date
+                     is the year as a string (like the World Bank API), and
+                     one column per indicator code
+        - delay    : seconds every request takes, to simulate the network
+                     (default: 0)
+        - failures : the number of requests that fail with a
+                     ConnectionError before it starts answering (default: 0)
+    -------
+
+    """
+
+    host = 'localhost'
+
+    def __init__(self, data, delay=0.0, failures=0):
+        self.data = data
+        self.delay = delay
+        self.failures = failures
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get_dataframe(self, indicators, country='all', date=None, parse_dates=False, keep_levels=False):
+        with self.lock:
+            self.calls.append((tuple(indicators), date))
+            failing = len(self.calls) <= self.failures
+        if self.delay:
+            time.sleep(self.delay)
+        if failing:
+            raise ConnectionError('LocalWBSource: simulated failure')
+
+        dataframe = self.data.reindex(columns=list(indicators))
+        dataframe.columns = [indicators[code] for code in indicators]
+
+        if country != 'all':
+            countries = [country] if isinstance(country, str) else list(country)
+            dataframe = dataframe[dataframe.index.get_level_values('country').isin(countries)]
+
+        if date is not None:
+            if isinstance(date, (tuple, list)):
+                first, last = date
+            else:
+                first = last = date
+            years = dataframe.index.get_level_values('date').astype(int)
+            dataframe = dataframe[(years >= _year(first)) & (years <= _year(last))]
+
+        if parse_dates:
+            dataframe.index = dataframe.index.set_levels(
+                pd.to_datetime(dataframe.index.levels[1], format='%Y'), level='date')
+
+        # like wbdata: drop the level that has only one value
+        if not keep_levels and len(set(dataframe.index.get_level_values(0))) == 1:
+            dataframe.index = dataframe.index.droplevel(0)
+        elif not keep_levels and len(set(dataframe.index.get_level_values(1))) == 1:
+            dataframe.index = dataframe.index.droplevel(1)
+        return dataframe
+
+
+class LocalHTTPStandIn(object):
+    """
+    -------
+
+    Local HTTP server that answers like the World Bank API (v2, JSON) and
+    the Nominatim geocoder, for testing the asynchronous sources offline.
+    It runs in a background thread on a free port of 127.0.0.1; use it with
+    "with" and pass wb_url and geocode_url as base_url. Every request path is
+    recorded in requests.
+
+    -------
+    Inputs:
+        - wb_data  : dataframe like for LocalWBSource (default: no data)
+        - places   : dictionary from place name to (latitude, longitude)
+                     (default: no places)
+        - failures : the number of requests that are answered with a 503
+                     server error before it starts answering (default: 0)
+    -------
+
+    """
+
+    def __init__(self, wb_data=None, places=None, failures=0):
+        self.wb_data = wb_data
+        self.places = places or {}
+        self.failures = failures
+        self.requests = []
+        self.server = None
+
+    def __enter__(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.requests.append(self.path)
+                if len(stand_in.requests) <= stand_in.failures:
+                    status, answer = 503, {'error': 'simulated failure'}
+                else:
+                    status, answer = stand_in.answer(self.path)
+                content = json.dumps(answer).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    @property
+    def wb_url(self):
+        return self.url+'/v2'
+
+    @property
+    def geocode_url(self):
+        return self.url
+
+    def answer(self, path):
+        parts = urlsplit(path)
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        segments = parts.path.strip('/').split('/')
+
+        if parts.path == '/search':
+            place = self.places.get(query.get('q'))
+            if place is None:
+                return 200, []
+            return 200, [{'lat': str(place[0]), 'lon': str(place[1]), 'display_name': query['q']}]
+
+        if len(segments) == 5 and segments[0] == 'v2' and segments[3] == 'indicator':
+            code = segments[4]
+            if self.wb_data is None or code not in self.wb_data.columns:
+                return 200, [{'message': [{'id': '120', 'value': 'Invalid value'}]}]
+            series = self.wb_data[code]
+            if 'date' in query:
+                first, last = (int(year) for year in query['date'].split(':'))
+                years = series.index.get_level_values('date').astype(int)
+                series = series[(years >= first) & (years <= last)]
+            per_page = int(query.get('per_page', 50))
+            page = int(query.get('page', 1))
+            pages = max(1, -(-len(series)//per_page))
+            rows = [{'indicator': {'id': code, 'value': code},
+                     'country': {'id': '', 'value': country},
+                     'date': str(date),
+                     'value': None if pd.isnull(value) else float(value)}
+                    for (country, date), value in series.iloc[(page-1)*per_page:page*per_page].items()]
+            return 200, [{'page': page, 'pages': pages, 'per_page': per_page, 'total': len(series)}, rows]
+
+        return 404, {'error': 'unknown path'}
+
+
+def _year(date):
+    if isinstance(date, (datetime.date, datetime.datetime)):
+        return date.year
+    return int(str(date)[:4])
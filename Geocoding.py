@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Country coordinates: the centroids (LAT/LON) of the TM_WORLD_BORDERS
+shapefile that ships with the project, and a cached geocoder for the names
+that are not in there.
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from geopy.geocoders import Nominatim
+
+from CountryRegistry import GetCountryRegistry, ReadBordersTable
+
+
+BORDERS_FILE = 'TM_WORLD_BORDERS_SIMPL-0.3/TM_WORLD_BORDERS_SIMPL-0.3.dbf'
+GEOCODE_CACHE_FILE = 'geocode_cache.sqlite'
+
+_centroids = {}
+_geocode_caches = {}
+_geolocator = []
+
+
+def GetCentroids(file=BORDERS_FILE):
+    """
+    This function returns the centroids of all countries in the shapefile,
+    as a dataframe with the ISO3 code as index and a Name, Latitude and
+    Longitude column. The .dbf file is read only once.
+    """
+    if file not in _centroids:
+        borders = ReadBordersTable(file)
+        centroids = pd.DataFrame({'Name': borders['NAME'].values,
+                                  'Latitude': borders['LAT'].values,
+                                  'Longitude': borders['LON'].values},
+                                 index=pd.Index(borders['ISO3'].values, name='ISO3'))
+        _centroids[file] = centroids[~centroids.index.duplicated()]
+    return _centroids[file]
+
+
+def CountryCentroids(countries, registry=None, file=BORDERS_FILE):
+    """
+    This function looks up the centroids of a list of countries. The names
+    (or codes) are resolved to ISO3 codes with the CountryRegistry and then
+    joined with the centroid table in one go.
+
+    ------
+    Inputs
+    ------
+    countries:  the country names or codes
+    registry:   the CountryRegistry to use (default: GetCountryRegistry())
+    file:       the .dbf file of the shapefile
+
+    -------
+    Outputs
+    -------
+    coordinates:    dataframe with the countries as index and a Latitude and
+                    Longitude column (NaN for countries that are not found)
+    """
+    if registry is None:
+        registry = GetCountryRegistry()
+    codes = registry.resolve_many(countries)
+    centroids = GetCentroids(file)
+    coordinates = centroids.reindex(codes.values)[['Latitude', 'Longitude']]
+    coordinates.index = codes.index
+    return coordinates.astype(np.float64)
+
+
+class GeocodeCache(object):
+    """
+    -------
+
+    Persistent store of geocoding results: an sqlite table on disk with a
+    small least-recently-used dictionary in memory in front of it. Places
+    that could not be found are stored as well (as None), so they are not
+    looked up again on every run.
+
+    -------
+    Inputs:
+        - file        : the sqlite file (default: GEOCODE_CACHE_FILE)
+        - memory_size : the number of results kept in memory (default: 1024)
+    -------
+
+    """
+
+    def __init__(self, file=GEOCODE_CACHE_FILE, memory_size=1024):
+        self.file = file
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS places '
+                                    '(name TEXT PRIMARY KEY, latitude REAL, longitude REAL, found INTEGER)')
+
+    def get_many(self, names):
+        """
+        Returns a dictionary with the cached result of every name that is in
+        the cache: a (latitude, longitude) tuple, or None for places that
+        were not found. Names that were never looked up are left out.
+        """
+        results = {}
+        missing = []
+        with self.lock:
+            for name in names:
+                if name in self.memory:
+                    self.memory.move_to_end(name)
+                    results[name] = self.memory[name]
+                else:
+                    missing.append(name)
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start+500]
+                rows = self.connection.execute(
+                    'SELECT name, latitude, longitude, found FROM places WHERE name IN (%s)'
+                    % ','.join('?'*len(chunk)), chunk).fetchall()
+                for name, latitude, longitude, found in rows:
+                    results[name] = (latitude, longitude) if found else None
+                    self._remember(name, results[name])
+        return results
+
+    def put_many(self, results):
+        """
+        Stores a dictionary from name to a (latitude, longitude) tuple, or
+        None for places that were not found.
+        """
+        rows = [(name, None, None, 0) if coords is None else (name, coords[0], coords[1], 1)
+                for name, coords in results.items()]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?)', rows)
+            for name, coords in results.items():
+                self._remember(name, coords)
+
+    def _remember(self, name, coords):
+        self.memory[name] = coords
+        self.memory.move_to_end(name)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM places').fetchone()[0]
+
+
+def GetGeocodeCache(file=GEOCODE_CACHE_FILE):
+    """
+    This function returns the shared GeocodeCache for a file, so every
+    caller in the process uses the same in-memory part.
+    """
+    if file not in _geocode_caches:
+        _geocode_caches[file] = GeocodeCache(file)
+    return _geocode_caches[file]
+
+
+def geocode_many(names, geocoder=None, cache=None, use_centroids=True, registry=None):
+    """
+    This function looks up the coordinates of many places at once. Every
+    distinct name is looked up only once, in this order: the centroids of
+    the shapefile, the geocode cache and finally the geocoder. Results of
+    the geocoder, also places that were not found, are stored in the cache,
+    so running it again costs no geocoding requests. Requests that fail
+    (e.g. no network) are not stored and are tried again next time.
+
+    ------
+    Inputs
+    ------
+    names:          the place names
+    geocoder:       any object with a geopy-like geocode(name) method
+                    (default: Nominatim)
+    cache:          the GeocodeCache (default: GetGeocodeCache())
+    use_centroids:  look in the shapefile first (default: True)
+    registry:       the CountryRegistry for the shapefile lookup
+
+    -------
+    Outputs
+    -------
+    coordinates:    dictionary from name to a (latitude, longitude) tuple,
+                    or None for places that were not found
+    """
+    unique = list(dict.fromkeys(names))
+    results = {}
+
+    if use_centroids and unique:
+        centroids = CountryCentroids(unique, registry=registry).dropna()
+        for name, latitude, longitude in zip(centroids.index, centroids['Latitude'], centroids['Longitude']):
+            results[name] = (float(latitude), float(longitude))
+
+    remaining = [name for name in unique if name not in results]
+    if not remaining:
+        return results
+
+    if cache is None:
+        cache = GetGeocodeCache()
+    results.update(cache.get_many(remaining))
+
+    remaining = [name for name in remaining if name not in results]
+    if remaining:
+        if geocoder is None:
+            geocoder = _default_geocoder()
+        found = {}
+        for name in remaining:
+            try:
+                location = geocoder.geocode(name)
+            except Exception as error:
+                print('Geocoding failed for '+str(name)+': '+str(error))
+                results[name] = None
+                continue
+            found[name] = None if location is None else (location.latitude, location.longitude)
+        cache.put_many(found)
+        results.update(found)
+    return results
+
+
+def _default_geocoder():
+    if not _geolocator:
+        _geolocator.append(Nominatim(user_agent='TrueEmissions'))
+    return _geolocator[0]
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Indexed IEA time series: the TimeSeries sheet of the IEA workbook as one
+(Product, Flow, Country) x year array, so any set of indicators for any set
+of countries and years is taken with a single vectorized selection.
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import numpy as np
+import pandas as pd
+
+
+KEY_COLUMNS = ['Product', 'Flow', 'Country']
+
+
+def _CountryIndex(countries):
+    # the countries, or the index of a dataframe/series of countries
+    if isinstance(countries, (pd.DataFrame, pd.Series)):
+        return pd.Index(countries.index)
+    return pd.Index(countries)
+
+
+def YearColumns(data):
+    """
+    This function returns the year columns of the IEA sheet as a dictionary
+    from the year (int) to the column label (which can be an int or a
+    string, depending on how the sheet was read).
+    """
+    years = {}
+    for column in data.columns:
+        label = str(column).strip()
+        if label.isdigit():
+            years.setdefault(int(label), column)
+    return years
+
+
+class IEAIndex(object):
+    """
+    -------
+
+    The IEA time series as a float64 array with one row per (Product, Flow,
+    Country) and one column per year. IEA placeholders such as '..' (not
+    available) and 'x' (confidential) are NaN. When a key occurs more than
+    once, the last row wins.
+
+    -------
+    Inputs:
+        - values : the (keys x years) array
+        - keys   : MultiIndex with the Product, Flow and Country levels
+        - years  : the years of the columns
+    -------
+
+    """
+
+    def __init__(self, values, keys, years):
+        self.values = values
+        self.keys = keys
+        self.years = [int(year) for year in years]
+        self.year_index = {year: position for position, year in enumerate(self.years)}
+
+    @classmethod
+    def from_frame(cls, data):
+        """
+        Builds the index from the dataframe of the TimeSeries sheet (e.g.
+        from GetDataFromExcelEIA).
+        """
+        year_columns = YearColumns(data)
+        years = sorted(year_columns)
+        values = data[[year_columns[year] for year in years]].apply(pd.to_numeric, errors='coerce')
+        keys = pd.MultiIndex.from_frame(data[KEY_COLUMNS].astype(object))
+        duplicated = keys.duplicated(keep='last')
+        return cls(values.to_numpy(dtype=np.float64)[~duplicated], keys[~duplicated], years)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def positions(self, data_needed, countries):
+        """
+        Returns the row of every (indicator, country) pair as a (countries x
+        indicators) array, -1 where the IEA has no data.
+        """
+        countries = _CountryIndex(countries)
+        products = np.repeat(data_needed[0].to_numpy(dtype=object), len(countries))
+        flows = np.repeat(data_needed[1].to_numpy(dtype=object), len(countries))
+        names = np.tile(countries.to_numpy(dtype=object), len(data_needed))
+        wanted = pd.MultiIndex.from_arrays([products, flows, names], names=KEY_COLUMNS)
+        return self.keys.get_indexer(wanted).reshape(len(data_needed), len(countries)).T
+
+    def extract(self, data_needed, countries, year=2014, first_year=None, return_years=False):
+        """
+        Takes the indicators of data_needed (Product, Flow and column name
+        in the columns 0, 1 and 2) for the countries. Without first_year,
+        the values of year are taken. With first_year, missing values are
+        filled with the latest valid value from year back to first_year
+        (inclusive).
+
+        -------
+        Outputs
+        -------
+        dataframe:  dataframe with the countries as index and one column per
+                    indicator (NaN where no valid value is found)
+        years:      only when return_years is True: dataframe with the year
+                    every value comes from
+        """
+        index = _CountryIndex(countries)
+        columns = list(data_needed[2])
+        if first_year is None:
+            first_year = year
+        selected = [self.year_index[y] for y in range(year, first_year-1, -1) if y in self.year_index]
+        if not selected:
+            raise KeyError('No IEA data for the years %d-%d; the sheet has %s'
+                           % (first_year, year, '%d-%d' % (min(self.years), max(self.years))
+                              if self.years else 'no years'))
+
+        positions = self.positions(data_needed, index)
+        found = positions >= 0
+        block = np.full(positions.shape+(len(selected),), np.nan)
+        block[found] = self.values[positions[found]][:, selected]
+
+        valid = ~np.isnan(block)
+        latest = valid.argmax(axis=2)
+        has_value = valid.any(axis=2)
+        values = np.where(has_value, np.take_along_axis(block, latest[..., np.newaxis], axis=2)[..., 0], np.nan)
+
+        dataframe = pd.DataFrame(values, index=index, columns=columns)
+        if not return_years:
+            return dataframe
+        found_years = np.where(has_value, np.asarray([self.years[s] for s in selected],
+                                                     dtype=np.float64)[latest], np.nan)
+        return dataframe, pd.DataFrame(found_years, index=index, columns=columns)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Imputation of missing World Bank data by the mean of groups of countries
+(same region and income level, same region, ...), with a record of where
+every value comes from.
+
+The record (the provenance) is a dataframe with the same index and columns
+as the values, in which every column is a categorical with the same
+categories, e.g. 'WB data 2015' or 'Estimation based on region'. Every cell
+takes one byte instead of a repeated string. The functions that still
+return "<column> source" columns do so with WithSourceColumns; 
+SplitSourceColumns turns them back into a provenance dataframe.
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# The label of every grouping level
+LEVEL_LABELS = {('Region', 'IncomeGroup'): 'Estimation based on region and income',
+                ('Region',): 'Estimation based on region',
+                ('IncomeGroup',): 'Estimation based on income',
+                (): 'Estimation based on mean of all countries'}
+
+DEFAULT_LEVELS = [['Region', 'IncomeGroup'], ['Region'], ['IncomeGroup'], []]
+
+# Relative uncertainty (standard deviation of a multiplicative error) of a
+# value by its source; labels are matched on their start, so 'WB data'
+# covers every year
+UNCERTAINTY_WIDTHS = {'WB data': 0.05,
+                      'Estimation based on region and income': 0.25,
+                      'Estimation based on region': 0.35,
+                      'Estimation based on income': 0.35,
+                      'Estimation based on mean of all countries': 0.5}
+
+# Columns that are never imputed
+NON_VALUE_COLUMNS = ['Country Data', 'Region', 'IncomeGroup']
+
+
+def ValueColumns(dataframe):
+    """
+    This function returns the columns of a WB dataframe that hold values:
+    the numeric columns, except the region/income columns and the
+    "<column> source" columns.
+    """
+    return [column for column in dataframe.columns
+            if column not in NON_VALUE_COLUMNS
+            and not str(column).endswith(' source')
+            and pd.api.types.is_numeric_dtype(dataframe[column])]
+
+
+def MakeProvenance(codes, categories, index, columns):
+    """
+    This function builds a provenance dataframe from a matrix of codes
+    (-1 for unknown) and the list of labels the codes refer to.
+    """
+    dtype = pd.CategoricalDtype(list(categories))
+    return pd.DataFrame({column: pd.Categorical.from_codes(codes[:, position], dtype=dtype)
+                         for position, column in enumerate(columns)},
+                        index=index, columns=columns)
+
+
+def ProvenanceFromSourceColumns(dataframe, columns=None):
+    """
+    This function turns the "<column> source" columns of a dataframe into a
+    provenance dataframe. Columns without a source column get unknown (NaN)
+    provenance.
+    """
+    if columns is None:
+        columns = ValueColumns(dataframe)
+    labels = pd.DataFrame({column: dataframe[column+' source'] if column+' source' in dataframe.columns
+                           else pd.Series(np.nan, index=dataframe.index, dtype=object)
+                           for column in columns}, index=dataframe.index, columns=columns)
+    categories = pd.unique(labels.stack().dropna().astype(str).to_numpy())
+    dtype = pd.CategoricalDtype(sorted(categories))
+    return labels.astype(str).where(labels.notnull()).astype(dtype)
+
+
+def SplitSourceColumns(dataframe):
+    """
+    This function splits a dataframe with "<column> source" columns into the
+    dataframe without them and the provenance of its value columns.
+    """
+    provenance = ProvenanceFromSourceColumns(dataframe)
+    source_cols = [column for column in dataframe.columns if str(column).endswith(' source')]
+    return dataframe.drop(source_cols, axis=1), provenance
+
+
+def ProvenanceSummary(provenance):
+    """
+    This function returns the percentage of the values of every column that
+    comes from every source, as a dataframe with the columns as index and
+    the labels as columns. Values without a source are left out.
+    """
+    counts = {column: provenance[column].value_counts(sort=False) for column in provenance.columns}
+    summary = pd.DataFrame(counts).T.fillna(0)
+    return summary*100/len(provenance) if len(provenance) else summary
+
+
+def ProvenanceWidths(provenance, widths=None, default=0.1):
+    """
+    This function translates a provenance dataframe into the relative
+    uncertainty of every value: a float dataframe of the same shape. Every
+    label gets the width of the longest entry of widths it starts with;
+    unknown labels and missing provenance get default.
+    """
+    if widths is None:
+        widths = UNCERTAINTY_WIDTHS
+    prefixes = sorted(widths, key=len, reverse=True)
+    result = {}
+    for column in provenance.columns:
+        categories = provenance[column].cat.categories
+        lookup = np.array([next((widths[prefix] for prefix in prefixes if str(label).startswith(prefix)), default)
+                           for label in categories]+[default], dtype=np.float64)
+        result[column] = lookup[provenance[column].cat.codes.to_numpy()]
+    return pd.DataFrame(result, index=provenance.index, columns=provenance.columns)
+
+
+def WithSourceColumns(dataframe, provenance):
+    """
+    This function writes a provenance dataframe back as "<column> source"
+    columns, for code that expects the old layout. Existing source columns
+    of the provenance columns are replaced.
+    """
+    dataframe = dataframe.drop([column+' source' for column in provenance.columns
+                                if column+' source' in dataframe.columns], axis=1)
+    sources = provenance.astype(object).where(provenance.notnull(), None)
+    sources.columns = [column+' source' for column in provenance.columns]
+    return pd.concat([dataframe, sources], axis=1)
+
+
+def ImputeByGroups(dataframe, levels=None, columns=None, provenance=None, labels=None):
+    """
+    This function fills the missing values of a WB dataframe by the mean of
+    groups of countries, one grouping level after the other: first with the
+    mean of the countries in the same group of the first level, what is
+    still missing with the second level, and so on. An empty level means
+    all countries. Every level is one groupby-transform over all columns.
+
+    ------
+    Inputs
+    ------
+    dataframe:  dataframe with the countries as index, the value columns and
+                the columns of the grouping levels (e.g. Region and
+                IncomeGroup)
+    levels:     the ordered list of grouping levels, every level a list of
+                columns (default: DEFAULT_LEVELS)
+    columns:    the columns to fill (default: ValueColumns(dataframe))
+    provenance: the provenance of the values before filling (default: read
+                from the "<column> source" columns, if any)
+    labels:     dictionary from level (tuple of columns) to provenance label
+                (default: LEVEL_LABELS)
+
+    -------
+    Outputs
+    -------
+    filled:     copy of the dataframe with the missing values filled (the
+                "<column> source" columns are left as they are)
+    provenance: the provenance of the filled values
+    """
+    if levels is None:
+        levels = DEFAULT_LEVELS
+    if columns is None:
+        columns = ValueColumns(dataframe)
+    if labels is None:
+        labels = LEVEL_LABELS
+    if provenance is None:
+        provenance = ProvenanceFromSourceColumns(dataframe, columns)
+    # the provenance may come from before a join that reordered or dropped
+    # rows; rows it does not cover get unknown provenance
+    provenance = provenance.reindex(index=dataframe.index, columns=columns)
+    # columns the provenance does not cover get unknown provenance as well
+    for column in columns:
+        if not isinstance(provenance[column].dtype, pd.CategoricalDtype):
+            provenance[column] = pd.Categorical([None]*len(provenance), categories=[])
+
+    level_labels = [labels.get(tuple(level), 'Estimation based on '+' and '.join(level))
+                    for level in levels]
+    categories = list(dict.fromkeys(category for column in columns
+                                    for category in provenance[column].cat.categories))
+    categories += [label for label in dict.fromkeys(level_labels) if label not in categories]
+    codes = np.column_stack([provenance[column].cat.set_categories(categories).cat.codes.to_numpy(np.int16)
+                             for column in columns]) if len(columns) else \
+        np.empty((len(dataframe), 0), dtype=np.int16)
+
+    values = dataframe[columns].to_numpy(dtype=np.float64, copy=True)
+    for level, label in zip(levels, level_labels):
+        missing = np.isnan(values)
+        if not missing.any():
+            break
+        current = pd.DataFrame(values, index=dataframe.index, columns=columns)
+        if level:
+            means = current.groupby([dataframe[key] for key in level]).transform('mean').to_numpy()
+        else:
+            means = np.broadcast_to(current.mean().to_numpy(), values.shape)
+        fill = missing & ~np.isnan(means)
+        values[fill] = means[fill]
+        codes[fill] = categories.index(label)
+
+    filled = dataframe.copy()
+    filled[columns] = values
+    return filled, MakeProvenance(codes, categories, dataframe.index, columns)
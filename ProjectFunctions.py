@@ -7,13 +7,26 @@ Created on Sun Nov  5 12:50:11 2017
 """
 
 import pandas as pd
-from geopy.geocoders import Nominatim
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
 import plotly
 import datetime
+import hashlib
+import itertools
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 import wbdata
+from TradeCube import TradeCube, SparseTradeCube, MeltTradeData
+from DataSources import FetchRangeWB, LatestObservationsWB
+from Imputation import (ImputeByGroups, WithSourceColumns, SplitSourceColumns, ProvenanceSummary,
+                        ProvenanceFromSourceColumns, ProvenanceWidths, DEFAULT_LEVELS)
+from Geocoding import CountryCentroids, geocode_many
+from CountryRegistry import GetCountryRegistry
 
 plotly.offline.init_notebook_mode(connected=True)
-geolocator = Nominatim()
 
 def build_multi_index_df(years, countries):
     
@@ -52,22 +65,32 @@ def FillWithTradeData(data, multi_index_dataframe, years):
     -------
     
     This function fills the multi-index dataframe with the data
-    contained in the dataset. 
-    
+    contained in the dataset. All "<year> in 1000 USD " columns are
+    melted into one long table and pivoted into the year*exporter*importer
+    layout in a single pass, instead of writing the values cell by cell.
+
+    The WITS rows are reported by the importing country, so the partner
+    ends up in the row (exporter) and the reporter in the column. Partners
+    or reporters that are not in the multi-index dataframe are dropped;
+    for duplicate rows the last one wins.
+
     -------
     Inputs:
         - data (the dataframe containing trade data)
         - dataframe (the empty multi-index dataframe)
+        - years (the years to take from the trade data)
     -------
     Outputs:
-        - dataframe: a multi-index dataframe filled with the data
+        - dataframe: a new multi-index dataframe (float) filled with the data,
+                     with the same index and columns as the input dataframe
     -------
     """
-    for index, row in data.iterrows():
-        for year in years:
-           year_key=str(year)+" in 1000 USD "
-           multi_index_dataframe.loc[year][row['ReporterName']][row['PartnerName']]=row[year_key]
-    return multi_index_dataframe
+    long_data=MeltTradeData(data, years)
+
+    filled_dataframe=long_data.set_index(['year', 'exporter', 'importer'])['value'].unstack('importer')
+    filled_dataframe=filled_dataframe.reindex(index=multi_index_dataframe.index,
+                                              columns=multi_index_dataframe.columns)
+    return filled_dataframe
 
 def GetIndicatorsWB(file="Selected_Indicators.xlsx", sheet="Blad1" ):
     """
@@ -123,10 +146,15 @@ def GetRegionIncomeDataWB(file = 'Regions.xlsx', sheetname=0, header=0,
                           index_col=index_col, names=names)
     return countries
 
-def GetDataWB(indicators, year1=2000, year2=2016):
+def GetDataWB(indicators, year1=2000, year2=2016, source=None, batched=True, batch_size=None, workers=1,
+              provenance=False):
     """
     This function first retrieves World Bank data from the latest year, and then
     fills any missing data in the dataframe with data from previous years (in the specified range).
+
+    By default all years are retrieved at once (one request per batch of 
+    indicators) and the latest available year is taken locally. With 
+    batched=False every year is retrieved with a separate request.
     
     ------
     Inputs
@@ -135,37 +163,61 @@ def GetDataWB(indicators, year1=2000, year2=2016):
                     function GetIndicatorsWB()
     year1:          The lower bound for time-period (default=2000)
     year2:          The upper bound for the time-period (default=2016)
+    source:         Where the data is retrieved from: wbdata (default), a 
+                    DataCache.WBCache to cache the pulls on disk, or a 
+                    DataSources.LocalWBSource to work offline
+    batched:        Retrieve all years at once (default=True)
+    batch_size:     The number of indicators per request when batched
+                    (default: all indicators in one request, or one per 
+                    request when workers > 1)
+    workers:        The number of requests that run concurrently when 
+                    batched (default=1)
+    provenance:     Return the sources as a separate categorical provenance
+                    dataframe instead of "<column> source" columns 
+                    (default=False)
     
     -------
     Outputs
     -------
     dataframe:      The resulting dataframe
+    provenance:     Only when provenance is True: the source of every value
     """
     
+    if source is None:
+        source=wbdata
+    
+    if batched:
+        # the years year1+1 up to and including year2, like the loop below;
+        # the loop always takes year2, also when year1 >= year2
+        return LatestObservationsWB(FetchRangeWB(indicators, min(year1+1, year2), year2, source, batch_size,
+                                                 workers=workers), provenance=provenance)
+    
     data_date=(datetime.datetime(year2,1,1), datetime.datetime(year2,1,1))
     
-    df_filled = wbdata.get_dataframe(indicators, data_date=data_date)
+    df_filled = source.get_dataframe(indicators, date=data_date)
     
     for column in df_filled:
         column_source= column + ' source'
         df_filled[column_source] = None
-        df_filled[column_source][df_filled[column].notnull()] = 'WB data ' + str(year2)                 
+        df_filled.loc[df_filled[column].notnull(), column_source] = 'WB data ' + str(year2)                 
                          
     year2range=year2-1
                          
     for year in range(year2range, year1, -1):
         data_date = (datetime.datetime(year,1,1), datetime.datetime(year,1,1))
-        df_year = wbdata.get_dataframe(indicators, data_date=data_date)
+        df_year = source.get_dataframe(indicators, date=data_date)
         
         for column in df_year:
             column_source = column + ' source'
             df_year[column_source] = None
-            df_year[column_source][df_year[column].notnull()] = 'WB data ' + str(year)
+            df_year.loc[df_year[column].notnull(), column_source] = 'WB data ' + str(year)
         df_filled = df_filled.combine_first(df_year)
-            
+    
+    if provenance:
+        return SplitSourceColumns(df_filled)
     return df_filled
 
-def FillByRegionAndIncomeWB(dataframe):
+def FillByRegionAndIncomeWB(dataframe, provenance=None):
     """
     This function fills missing values in the dataframe by taking the mean of 
     countries in the same region with the same income level. 
@@ -176,38 +228,26 @@ def FillByRegionAndIncomeWB(dataframe):
     dataframe:      a dataframe with the countries as index and a region and
                     income column. 
                     
+    provenance:     the provenance dataframe of the values (optional); when
+                    given, it is updated instead of the "<column> source"
+                    columns
+                    
     -------
     Outputs
     -------
     df_complete:    the resulting dataframe
+    provenance:     only when provenance is given: the updated provenance
     """
     
-    source_cols=[col for col in dataframe.columns if 'source' in col]
-    data=dataframe.drop(source_cols, axis=1)
+    if provenance is not None:
+        return ImputeByGroups(dataframe, levels=[['Region', 'IncomeGroup']], provenance=provenance)
     
-    filled_data=pd.DataFrame()
+    filled, provenance = ImputeByGroups(dataframe, levels=[['Region', 'IncomeGroup']])
+    df_complete = WithSourceColumns(filled, provenance)
     
-    # actions on data frame
-    for region in set(data['Region']):
-        for incomelevel in set(data['IncomeGroup']):
-            regional_data=data.loc[(data["Region"]==region) & (data["IncomeGroup"]==incomelevel)]
-            regional_data=regional_data.fillna(regional_data.mean())
-            filled_data=filled_data.append(regional_data)
-            
-    dont_include = ['Country Data', 'Region', 'IncomeGroup']
-            
-    for column in filled_data.columns[~filled_data.columns.isin(dont_include)]:
-            column_source = column + ' source'
-            filled_data[column_source] = None
-            filled_data[column_source][filled_data[column].notnull()] = 'Estimation based on region and income' 
-        
-        
-    df_complete = dataframe.combine_first(filled_data)
-            
     return df_complete
 
-
-def FillByIncomeWB(dataframe):
+def FillByIncomeWB(dataframe, provenance=None):
     """
     This function fills missing values in the dataframe by taking the mean of 
     countries with the same income level. 
@@ -218,35 +258,26 @@ def FillByIncomeWB(dataframe):
     dataframe:      a dataframe with the countries as index and an
                     income column. 
                     
+    provenance:     the provenance dataframe of the values (optional); when
+                    given, it is updated instead of the "<column> source"
+                    columns
+                    
     -------
     Outputs
     -------
     df_complete:    the resulting dataframe
+    provenance:     only when provenance is given: the updated provenance
     """
     
-    source_cols=[col for col in dataframe.columns if 'source' in col]
-    
-    data=dataframe.drop(source_cols, axis=1)
-    
-    filled_data=pd.DataFrame()
+    if provenance is not None:
+        return ImputeByGroups(dataframe, levels=[['IncomeGroup']], provenance=provenance)
     
-    for incomelevel in set(data['IncomeGroup']):
-        income_data=data.loc[(data["IncomeGroup"]==incomelevel)]
-        income_data=income_data.fillna(income_data.mean())
-        filled_data=filled_data.append(income_data)
+    filled, provenance = ImputeByGroups(dataframe, levels=[['IncomeGroup']])
+    df_complete = WithSourceColumns(filled, provenance)
     
-    dont_include = ['Country Data', 'Region', 'IncomeGroup']
-            
-    for column in filled_data.columns[~filled_data.columns.isin(dont_include)]:
-            column_source = column + ' source'
-            filled_data[column_source] = None
-            filled_data[column_source][filled_data[column].notnull()] = 'Estimation based on income' 
-    
-    df_complete = dataframe.combine_first(filled_data)
-        
     return df_complete
 
-def FillByRegionWB(dataframe):
+def FillByRegionWB(dataframe, provenance=None):
     """
     This function fills missing values in the dataframe by taking the mean of 
     countries in the same region. 
@@ -257,34 +288,26 @@ def FillByRegionWB(dataframe):
     dataframe:      a dataframe with the countries as index and a region and
                     income column. 
                     
+    provenance:     the provenance dataframe of the values (optional); when
+                    given, it is updated instead of the "<column> source"
+                    columns
+                    
     -------
     Outputs
     -------
     df_complete:    the resulting dataframe
+    provenance:     only when provenance is given: the updated provenance
     """
     
-    source_cols=[col for col in dataframe.columns if 'source' in col]
-    data=dataframe.drop(source_cols, axis=1)
-    
-    filled_data=pd.DataFrame()
-    
-    for region in set(data['Region']):
-        regional_data=data.loc[(data["Region"]==region)]
-        regional_data=regional_data.fillna(regional_data.mean())
-        filled_data=filled_data.append(regional_data)
+    if provenance is not None:
+        return ImputeByGroups(dataframe, levels=[['Region']], provenance=provenance)
     
-    dont_include = ['Country Data', 'Region', 'IncomeGroup']
-    
-    for column in filled_data.columns[~filled_data.columns.isin(dont_include)]:
-            column_source = column + ' source'
-            filled_data[column_source] = None
-            filled_data[column_source][filled_data[column].notnull()] = 'Estimation based on region'
-    
-    df_complete = dataframe.combine_first(filled_data)
+    filled, provenance = ImputeByGroups(dataframe, levels=[['Region']])
+    df_complete = WithSourceColumns(filled, provenance)
     
     return df_complete
 
-def FillWithMeanWB(dataframe):
+def FillWithMeanWB(dataframe, provenance=None):
     """
     
     This function fills any missing data with the mean of all the other countries. 
@@ -293,35 +316,26 @@ def FillWithMeanWB(dataframe):
     ------
     dataframe: The dataframe with missing data. 
     
+    provenance: The provenance dataframe of the values (optional); when
+                given, it is updated instead of the "<column> source" columns
+    
     -------
     Outputs
     -------
     df_complete:    The resulting dataframe
+    provenance:     Only when provenance is given: the updated provenance
     
     """
-
-    
-    source_cols=[col for col in dataframe.columns if 'source' in col]
-    
-    data=dataframe.drop(source_cols, axis=1)
     
-    filled_data=pd.DataFrame()
+    if provenance is not None:
+        return ImputeByGroups(dataframe, levels=[[]], provenance=provenance)
     
-    filled_data=data.fillna(data.mean())
-    
-    dont_include = ['Country Data', 'Region', 'IncomeGroup']
-    
-    for column in filled_data.columns[~filled_data.columns.isin(dont_include)]:
-            column_source = column + ' source'
-            filled_data[column_source] = None
-            filled_data[column_source][filled_data[column].notnull()] = 'Estimation based on region'
-    
-    
-    df_complete=dataframe.combine_first(filled_data)
+    filled, provenance = ImputeByGroups(dataframe, levels=[[]])
+    df_complete = WithSourceColumns(filled, provenance)
     
     return df_complete
 
-def DataCompleteness(dataframe):
+def DataCompleteness(dataframe, provenance=None):
     """
     Function to check how complete the dataset is. 
     
@@ -329,14 +343,21 @@ def DataCompleteness(dataframe):
     Inputs
     ------
     dataframe:      The dataframe to check
+    provenance:     The provenance dataframe of the values (optional)
     -------
     Outputs
     -------
     Prints the percentage of data available in the dataframe for each indicator
+    and, when the sources are known (provenance or "<column> source" columns),
+    the percentage of every indicator that comes from every source
     
     """
+    if provenance is None and any(str(col).endswith(' source') for col in dataframe.columns):
+        dataframe, provenance = SplitSourceColumns(dataframe)
     percentage = 100-(dataframe.isnull().sum()/len(dataframe))*100         # percentage of available data
     print(percentage)
+    if provenance is not None:
+        print(ProvenanceSummary(provenance).round(1))
 
 def CheckDictionaries(dic1, dic2):
     """
@@ -361,54 +382,131 @@ def CheckDictionaries(dic1, dic2):
         else:
             print(item, dic2[item])
 
-def MergeDataFrames(dataframe_WB, dataframe_trade, country_dic_wb, country_dic_trade, conversion_dic):         
+def ResolveCountryKeys(names, country_dic, conversion_dic=None, registry=None):
+    """
+    
+    This function translates a list of country names into ISO3 codes with
+    country_dic, after which outdated codes are replaced using 
+    conversion_dic (e.g. {'SER':'SRB', 'SUD':'SDN', 'ROM':'ROU'}). 
+    Entries of conversion_dic that are keyed by country name are used as well.
+    With a CountryRegistry, the resulting codes are normalized by it (so
+    outdated codes are replaced) and names that are still unresolved are
+    looked up in it; anything left gets NaN.
+    
+    ------
+    Inputs
+    ------
+    names:          the country names
+    country_dic:    dictionary from country name to ISO3 code (can be None)
+    conversion_dic: dictionary from outdated codes (or names) to ISO3 codes
+    registry:       a CountryRegistry (see CountryRegistry.GetCountryRegistry)
+    
+    -------
+    Outputs
+    -------
+    codes:          Series with the ISO3 code of every name (index: names)
+    """
+    names=pd.Index(names)
+    codes=pd.Series(names.map(country_dic or {}), index=names, dtype=object)
+    if conversion_dic:
+        converted=codes.map(conversion_dic)
+        converted=converted.fillna(pd.Series(names.map(conversion_dic), index=names, dtype=object))
+        codes=converted.fillna(codes)
+    if registry is not None:
+        # the codes of the dictionaries may be outdated (e.g. TMP for East
+        # Timor), so they are normalized by the registry as well
+        known=codes.notnull()
+        normalized=registry.resolve_many(codes[known].values)
+        codes[known]=normalized.fillna(pd.Series(codes[known].values, index=normalized.index)).values
+        codes=codes.fillna(registry.resolve_many(names))
+    return codes
+
+def MergeDataFrames(dataframe_WB, dataframe_trade, country_dic_wb, country_dic_trade, conversion_dic,
+                    return_unmatched=False, registry=None):         
     
     """
     
     This function merges the World Bank dataframe and the Trade dataframe.
+
+    Countries are matched on their name first, and otherwise on their ISO3
+    code (see ResolveCountryKeys). The World Bank columns are then added to
+    the trade dataframe with a single indexed join; countries without a
+    match get NaN. 
     
-    """
+    ------
+    Inputs
+    ------
+    dataframe_WB:       the World Bank dataframe (countries as index)
+    dataframe_trade:    the trade dataframe (countries as index)
+    country_dic_wb:     dictionary from WB country name to ISO3 code
+    country_dic_trade:  dictionary from trade country name to ISO3 code
+    conversion_dic:     dictionary from outdated trade codes to ISO3 codes
+    return_unmatched:   also return the trade countries without WB data
+                        (default: False)
+    registry:           a CountryRegistry to resolve the names that are
+                        not in the dictionaries (default: None)
     
+    -------
+    Outputs
+    -------
+    filled_dataframe:   the merged dataframe
+    unmatched:          list of the trade countries without WB data
+                        (only if return_unmatched is True)
+    """
+    wb_codes=ResolveCountryKeys(dataframe_WB.index, country_dic_wb, registry=registry)
+    wb_codes=wb_codes[wb_codes.notnull() & ~wb_codes.duplicated(keep='last')]
+    wb_country_by_code=pd.Series(wb_codes.index, index=wb_codes.values)
+
+    trade_countries=pd.Series(dataframe_trade.index, index=dataframe_trade.index)
+    trade_codes=ResolveCountryKeys(dataframe_trade.index, country_dic_trade, conversion_dic, registry)
+    wb_country=trade_countries.where(trade_countries.isin(dataframe_WB.index))
+    wb_country=wb_country.fillna(trade_codes.map(wb_country_by_code))
+
+    wb_values=dataframe_WB.reindex(wb_country.values)
+    wb_values.index=dataframe_trade.index
     
-    filled_dataframe=dataframe_trade.copy(deep=False)
-    for column in dataframe_WB:
-        column_name=column
-        filled_dataframe[column_name]=None
-        for index in dataframe_trade.index:
-            for index2 in dataframe_WB.index:    
-                if index==index2 or country_dic_trade[index]==country_dic_wb[index2]:
-                    filled_dataframe[column_name][index]=dataframe_WB[column][index2]
-                else:
-                    try:
-                        if conversion_dic[index]==country_dic_wb[index2]:
-                            filled_dataframe[column_name][index]=dataframe_WB[column][index2]
-                    except KeyError: 
-                        continue
+    filled_dataframe=pd.concat([dataframe_trade.drop(dataframe_WB.columns, axis=1, errors='ignore'),
+                                wb_values], axis=1)
+    if return_unmatched:
+        return filled_dataframe, list(wb_country.index[wb_country.isnull()])
     return filled_dataframe
 
 def GetCountryCoordinates(country):
     '''
     Inputs country. Returns the lat/long coordinates the center of the country.
+    The centroids of the shapefile are used when the country is in there;
+    other places are geocoded once and then taken from the geocode cache
+    (see Geocoding.geocode_many).
     '''
-    loc = geolocator.geocode(country)
-    try:
-        return (loc.latitude, loc.longitude)
-    except:
+    coords=geocode_many([country])[country]
+    if coords is None:
         print('No location found for '+country)
         return (0,0)
+    return coords
     
-def AddCoordinatesColumn(dataframe):
+def AddCoordinatesColumn(dataframe, registry=None, geocode_missing=False):
     """
     
     This function adds a coordinates column to a dataframe with countries as index. 
+    The coordinates are the centroids from the TM_WORLD_BORDERS shapefile, 
+    joined on the ISO3 code of every country (see Geocoding.CountryCentroids),
+    so no network access is needed. Countries that are not in the shapefile
+    get (0,0), unless geocode_missing is True: then they are looked up with
+    the cached geocoder (see Geocoding.geocode_many).
    
     """
-    dataframe['Latitude']=None
-    dataframe['Longitude']=None
-    for country in dataframe.index:
-        coords=GetCountryCoordinates(country)
-        dataframe['Latitude'][country]=coords[0]
-        dataframe['Longitude'][country]=coords[1]
+    coords=CountryCentroids(dataframe.index, registry=registry)
+    missing=coords.index[coords['Latitude'].isnull()].unique()
+    if geocode_missing and len(missing):
+        found=geocode_many(list(missing), use_centroids=False)
+        found=pd.DataFrame({name: place for name, place in found.items() if place is not None},
+                           index=['Latitude', 'Longitude']).T
+        coords=coords.fillna(found.reindex(coords.index))
+        missing=coords.index[coords['Latitude'].isnull()].unique()
+    for country in missing:
+        print('No location found for '+str(country))
+    dataframe['Latitude']=coords['Latitude'].fillna(0).values
+    dataframe['Longitude']=coords['Longitude'].fillna(0).values
     return dataframe
 
 def RemoveEmissionColumns(dataframe):
@@ -424,54 +522,75 @@ def RemoveEmissionColumns(dataframe):
     dataframe.drop(columns_to_remove, axis=1, inplace=True)
     return dataframe
 
+def EmissionFlowEdges(dataframe, data, direction='from', threshold=0.1):
+    """
+    This function builds the edge list of the emission flows: one row per
+    pair of countries with more than threshold emissions transferred. The
+    emission matrix is stacked, filtered with one boolean mask and the start
+    and end coordinates are joined on the country names, so all edges of all
+    countries are built at once.
+    
+    ------
+    Inputs
+    ------
+    dataframe:  emission dataframe with the exporting countries as index and
+                "Emissions to <country>" columns (emission_data)
+    data:       dataframe with a Latitude and Longitude column and the
+                countries as index (complete dataframe)
+    direction:  'from' to draw the lines from the exporter to the importer,
+                'to' to draw them from the importer to the exporter
+    threshold:  the minimum transfer to draw (default: 0.1)
+    
+    -------
+    Outputs
+    -------
+    coords_df:  dataframe with start_lon, start_lat, end_lon, end_lat,
+                emissions, exporter and importer columns; coordinates of 
+                countries that are not in data are NaN
+    """
+    if direction not in ('from', 'to'):
+        raise ValueError("direction must be 'from' or 'to', not %r" % (direction,))
+    
+    values=dataframe.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    rows, columns=np.nonzero(values>threshold)
+    exporters=dataframe.index.to_numpy()[rows]
+    importers=dataframe.columns.str.replace('Emissions to ', '', regex=False).to_numpy()[columns]
+    
+    if direction=='from':
+        start, end=exporters, importers
+    else:
+        start, end=importers, exporters
+    longitude=data['Longitude']
+    latitude=data['Latitude']
+    coords_df=pd.DataFrame({'start_lon': longitude.reindex(start).to_numpy(dtype=np.float64),
+                            'start_lat': latitude.reindex(start).to_numpy(dtype=np.float64),
+                            'end_lon': longitude.reindex(end).to_numpy(dtype=np.float64),
+                            'end_lat': latitude.reindex(end).to_numpy(dtype=np.float64),
+                            'emissions': values[rows, columns],
+                            'exporter': exporters,
+                            'importer': importers})
+    return coords_df
+
 def EmissionFlowDataFrame(dataframe, data):
     """
     Input:
         - Emission Dataframe (emission_data)
         - data (complete dataframe)
+    Lines from the exporters to the importers, see EmissionFlowEdges.
     """
-    export_country=[]
-    import_country=[]
-    emissions_transferred=[]
-
-    for country in dataframe.index:
-        for column in dataframe.columns:
-            if dataframe[column][country]>0.1:
-                exp_long=data['Longitude'][country]
-                exp_lat=data['Latitude'][country]
-                exp_tup=(exp_long, exp_lat)
-                column_country = column.replace("Emissions to ", "")
-                imp_long=data['Longitude'][column_country]
-                imp_lat=data['Latitude'][column_country]
-                imp_tup=(imp_long, imp_lat)
-            
-                emissions_to_country=dataframe[column][country]
-            
-                export_country.append(exp_tup)
-                import_country.append(imp_tup)
-                emissions_transferred.append(emissions_to_country)
-    
-    coords_df_export=pd.DataFrame(export_country)
-    coords_df_import=pd.DataFrame(import_country)
-    coords_df_emissions=pd.DataFrame(emissions_transferred)
-    coords_df=pd.concat([coords_df_export, coords_df_import, coords_df_emissions], axis=1)
-    coords_df.columns=['start_lon', 'start_lat', 'end_lon', 'end_lat', 'emissions']
-    return coords_df
+    return EmissionFlowEdges(dataframe, data, direction='from')
 
 def VisualizeFlowsFromCountry(country, emissions_dataframe, filled_dataframe):
     
-    emission_country=emissions_dataframe.loc[country].reset_index().T
-    emission_country.columns = emission_country.iloc[0]
-    emission_country=emission_country.drop('index')
-    df_country=EmissionFlowDataFrame(emission_country, filled_dataframe)
+    df_country=EmissionFlowEdges(emissions_dataframe.loc[[country]], filled_dataframe, direction='from')
     filename="EmissionFlows"+country+".html"
     title="Emission Flows from " +country+ " to other countries"
     url=EmissionFlowPlot(df_country, filename=filename, title=title)
     return url
 
 def VisualizeFlowsToCountry(country, emissions_dataframe, filled_dataframe):
-    emission_to_country=pd.DataFrame(emissions_dataframe['Emissions to '+country])
-    df_country=EmissionFlowDataFrame_TO(emission_to_country, filled_dataframe)
+    emission_to_country=emissions_dataframe[['Emissions to '+country]]
+    df_country=EmissionFlowEdges(emission_to_country, filled_dataframe, direction='to')
     filename="EmissionFlows"+country+".html"
     title="Emission Flows to " +country+"from other countries"
     url=EmissionFlowPlot(df_country, filename=filename, title=title)
@@ -482,59 +601,67 @@ def EmissionFlowDataFrame_TO(dataframe, data):
     Input:
         - Emission Dataframe (emission_data)
         - data (complete dataframe)
+    Lines from the importers to the exporters, see EmissionFlowEdges.
     """
-    export_country=[]
-    import_country=[]
-    emissions_transferred=[]
-
-    for country in dataframe.index:
-        for column in dataframe.columns:
-            if dataframe[column][country]>0.1:
-                imp_long=data['Longitude'][country]
-                imp_lat=data['Latitude'][country]
-                imp_tup=(imp_long, imp_lat)
-                column_country = column.replace("Emissions to ", "")
-                exp_long=data['Longitude'][column_country]
-                exp_lat=data['Latitude'][column_country]
-                exp_tup=(exp_long, exp_lat)
-            
-                emissions_to_country=dataframe[column][country]
-            
-                export_country.append(exp_tup)
-                import_country.append(imp_tup)
-                emissions_transferred.append(emissions_to_country)
-    
-    coords_df_export=pd.DataFrame(export_country)
-    coords_df_import=pd.DataFrame(import_country)
-    coords_df_emissions=pd.DataFrame(emissions_transferred)
-    coords_df=pd.concat([coords_df_export, coords_df_import, coords_df_emissions], axis=1)
-    coords_df.columns=['start_lon', 'start_lat', 'end_lon', 'end_lat', 'emissions']
-    return coords_df
+    return EmissionFlowEdges(dataframe, data, direction='to')
 
 
-def EmissionFlowPlot(coords_df, filename='EmissionFlows.html' ,title):
+def EmissionFlowTraces(coords_df, classes=10):
     """
     
-    This function plots the transferred emissions from country to country. 
-    Larger transfers are represented by a thicker line. 
+    This function packs all transfers into at most classes scattergeo traces.
+    The transfers are put into classes by their size relative to the largest
+    transfer; every class is one trace with the line segments separated by
+    None, and the width and opacity of the upper bound of its class. The 
+    largest transfers therefore look the same as with one trace per 
+    transfer, while the figure stays small.
     
     """
+    coords_df=coords_df.dropna(subset=['start_lon', 'start_lat', 'end_lon', 'end_lat'])
+    emissions=coords_df['emissions'].to_numpy(dtype=np.float64)
+    if len(emissions)==0 or emissions.max()<=0:
+        return []
+    ratio=emissions/emissions.max()
+    bucket=np.clip(np.ceil(ratio*classes).astype(int), 1, classes)
+    
     emission_transfers = []
-    for i in range( len( coords_df ) ):
+    for k in np.unique(bucket):
+        selected=bucket==k
+        n=int(selected.sum())
+        lon=np.empty(3*n, dtype=object)
+        lat=np.empty(3*n, dtype=object)
+        lon[0::3]=coords_df['start_lon'].to_numpy(dtype=np.float64)[selected]
+        lon[1::3]=coords_df['end_lon'].to_numpy(dtype=np.float64)[selected]
+        lat[0::3]=coords_df['start_lat'].to_numpy(dtype=np.float64)[selected]
+        lat[1::3]=coords_df['end_lat'].to_numpy(dtype=np.float64)[selected]
         emission_transfers.append(
                 dict(
                     type = 'scattergeo',
                     locationmode = 'country names',
-                    lon = [ coords_df['start_lon'][i], coords_df['end_lon'][i] ],
-                    lat = [ coords_df['start_lat'][i], coords_df['end_lat'][i] ],
+                    lon = lon.tolist(),
+                    lat = lat.tolist(),
                     mode = 'lines',
                     line = dict(
-                    width = 5*float(coords_df['emissions'][i])/float(coords_df['emissions'].max()),
+                    width = 5*float(k)/classes,
                     color = 'red',
                     ),
-                    opacity = float(coords_df['emissions'][i])/float(coords_df['emissions'].max()),
+                    opacity = float(k)/classes,
                     )
                                 )
+    return emission_transfers
+
+def EmissionFlowFigure(coords_df, title, classes=10):
+    """
+    
+    This function builds the figure of the transferred emissions, with at
+    most classes traces (see EmissionFlowTraces).
+    
+    """
+    emission_transfers = EmissionFlowTraces(coords_df, classes=classes)
+    if not emission_transfers:
+        # plotly refuses a figure without traces; countries without flows 
+        # above the threshold get an empty map
+        emission_transfers = [dict(type='scattergeo', lon=[], lat=[], mode='lines')]
     layout = dict(
         title = title,
         showlegend = False,
@@ -553,44 +680,870 @@ def EmissionFlowPlot(coords_df, filename='EmissionFlows.html' ,title):
     )
 
     fig = dict( data=emission_transfers, layout=layout )
+    return fig
+
+def EmissionFlowPlot(coords_df, title, filename='EmissionFlows.html', classes=10):
+    """
+    
+    This function plots the transferred emissions from country to country. 
+    Larger transfers are represented by a thicker line. All transfers are
+    drawn with at most classes traces (see EmissionFlowTraces).
+    
+    """
+    fig = EmissionFlowFigure(coords_df, title, classes=classes)
     url = plotly.offline.plot( fig, filename=filename)
     return url
+
+def _WriteFlowMap(task):
+    # runs in the worker processes of render_all_flow_maps
+    coords_df, title, filename, classes, include_plotlyjs = task
+    fig = EmissionFlowFigure(coords_df, title, classes=classes)
+    plotly.offline.plot(fig, filename=filename, auto_open=False, include_plotlyjs=include_plotlyjs)
+    return filename
+
+def _FlowMapHash(coords_df, title, classes):
+    digest = hashlib.sha1(pd.util.hash_pandas_object(coords_df, index=False).to_numpy().tobytes())
+    digest.update(repr((title, classes)).encode('utf-8'))
+    return digest.hexdigest()
+
+def _FlowMapFileName(country):
+    # country names like "Serbia, FR(Serbia/Montenegro)" hold characters that
+    # cannot be used in a file name
+    return re.sub(r"[^\w .,()&'-]", '_', str(country)).strip() or '_'
+
+def render_all_flow_maps(emissions, coords, out_dir, workers=1, countries=None, 
+                         threshold=0.1, classes=10, include_plotlyjs='directory'):
+    """
+    
+    This function writes the flow maps of all countries at once: for every
+    country a map of the emissions it transfers to other countries
+    (EmissionFlowsFrom<country>.html) and a map of the emissions transferred
+    to it (EmissionFlowsTo<country>.html). Characters that cannot be used in
+    a file name (e.g. the '/' in "Serbia, FR(Serbia/Montenegro)") are 
+    replaced by '_'; the file of every country is in the returned summary.
+    
+    The edge list of all countries is built only once per direction and then
+    split by exporter and importer. The HTML files are written by a pool of workers
+    processes. The hash of the edges of every map is kept in flow_maps.json
+    in out_dir, and maps whose edges did not change since the last run are 
+    not written again.
+    
+    ------
+    Inputs
+    ------
+    emissions:          emission dataframe with the exporting countries as 
+                        index and "Emissions to <country>" columns 
+    coords:             dataframe with a Latitude and Longitude column and
+                        the countries as index (complete dataframe)
+    out_dir:            the directory of the HTML files
+    workers:            the number of worker processes (default: 1)
+    countries:          the countries to make maps of (default: all)
+    threshold:          the minimum transfer to draw (default: 0.1)
+    classes:            the number of line classes (default: 10)
+    include_plotlyjs:   passed to plotly.offline.plot; the default 
+                        'directory' writes plotly.min.js once into out_dir
+                        instead of into every file
+    
+    -------
+    Outputs
+    -------
+    maps:               dataframe with one row per map and the country, 
+                        direction, file and rendered (False when skipped)
+                        columns
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_file = os.path.join(out_dir, 'flow_maps.json')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as manifest_json:
+            manifest = json.load(manifest_json)
+    
+    if countries is None:
+        countries = list(emissions.index)
+    file_names = {}
+    for country in countries:
+        name = _FlowMapFileName(country)
+        while name in file_names.values():
+            name += '_'
+        file_names[country] = name
+    
+    maps = []
+    tasks = []
+    columns = ['start_lon', 'start_lat', 'end_lon', 'end_lat', 'emissions']
+    for direction, key in (('from', 'exporter'), ('to', 'importer')):
+        # the 'to' edges run from the importer to the exporters, like 
+        # VisualizeFlowsToCountry
+        edges = EmissionFlowEdges(emissions, coords, direction=direction, threshold=threshold)
+        groups = dict(tuple(edges.groupby(key, sort=False)))
+        for country in countries:
+            coords_df = groups.get(country, edges.iloc[:0])[columns].reset_index(drop=True)
+            if direction == 'from':
+                title = "Emission Flows from " +country+ " to other countries"
+            else:
+                title = "Emission Flows to " +country+ " from other countries"
+            name = 'EmissionFlows'+direction.capitalize()+file_names[country]+'.html'
+            filename = os.path.join(out_dir, name)
+            digest = _FlowMapHash(coords_df, title, classes)
+            rendered = manifest.get(name) != digest or not os.path.exists(filename)
+            if rendered:
+                tasks.append((coords_df, title, filename, classes, include_plotlyjs))
+                manifest[name] = digest
+            maps.append((country, direction, filename, rendered))
+    
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_WriteFlowMap, tasks, chunksize=max(1, len(tasks)//(4*workers))))
+    else:
+        for task in tasks:
+            _WriteFlowMap(task)
+    
+    with open(manifest_file, 'w') as manifest_json:
+        json.dump(manifest, manifest_json, indent=1, sort_keys=True)
+    return pd.DataFrame(maps, columns=['country', 'direction', 'file', 'rendered'])
         
 
-def CalculatePercentages(dataframe, years):
+GHG_COLUMN = "Total greenhouse gas emissions (kt of CO2 equivalent)"
+EXPORTS_COLUMN = "Exports of goods and services (% of GDP)"
+GDP_COLUMN = "GDP (current US$)"
+
+def compute_true_emissions(trade_cube, wb_frame, year, wide=False, return_transfers=False):
+    """
+    
+    This function calculates the true emissions of every country for one 
+    year, as matrix algebra instead of one "Percentage to" and one 
+    "Emissions to" column per partner:
+        
+        EmissionForExport    = GHG * Exports(% of GDP)/100
+        transfers            = trade shares (exporters x importers), every 
+                               exporter row scaled by its EmissionForExport
+        EmissionsToCountries = column sums of transfers
+        NewEmissions         = EmissionsToCountries + (1-Exports/100)*GHG
+        EmissionDifference   = NewEmissions - GHG
+    
+    Exporters without WB data transfer nothing. Countries of wb_frame that
+    are not in the trade cube get NaN.
+    
+    ------
+    Inputs
+    ------
+    trade_cube:         TradeCube, SparseTradeCube or multi-index trade 
+                        dataframe with the trade values (or shares)
+    wb_frame:           dataframe with the countries as index (the names of
+                        the trade cube) and the GHG_COLUMN and 
+                        EXPORTS_COLUMN columns
+    year:               the year of the trade data
+    wide:               return the old wide dataframe: wb_frame with the
+                        "Percentage to <country>" and "Emissions to 
+                        <country>" columns and the totals (default: False)
+    return_transfers:   also return the transfer matrix (default: False)
+    
+    -------
+    Outputs
+    -------
+    totals:             dataframe with the countries of wb_frame as index 
+                        and the EmissionForExport, EmissionsToCountries, 
+                        NewEmissions and EmissionDifference columns (the wide
+                        dataframe when wide is True)
+    transfers:          only when return_transfers is True: the (exporters x
+                        importers) transfer matrix, a numpy array or CSR
+                        matrix in the order of trade_cube.countries
+    """
+    if isinstance(trade_cube, pd.DataFrame):
+        trade_cube=TradeCube.from_frame(trade_cube)
+    countries=pd.Index(trade_cube.countries)
+    
+    ghg=wb_frame[GHG_COLUMN].to_numpy(dtype=np.float64)
+    exports=wb_frame[EXPORTS_COLUMN].to_numpy(dtype=np.float64)
+    emission_for_export=ghg*exports/100
+    
+    export_emissions=pd.Series(emission_for_export, index=wb_frame.index).reindex(countries).to_numpy()
+    transfers=trade_cube.transfers(year, np.nan_to_num(export_emissions))
+    received=np.asarray(transfers.sum(axis=0)).ravel()
+    
+    positions=countries.get_indexer(wb_frame.index)
+    emissions_to_countries=np.where(positions>=0, received[positions], np.nan)
+    new_emissions=emissions_to_countries+(1-exports/100)*ghg
+    
+    totals=pd.DataFrame({'EmissionForExport': emission_for_export,
+                         'EmissionsToCountries': emissions_to_countries,
+                         'NewEmissions': new_emissions,
+                         'EmissionDifference': new_emissions-ghg}, index=wb_frame.index)
+    
+    if wide:
+        shares=trade_cube.loc[year]
+        shares=shares.toarray() if sparse.issparse(shares) else np.asarray(shares)
+        row_totals=shares.sum(axis=1, keepdims=True)
+        shares=np.divide(shares, row_totals, out=np.zeros_like(shares), where=row_totals!=0)
+        rows=np.where(positions>=0, positions, 0)
+        missing=(positions<0)[:, np.newaxis]
+        percentages=pd.DataFrame(np.where(missing, np.nan, shares[rows]), index=wb_frame.index,
+                                 columns=['Percentage to '+str(country) for country in countries])
+        emissions=pd.DataFrame(percentages.to_numpy()*emission_for_export[:, np.newaxis], index=wb_frame.index,
+                               columns=['Emissions to '+str(country) for country in countries])
+        totals=pd.concat([wb_frame, percentages, emissions, totals], axis=1)
+    
+    if return_transfers:
+        return totals, transfers
+    return totals
+
+def _WBPanel(wb_panel, column, years, fill_latest):
+    # years x countries table of one WB indicator
+    if isinstance(wb_panel.index, pd.MultiIndex):
+        level='year' if 'year' in wb_panel.index.names else 1
+        table=wb_panel[column].unstack(level=level).T
+        country_level=1-wb_panel.index.names.index(level) if level=='year' else 0
+        table=table[wb_panel.index.get_level_values(country_level).unique()]
+        table.index=table.index.astype(int)
+        if fill_latest:
+            all_years=range(min(table.index.min(), min(years)), max(table.index.max(), max(years))+1)
+            table=table.reindex(all_years).ffill()
+        return table.reindex(years)
+    return pd.DataFrame([wb_panel[column].to_numpy()]*len(years), index=years, columns=wb_panel.index)
+
+def compute_true_emissions_panel(trade_cube, wb_panel, years=None, fill_latest=True):
+    """
+    
+    This function calculates the true emissions (see compute_true_emissions)
+    for all years at once. The WB indicators are matched by year: for every 
+    year the GHG emissions and exports of that year are used. The transfers
+    of all years are computed in one batched operation over the year axis 
+    (einsum over the dense cube, one sparse product per year for a sparse 
+    cube).
+    
+    ------
+    Inputs
+    ------
+    trade_cube:     TradeCube, SparseTradeCube or multi-index trade dataframe
+    wb_panel:       dataframe with a (country, year) MultiIndex and the 
+                    GHG_COLUMN and EXPORTS_COLUMN columns, e.g. from 
+                    DataSources.FetchRangeWB(); a dataframe with only the
+                    countries as index is used for every year
+    years:          the years to calculate (default: all years of the cube)
+    fill_latest:    use the latest earlier observation when a country has
+                    no WB data for a year (default: True)
+    
+    -------
+    Outputs
+    -------
+    panel:          dataframe with a (year, country) MultiIndex and the 
+                    EmissionForExport, EmissionsToCountries, NewEmissions 
+                    and EmissionDifference columns; use e.g. 
+                    panel['NewEmissions'].unstack() for a year x country table
+    """
+    if isinstance(trade_cube, pd.DataFrame):
+        trade_cube=TradeCube.from_frame(trade_cube)
+    if years is None:
+        years=list(trade_cube.years)
+    years=[int(year) for year in years]
+    countries=pd.Index(trade_cube.countries)
+    
+    ghg_table=_WBPanel(wb_panel, GHG_COLUMN, years, fill_latest)
+    exports_table=_WBPanel(wb_panel, EXPORTS_COLUMN, years, fill_latest).reindex(columns=ghg_table.columns)
+    wb_countries=ghg_table.columns
+    ghg=ghg_table.to_numpy(dtype=np.float64)
+    exports=exports_table.to_numpy(dtype=np.float64)
+    emission_for_export=ghg*exports/100
+    
+    positions=countries.get_indexer(wb_countries)
+    known=positions>=0
+    export_emissions=np.zeros((len(years), len(countries)))
+    export_emissions[:, positions[known]]=np.nan_to_num(emission_for_export[:, known])
+    
+    year_positions=[trade_cube.year_index[year] for year in years]
+    if isinstance(trade_cube, SparseTradeCube):
+        received=np.empty((len(years), len(countries)))
+        for row, position in enumerate(year_positions):
+            matrix=trade_cube.matrices[position]
+            totals=np.asarray(matrix.sum(axis=1)).ravel()
+            scale=np.divide(export_emissions[row], totals, out=np.zeros_like(totals), where=totals!=0)
+            received[row]=matrix.T @ scale
+    else:
+        values=trade_cube.values[year_positions]
+        totals=values.sum(axis=2)
+        scale=np.divide(export_emissions, totals, out=np.zeros_like(totals), where=totals!=0)
+        received=np.einsum('yi,yij->yj', scale, values)
+    
+    emissions_to_countries=np.full(ghg.shape, np.nan)
+    emissions_to_countries[:, known]=received[:, positions[known]]
+    new_emissions=emissions_to_countries+(1-exports/100)*ghg
+    
+    index=pd.MultiIndex.from_product([years, wb_countries], names=['year', 'country'])
+    panel=pd.DataFrame({'EmissionForExport': emission_for_export.ravel(),
+                        'EmissionsToCountries': emissions_to_countries.ravel(),
+                        'NewEmissions': new_emissions.ravel(),
+                        'EmissionDifference': (new_emissions-ghg).ravel()}, index=index)
+    return panel
+
+def compute_mrio_emissions(trade_cube, wb_frame, year, method='lu', tol=1e-10, maxiter=1000, 
+                           trade_unit=1000.0):
+    """
+    
+    This function calculates consumption-based emissions with a multi-region
+    input-output (Leontief) model, so emissions embodied in re-exports 
+    (China -> Netherlands -> Germany) end up at the final consumer instead 
+    of at the first importer. With one sector per country:
+        
+        Z  = trade flows (exporters x importers), in US$
+        x  = GDP + imports (total output: value added plus inputs)
+        A  = Z diag(1/x) (technical coefficients)
+        f  = GHG / x (emission intensity)
+        m  = f (I - A)^-1 (emissions per US$ of final demand)
+        y  = x - exports (final demand)
+        NewEmissions = m * y
+    
+    The multipliers m are found without forming the inverse: by a sparse LU
+    factorisation of (I - A)^T, or iteratively (m = f + m A until the 
+    relative change is below tol). The columns of A add up to less than 1,
+    so the iteration always converges. The total of NewEmissions equals the
+    total of GHG. Countries without GDP or GHG data are left out of the 
+    model (their trade is ignored) and get NaN.
+    
+    ------
+    Inputs
+    ------
+    trade_cube:     TradeCube, SparseTradeCube or multi-index trade dataframe
+    wb_frame:       dataframe with the countries as index and the GHG_COLUMN
+                    and GDP_COLUMN columns
+    year:           the year of the trade data
+    method:         'lu' or 'iterative' (default: 'lu')
+    tol:            the tolerance of the iterative method (default: 1e-10)
+    maxiter:        the maximum number of iterations (default: 1000)
+    trade_unit:     US$ per unit of the trade values (default: 1000, the 
+                    WITS data is in 1000 USD)
+    
+    -------
+    Outputs
+    -------
+    totals:         dataframe with the countries of wb_frame as index and 
+                    the EmissionMultiplier, NewEmissions and 
+                    EmissionDifference (NewEmissions - GHG) columns
+    """
+    if isinstance(trade_cube, pd.DataFrame):
+        trade_cube=TradeCube.from_frame(trade_cube)
+    countries=pd.Index(trade_cube.countries)
+    
+    gdp=wb_frame[GDP_COLUMN].reindex(countries).to_numpy(dtype=np.float64)
+    ghg=wb_frame[GHG_COLUMN].reindex(countries).to_numpy(dtype=np.float64)
+    valid=np.isfinite(gdp) & np.isfinite(ghg) & (gdp>0)
+    
+    flows=trade_cube.loc[year]
+    flows=flows if sparse.issparse(flows) else sparse.csr_matrix(flows)
+    Z=sparse.csr_matrix(flows[valid][:, valid])*trade_unit
+    imports=np.asarray(Z.sum(axis=0)).ravel()
+    exports=np.asarray(Z.sum(axis=1)).ravel()
+    
+    x=gdp[valid]+imports
+    A=sparse.csr_matrix(Z @ sparse.diags(1/x))
+    f=ghg[valid]/x
+    
+    if method=='lu':
+        identity=sparse.identity(len(x), format='csc')
+        multipliers=splu(sparse.csc_matrix((identity-A).T)).solve(f)
+    elif method=='iterative':
+        AT=sparse.csr_matrix(A.T)
+        multipliers=f.copy()
+        for iteration in range(maxiter):
+            updated=f+AT @ multipliers
+            change=np.abs(updated-multipliers).max()
+            multipliers=updated
+            if change<=tol*np.abs(multipliers).max():
+                break
+        else:
+            raise RuntimeError('The Leontief iteration did not converge in %d iterations' % maxiter)
+    else:
+        raise ValueError("method must be 'lu' or 'iterative', not %r" % (method,))
+    
+    final_demand=x-exports
+    result=pd.DataFrame(np.nan, index=countries, columns=['EmissionMultiplier', 'NewEmissions'])
+    result.loc[countries[valid], 'EmissionMultiplier']=multipliers
+    result.loc[countries[valid], 'NewEmissions']=multipliers*final_demand
+    
+    totals=result.reindex(wb_frame.index)
+    totals['EmissionDifference']=totals['NewEmissions']-wb_frame[GHG_COLUMN]
+    return totals
+
+_monte_carlo_inputs = {}
+
+def _MonteCarloInputs(flows, n_countries, positions, ghg, exports, ghg_width, exports_width, trade_sigma):
+    # the inputs that all chunks share, with the sparse (countries x flows)
+    # indicators of the exporter and importer of every flow
+    rows, columns=flows.row, flows.col
+    return {'flows': flows.data,
+            'rows': rows,
+            'exporter_of': sparse.csr_matrix((np.ones(len(rows)), (rows, np.arange(len(rows)))),
+                                             shape=(n_countries, len(rows))),
+            'importer_of': sparse.csr_matrix((np.ones(len(columns)), (columns, np.arange(len(columns)))),
+                                             shape=(n_countries, len(columns))),
+            'n_countries': n_countries, 'positions': positions, 'ghg': ghg, 'exports': exports,
+            'ghg_width': ghg_width, 'exports_width': exports_width, 'trade_sigma': trade_sigma}
+
+def _UsableCPUs():
+    # the number of CPUs this process may run on
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def _InitMonteCarloWorker(inputs):
+    # the shared inputs are sent once per worker process, not once per chunk
+    _monte_carlo_inputs.clear()
+    _monte_carlo_inputs.update(inputs)
+
+def _MonteCarloChunk(task, inputs=None):
+    # one chunk of samples; in the worker processes of 
+    # monte_carlo_true_emissions the inputs come from _InitMonteCarloWorker
+    seed, samples=task
+    if inputs is None:
+        inputs=_monte_carlo_inputs
+    flows, rows, positions=inputs['flows'], inputs['rows'], inputs['positions']
+    n_countries, ghg, exports=inputs['n_countries'], inputs['ghg'], inputs['exports']
+    rng=np.random.default_rng(seed)
+    known=positions>=0
+    
+    def draw(values, width):
+        # (values x samples) lognormal draws with mean values; the noise is
+        # drawn in single precision, which is plenty for an error term
+        noise=rng.standard_normal((np.size(values), samples), dtype=np.float32)
+        noise*=np.asarray(width, dtype=np.float32).reshape(-1, 1)
+        noise-=np.asarray(width, dtype=np.float32).reshape(-1, 1)**2/2
+        return np.asarray(values, dtype=np.float64).reshape(-1, 1)*np.exp(noise)
+    
+    ghg_samples=draw(ghg, inputs['ghg_width'])
+    exports_samples=draw(exports, inputs['exports_width'])
+    flow_samples=draw(flows, np.full(len(flows), inputs['trade_sigma']))
+    
+    export_emissions=np.zeros((n_countries, samples))
+    export_emissions[positions[known]]=np.nan_to_num(ghg_samples*exports_samples/100)[known]
+    totals=inputs['exporter_of'] @ flow_samples
+    scale=np.divide(export_emissions, totals, out=np.zeros_like(totals), where=totals!=0)
+    flow_samples*=scale[rows]
+    received=inputs['importer_of'] @ flow_samples
+    
+    emissions_to_countries=np.full(ghg_samples.shape, np.nan)
+    emissions_to_countries[known]=received[positions[known]]
+    new_emissions=(emissions_to_countries+(1-exports_samples/100)*ghg_samples).T
+    ghg_samples=ghg_samples.T
+    return new_emissions, new_emissions-ghg_samples
+
+def monte_carlo_true_emissions(trade_cube, wb_frame, year, provenance=None, n_samples=1000,
+                               trade_sigma=0.1, widths=None, percentiles=(5, 50, 95), seed=None,
+                               workers=1, chunk_size=250):
+    """
+    
+    This function propagates the uncertainty of the inputs through the 
+    emission transfer calculation (see compute_true_emissions). Many inputs
+    are estimates (region/income means) rather than observations, so every
+    sample multiplies the GHG emissions and the exports (% of GDP) by a 
+    lognormal error whose width depends on the source of the value (see 
+    Imputation.ProvenanceWidths), and every trade flow by a lognormal error
+    of width trade_sigma. All samples of a chunk are calculated at once; 
+    with workers > 1 the chunks are calculated by a pool of processes, 
+    which get the inputs once and then only a seed and a size per chunk.
+    The pool has at most one process per CPU, and only pays off for large
+    n_samples on several CPUs. The result does not depend on the number of
+    workers.
+    
+    ------
+    Inputs
+    ------
+    trade_cube:     TradeCube, SparseTradeCube or multi-index trade dataframe
+    wb_frame:       dataframe with the countries as index and the GHG_COLUMN 
+                    and EXPORTS_COLUMN columns
+    year:           the year of the trade data
+    provenance:     the provenance dataframe of wb_frame (default: read from
+                    the "<column> source" columns)
+    n_samples:      the number of samples (default: 1000)
+    trade_sigma:    the relative uncertainty of the trade flows (default: 0.1)
+    widths:         dictionary from provenance label to relative uncertainty
+                    (default: Imputation.UNCERTAINTY_WIDTHS)
+    percentiles:    the percentiles to return (default: 5, 50 and 95)
+    seed:           the random seed (default: None)
+    workers:        the number of worker processes, at most the number of
+                    CPUs (default: 1)
+    chunk_size:     the number of samples per chunk (default: 250)
+    
+    -------
+    Outputs
+    -------
+    bands:          dataframe with the countries of wb_frame as index and a
+                    "NewEmissions p<percentile>" and "EmissionDifference 
+                    p<percentile>" column for every percentile
+    """
+    if isinstance(trade_cube, pd.DataFrame):
+        trade_cube=TradeCube.from_frame(trade_cube)
+    countries=pd.Index(trade_cube.countries)
+    columns=[GHG_COLUMN, EXPORTS_COLUMN]
+    if provenance is None:
+        provenance=ProvenanceFromSourceColumns(wb_frame, columns)
+    uncertainty=ProvenanceWidths(provenance[columns], widths=widths).reindex(wb_frame.index).fillna(0)
+    
+    flows=trade_cube.loc[year]
+    flows=sparse.coo_matrix(flows)
+    
+    positions=countries.get_indexer(wb_frame.index)
+    ghg=wb_frame[GHG_COLUMN].to_numpy(dtype=np.float64)
+    exports=wb_frame[EXPORTS_COLUMN].to_numpy(dtype=np.float64)
+    
+    sizes=[min(chunk_size, n_samples-start) for start in range(0, n_samples, chunk_size)]
+    seeds=np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks=list(zip(seeds, sizes))
+    # more processes than CPUs only add the cost of the pool
+    workers=min(workers, _UsableCPUs())
+    inputs=_MonteCarloInputs(flows, len(countries), positions, ghg, exports, uncertainty[GHG_COLUMN].to_numpy(),
+                             uncertainty[EXPORTS_COLUMN].to_numpy(), trade_sigma)
+    
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_InitMonteCarloWorker,
+                                 initargs=(inputs,)) as pool:
+            results=list(pool.map(_MonteCarloChunk, tasks))
+    else:
+        results=[_MonteCarloChunk(task, inputs) for task in tasks]
+    
+    new_emissions=np.concatenate([result[0] for result in results])
+    differences=np.concatenate([result[1] for result in results])
+    
+    bands=pd.DataFrame(index=wb_frame.index)
+    for name, samples in (('NewEmissions', new_emissions), ('EmissionDifference', differences)):
+        values=np.nanpercentile(samples, percentiles, axis=0)
+        for percentile, value in zip(percentiles, values):
+            bands[name+' p'+str(percentile)]=value
+    return bands
+
+DEFAULT_SCENARIO = {'year1': 2000,
+                    'year2': 2016,
+                    'year': None,
+                    'levels': DEFAULT_LEVELS,
+                    'threshold': 0.1,
+                    'countries_to_remove': [],
+                    'mode': 'direct'}
+
+_scenario_inputs = {}
+
+def scenario_grid(**options):
+    """
+    
+    This function builds the list of scenarios for run_scenarios from lists 
+    of options: every combination is one scenario, e.g. 
+    scenario_grid(year2=[2014, 2016], threshold=[0.1, 1.0]) gives four.
+    
+    """
+    names=list(options)
+    return [dict(zip(names, values)) for values in itertools.product(*[options[name] for name in names])]
+
+def _InitScenarioWorker(inputs):
+    # the shared inputs are sent once per worker process, not once per scenario
+    _scenario_inputs.clear()
+    _scenario_inputs.update(inputs)
+
+def _YearCube(trade_cube, year, countries_to_remove):
+    # the trade of one year, with the removed countries as neither exporter nor importer
+    keep=~pd.Index(trade_cube.countries).isin(countries_to_remove)
+    if isinstance(trade_cube, SparseTradeCube):
+        mask=sparse.diags(keep.astype(np.float64))
+        return SparseTradeCube([sparse.csr_matrix(mask @ trade_cube.loc[year] @ mask)], [year], trade_cube.countries)
+    values=trade_cube.loc[year]*keep[:, np.newaxis]*keep[np.newaxis, :]
+    return TradeCube(values[np.newaxis], [year], trade_cube.countries)
+
+def _CountryYearPanel(wb_panel):
+    # the WB panel with a (country, year) MultiIndex, as LatestObservationsWB
+    # expects; like _WBPanel, the year level is found by name if it has one
+    if 'year' in wb_panel.index.names and list(wb_panel.index.names).index('year')==0:
+        wb_panel=wb_panel.swaplevel()
+    wb_panel=wb_panel.copy(deep=False)
+    wb_panel.index=wb_panel.index.set_names(['country', 'year'])
+    return wb_panel
+
+def _RunScenario(task, inputs=None):
+    # in a worker process the inputs come from _InitScenarioWorker
+    name, scenario=task
+    if inputs is None:
+        inputs=_scenario_inputs
+    trade_cube=inputs['trade_cube']
+    wb_panel=inputs['wb_panel']
+    regions=inputs['regions']
+    parameters=dict(DEFAULT_SCENARIO, **scenario)
+    
+    # the WB data of the years year1+1 up to and including year2, like GetDataWB
+    years=wb_panel.index.get_level_values('year')
+    in_range=(years>parameters['year1']) & (years<=parameters['year2'])
+    values, provenance=LatestObservationsWB(wb_panel[in_range], provenance=True)
+    keep=~values.index.isin(parameters['countries_to_remove'])
+    values, provenance=values[keep], provenance[keep]
+    frame=values.join(regions[['Region', 'IncomeGroup']])
+    filled, provenance=ImputeByGroups(frame, levels=parameters['levels'], columns=list(values.columns),
+                                      provenance=provenance)
+    
+    year=parameters['year']
+    if year is None:
+        earlier=[cube_year for cube_year in trade_cube.years if cube_year<=parameters['year2']]
+        if not earlier:
+            raise ValueError('Scenario %r: the trade cube has no year up to year2=%d (it has %s)'
+                             % (name, parameters['year2'], ', '.join(map(str, trade_cube.years))))
+        year=max(earlier)
+    year_cube=_YearCube(trade_cube, year, parameters['countries_to_remove'])
+    
+    totals, transfers=compute_true_emissions(year_cube, filled, year, return_transfers=True)
+    if parameters['mode']=='mrio':
+        totals=compute_mrio_emissions(year_cube, filled, year)
+    elif parameters['mode']!='direct':
+        raise ValueError("mode must be 'direct' or 'mrio', not %r" % (parameters['mode'],))
+    
+    # the number of flows that would be drawn on the flow maps
+    edges=np.asarray((transfers>parameters['threshold']).sum(axis=1)).ravel()
+    positions=pd.Index(year_cube.countries).get_indexer(filled.index)
+    
+    result=pd.DataFrame({'scenario': name,
+                         'country': filled.index,
+                         'year': year,
+                         'GHG': filled[GHG_COLUMN].to_numpy(),
+                         'NewEmissions': totals['NewEmissions'].to_numpy(),
+                         'EmissionDifference': totals['EmissionDifference'].to_numpy(),
+                         'FlowsAboveThreshold': np.where(positions>=0, edges[positions], 0)})
+    for parameter in ('year1', 'year2', 'threshold', 'mode'):
+        result[parameter]=parameters[parameter]
+    result['levels']=str(parameters['levels'])
+    result['countries_to_remove']=str(list(parameters['countries_to_remove']))
+    return result
+
+def _ScenarioParameters(scenarios):
+    if isinstance(scenarios, dict):
+        scenarios=list(scenarios.values())
+    return [dict(DEFAULT_SCENARIO, **scenario) for scenario in scenarios]
+
+def _TradeDataYears(trade_data):
+    # the years of the "<year> in 1000 USD " columns of the WITS trade data
+    years=[re.match(r'(\d{4}) in 1000 USD $', str(column)) for column in trade_data.columns]
+    return sorted(int(match.group(1)) for match in years if match)
+
+def prepare_scenario_inputs(scenarios, trade_cube=None, wb_panel=None, regions=None, trade_data=None,
+                            indicators=None, source=None, registry=None):
+    """
+    
+    This function does the stages that all scenarios share, once: loading 
+    the region data and the WB data, the country registry and the trade 
+    cube. Inputs that are passed in are used as they are; the others are 
+    built here:
+        - regions:      from GetRegionIncomeDataWB()
+        - wb_panel:     from DataSources.FetchRangeWB(), with one request 
+                        for the years of all scenarios together 
+                        (min(year1)+1 up to max(year2))
+        - trade_cube:   a SparseTradeCube of the countries of regions, 
+                        built from trade_data for all its years up to the 
+                        last year that a scenario can use
+    The country names of the loaded data are made canonical with the 
+    registry, so the trade data, the WB data and the regions match.
+    
+    ------
+    Inputs
+    ------
+    scenarios:      list of scenarios or dictionary of scenarios (see 
+                    run_scenarios)
+    trade_cube:     TradeCube or SparseTradeCube (default: built from 
+                    trade_data)
+    wb_panel:       dataframe with a (country, year) MultiIndex (default: 
+                    fetched for indicators)
+    regions:        dataframe with a Region and IncomeGroup column 
+                    (default: GetRegionIncomeDataWB())
+    trade_data:     the WITS trade data, needed when there is no trade_cube
+    indicators:     dictionary from indicator code to column name (default: 
+                    the indicators of GetIndicatorsWB())
+    source:         where the WB data is retrieved from (default: wbdata)
+    registry:       the CountryRegistry (default: 
+                    CountryRegistry.GetCountryRegistry())
+    
+    -------
+    Outputs
+    -------
+    inputs:         dictionary with the trade_cube, wb_panel and regions,
+                    as used by every scenario
+    """
+    parameters=_ScenarioParameters(scenarios)
+    loading=regions is None or wb_panel is None or trade_cube is None
+    if registry is None and loading:
+        registry=GetCountryRegistry()
+    
+    if regions is None:
+        regions=GetRegionIncomeDataWB()
+        regions.index=registry.canonical_names(regions.index).values
+    
+    if wb_panel is None:
+        if indicators is None:
+            indicators=GetIndicatorsWB()[1]
+        year1=min(scenario['year1'] for scenario in parameters)
+        year2=max(scenario['year2'] for scenario in parameters)
+        wb_panel=FetchRangeWB(indicators, year1+1, year2, source=source)
+        countries=registry.canonical_names(wb_panel.index.levels[0]).values
+        wb_panel.index=wb_panel.index.set_levels(countries, level=0, verify_integrity=False)
+    
+    if trade_cube is None:
+        if trade_data is None:
+            raise ValueError('Either trade_cube or trade_data is needed')
+        last_year=max(max(scenario['year2'], scenario['year'] or 0) for scenario in parameters)
+        years=[year for year in _TradeDataYears(trade_data) if year<=last_year]
+        trade_data=trade_data.copy(deep=False)
+        for column in ('ReporterName', 'PartnerName'):
+            trade_data[column]=registry.canonical_names(trade_data[column]).values
+        trade_cube=SparseTradeCube.from_trade_data(trade_data, years, list(regions.index))
+    
+    return {'trade_cube': trade_cube, 'wb_panel': _CountryYearPanel(wb_panel), 'regions': regions}
+
+def run_scenarios(scenarios, trade_cube=None, wb_panel=None, regions=None, workers=1, trade_data=None,
+                  indicators=None, source=None, registry=None):
+    """
+    
+    This function runs the true emissions calculation for many parameter 
+    sets. The shared stages (loading the data, the country registry, the 
+    trade cube) are done once, by prepare_scenario_inputs, or passed in 
+    when they are already there; only the stages that depend on the 
+    parameters (taking the latest WB data in the year range, imputation, 
+    removing countries, the allocation) are done per scenario, by a pool 
+    of worker processes when workers > 1. 
+    
+    Every scenario is a dictionary with any of the keys of DEFAULT_SCENARIO:
+        - year1, year2:         the WB year range (years year1+1 to year2)
+        - year:                 the trade year (default: the latest year of 
+                                the trade cube up to year2)
+        - levels:               the imputation levels (see 
+                                Imputation.ImputeByGroups)
+        - threshold:            the minimum transfer of a drawn flow
+        - countries_to_remove:  countries (and aggregates) to leave out
+        - mode:                 'direct' (compute_true_emissions) or 'mrio'
+                                (compute_mrio_emissions)
+    
+    ------
+    Inputs
+    ------
+    scenarios:      list of scenarios (see scenario_grid), or a dictionary 
+                    from scenario name to scenario
+    trade_cube:     TradeCube or SparseTradeCube with the trade values 
+                    (default: built from trade_data)
+    wb_panel:       dataframe with a (country, year) MultiIndex with all 
+                    years, e.g. from DataSources.FetchRangeWB() (a level
+                    named 'year' may also come first), with the
+                    GHG_COLUMN, EXPORTS_COLUMN and (for 'mrio') GDP_COLUMN
+                    (default: fetched for indicators from source)
+    regions:        dataframe with the countries as index and a Region and 
+                    IncomeGroup column (default: GetRegionIncomeDataWB())
+    workers:        the number of worker processes (default: 1)
+    trade_data, indicators, source, registry:
+                    used to build the missing inputs, see 
+                    prepare_scenario_inputs
+    
+    -------
+    Outputs
+    -------
+    results:        tidy dataframe with one row per scenario and country: 
+                    the scenario, country, year, GHG, NewEmissions, 
+                    EmissionDifference and FlowsAboveThreshold columns and 
+                    the parameters of the scenario
+    """
+    if isinstance(scenarios, dict):
+        tasks=list(scenarios.items())
+    else:
+        tasks=list(enumerate(scenarios))
+    inputs=prepare_scenario_inputs(scenarios, trade_cube=trade_cube, wb_panel=wb_panel, regions=regions,
+                                   trade_data=trade_data, indicators=indicators, source=source,
+                                   registry=registry)
+    
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_InitScenarioWorker,
+                                 initargs=(inputs,)) as pool:
+            results=list(pool.map(_RunScenario, tasks))
+    else:
+        # in this process the inputs are passed directly, so no module-level
+        # reference keeps them alive after the call
+        results=[_RunScenario(task, inputs) for task in tasks]
+    return pd.concat(results, ignore_index=True)
+
+def _DivideRows(values):
+    # divides every row of a float64 array by its sum, in place; missing 
+    # values and rows without exports become 0
+    values[np.isnan(values)]=0
+    totals=values.sum(axis=1, keepdims=True)
+    np.divide(values, totals, out=values, where=totals != 0)
+    values[totals[:, 0] == 0]=0
+
+def CalculatePercentages(dataframe, years, inplace=False):
     """
     
     This function calculates the percentages of the emissions that should be 
     transferred from one country to another. 
+
+    Every (year, exporter) row is divided by its own sum in one broadcasted
+    operation over the whole multi-index dataframe, so all years are done
+    at once. Missing values and rows without exports become 0. Rows of
+    years that are not in years are left untouched.
+    
+    The dataframe can also be a TradeCube or SparseTradeCube, in which case
+    a cube with the shares is returned (sparse cubes stay sparse); there too
+    only the years in years are converted and the other years are copied
+    as they are. With inplace, the cube itself is converted in its own 
+    memory, year by year. A dataframe cannot be converted in place: pandas 
+    would copy it anyway; convert it with TradeCube.from_frame first.
+
+    -------
+    Inputs:
+        - dataframe : the multi-index trade dataframe, or a trade cube
+        - years     : the years to calculate the percentages for
+        - inplace   : write the percentages into the cube instead of
+                      returning a new cube (default: False; only for a
+                      TradeCube or SparseTradeCube)
+    -------
+    Outputs:
+        - percentages : the multi-index dataframe (or cube) with the 
+                        percentages
+    -------
     
     """
-    percentages=dataframe.copy()
-    for year in years:
-        df1 = percentages.loc[year].div(percentages.loc[year].sum(axis=1), axis=0)
-        df2 = df1.fillna(0)
-        percentages.loc[year].update(df2)
-        
-    return percentages
+    if isinstance(dataframe, (TradeCube, SparseTradeCube)):
+        cube=dataframe if inplace else dataframe.copy()
+        for position, year in enumerate(cube.years):
+            if year not in years:
+                continue
+            if isinstance(cube, TradeCube):
+                _DivideRows(cube.values[position])
+            else:
+                matrix=cube.matrices[position]
+                totals=np.asarray(matrix.sum(axis=1)).ravel()
+                inverse=np.divide(1.0, totals, out=np.zeros_like(totals), where=totals != 0)
+                matrix.data*=np.repeat(inverse, np.diff(matrix.indptr))
+        return cube
+
+    if inplace:
+        raise ValueError('inplace is only supported for a TradeCube or SparseTradeCube, '
+                         'convert the dataframe with TradeCube.from_frame first')
+    in_years=dataframe.index.get_level_values(0).isin(years)
+    values=dataframe.to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+    
+    if in_years.all():
+        _DivideRows(values)
+    else:
+        selected=values[in_years]
+        _DivideRows(selected)
+        values[in_years]=selected
+    return pd.DataFrame(values, index=dataframe.index, columns=dataframe.columns)
 
 def DataPointsPerExporter(dataframe, years):
     """
-    This function calculates how many datapoints there 
-    are for each exporting country.
+    This function calculates how many datapoints (non-zero trade partners)
+    there are for each exporting country.
     Input: 
-    - dataframe (percentages)
+    - dataframe (percentages), TradeCube or SparseTradeCube
     - years
+    Output:
+    - dataframe with the exporters as index and one column per year, for 
+      all three kinds of input
     """
-    data_points = (dataframe.loc[1995] != 0).sum(axis=1).to_frame()
-    data_points.columns = ['1995']
-
-    #skip first, as it is used above to create dataframe
-    #must overwrite column names each loop cycle, as df.assign() interprets column name as literal
-    i=1
-    for year in years[1:]:
-        i=i+1
-        this = (dataframe.loc[year] != 0).sum(axis=1)
-        data_points = data_points.assign(temp = this)
-        data_points.columns = [years[:i]]
-
+    if isinstance(dataframe, SparseTradeCube):
+        data_points=dataframe.nonzero_per_exporter()[years]
+    elif isinstance(dataframe, TradeCube):
+        counts=np.count_nonzero(dataframe.values, axis=2).T
+        data_points=pd.DataFrame(counts, index=dataframe.countries, columns=dataframe.years)[years]
+    else:
+        selected=dataframe[dataframe.index.get_level_values(0).isin(years)]
+        counts=(selected.fillna(0) != 0).sum(axis=1).unstack(level=0)
+        data_points=counts.reindex(index=dataframe.index.get_level_values(1).unique(), columns=years).fillna(0)
+    data_points=data_points.astype(np.int64)
+    data_points.index.name='exporter'
+    data_points.columns.name='year'
     return data_points
 
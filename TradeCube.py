@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dense and sparse year*exporter*importer trade cubes.
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def MeltTradeData(data, years):
+    """
+    -------
+
+    Melts the "<year> in 1000 USD " columns of the WITS trade data into one
+    long table with a year, exporter, importer and value column.
+    The WITS rows are reported by the importing country, so the partner is
+    the exporter and the reporter the importer. For duplicate rows the last
+    one wins.
+
+    -------
+    Inputs:
+        - data  : the dataframe containing trade data
+        - years : the years to take from the trade data
+    -------
+    Outputs:
+        - long_data : the long table
+    -------
+
+    """
+    year_keys={str(year)+" in 1000 USD ": year for year in years}
+
+    long_data=data.melt(id_vars=['ReporterName', 'PartnerName'],
+                        value_vars=list(year_keys), var_name='year', value_name='value')
+    long_data['year']=long_data['year'].map(year_keys)
+    long_data['value']=pd.to_numeric(long_data['value'], errors='coerce')
+    long_data=long_data.rename(columns={'PartnerName': 'exporter', 'ReporterName': 'importer'})
+    long_data=long_data.drop_duplicates(['year', 'exporter', 'importer'], keep='last')
+    return long_data[['year', 'exporter', 'importer', 'value']]
+
+
+class TradeCube(object):
+    """
+    -------
+
+    Trade matrix stored as one contiguous float64 array of shape
+    (years, countries, countries). The first country axis holds the
+    exporters, the second one the importers, just like the rows and columns
+    of the multi-index dataframe from build_multi_index_df.
+
+    Years and countries are mapped to integer positions with dictionaries,
+    so a lookup by label costs a single dictionary access. Selections with
+    .loc return numpy views (no copy) as long as scalars and slices are used.
+
+    -------
+    Inputs:
+        - values    : array-like of shape (years, countries, countries)
+        - years     : the years along the first axis
+        - countries : the countries along the second and third axis
+    -------
+
+    """
+
+    def __init__(self, values, years, countries):
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != (len(years), len(countries), len(countries)):
+            raise ValueError('values has shape %s, expected %s' %
+                             (values.shape, (len(years), len(countries), len(countries))))
+        self.values = values
+        self.years = list(years)
+        self.countries = list(countries)
+        self.year_index = {year: i for i, year in enumerate(self.years)}
+        self.country_index = {country: i for i, country in enumerate(self.countries)}
+
+    @classmethod
+    def from_frame(cls, dataframe, fill_value=0.0):
+        """
+        -------
+
+        Builds a trade cube from a multi-index dataframe with a
+        (year, exporter) index and one column per importer.
+        The columns define the country order; missing rows and empty
+        cells are filled with fill_value.
+
+        -------
+        Inputs:
+            - dataframe  : the multi-index dataframe
+            - fill_value : the value for missing trade data (default: 0.0)
+        -------
+        Outputs:
+            - cube : the resulting TradeCube
+        -------
+
+        """
+        years = list(dataframe.index.get_level_values(0).unique())
+        countries = list(dataframe.columns)
+        full_index = pd.MultiIndex.from_product([years, countries], names=['year', 'exporter'])
+        full_frame = dataframe.reindex(index=full_index)
+        values = np.array(full_frame.apply(pd.to_numeric, errors='coerce'), dtype=np.float64, order='C')
+        values[np.isnan(values)] = fill_value
+        return cls(values.reshape(len(years), len(countries), len(countries)), years, countries)
+
+    def to_frame(self):
+        """
+        -------
+
+        Returns the cube as a multi-index dataframe in the layout of
+        build_multi_index_df. The dataframe shares memory with the cube
+        where pandas allows it.
+
+        -------
+        Outputs:
+            - dataframe : the multi-index dataframe
+        -------
+
+        """
+        index = pd.MultiIndex.from_product([self.years, self.countries], names=['year', 'exporter'])
+        values = self.values.reshape(len(self.years)*len(self.countries), len(self.countries))
+        return pd.DataFrame(values, index=index, columns=self.countries, copy=False)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def loc(self):
+        """
+        Label based selection: cube.loc[year], cube.loc[year, exporter] or
+        cube.loc[year, exporter, importer]. Label slices are inclusive, as in
+        pandas. Scalars and slices give numpy views; a selection that keeps
+        all three axes is returned as a TradeCube sharing the same memory.
+        Lists of labels are supported as well, but numpy copies those.
+        """
+        return _TradeCubeLocIndexer(self)
+
+    def shares(self):
+        """
+        Returns a new TradeCube in which every exporter row is divided by its
+        total exports in that year. Rows without exports stay zero.
+        """
+        totals = self.values.sum(axis=2, keepdims=True)
+        shares = np.divide(self.values, totals, out=np.zeros_like(self.values), where=totals != 0)
+        return TradeCube(shares, self.years, self.countries)
+
+    def transfers(self, year, export_emissions):
+        """
+        Allocates the emissions embodied in the exports of every country
+        (in the order of cube.countries) to its importers, in proportion to
+        the trade shares of the given year. Returns the (exporters x
+        importers) array of transferred emissions.
+        """
+        matrix = self.values[self.year_index[year]]
+        totals = matrix.sum(axis=1)
+        scale = np.divide(np.asarray(export_emissions, dtype=np.float64), totals,
+                          out=np.zeros_like(totals), where=totals != 0)
+        return matrix*scale[:, np.newaxis]
+
+    def copy(self):
+        return TradeCube(self.values.copy(), self.years, self.countries)
+
+    def __repr__(self):
+        return 'TradeCube(%d years x %d exporters x %d importers)' % self.values.shape
+
+
+class SparseTradeCube(object):
+    """
+    -------
+
+    Sparse version of the TradeCube: one scipy CSR matrix
+    (exporters x importers) per year. Only the reporter/partner pairs that
+    actually trade are stored, so full bilateral (e.g. HS-level) data fits
+    in memory without materializing the dense years*countries*countries
+    block.
+
+    -------
+    Inputs:
+        - matrices  : one (countries x countries) matrix per year
+        - years     : the years belonging to the matrices
+        - countries : the countries along both axes of every matrix
+    -------
+
+    """
+
+    def __init__(self, matrices, years, countries):
+        if len(matrices) != len(years):
+            raise ValueError('got %d matrices for %d years' % (len(matrices), len(years)))
+        self.matrices = [sparse.csr_matrix(matrix, dtype=np.float64) for matrix in matrices]
+        for matrix in self.matrices:
+            if matrix.shape != (len(countries), len(countries)):
+                raise ValueError('matrix has shape %s, expected %s' %
+                                 (matrix.shape, (len(countries), len(countries))))
+        self.years = list(years)
+        self.countries = list(countries)
+        self.year_index = {year: i for i, year in enumerate(self.years)}
+        self.country_index = {country: i for i, country in enumerate(self.countries)}
+
+    @classmethod
+    def from_trade_data(cls, data, years, countries):
+        """
+        -------
+
+        Builds a sparse trade cube straight from the WITS trade data,
+        without going through the dense multi-index dataframe. Rows for
+        countries that are not in countries are dropped, as are empty cells.
+
+        -------
+        Inputs:
+            - data      : the dataframe containing trade data
+            - years     : the years to take from the trade data
+            - countries : the countries to include
+        -------
+        Outputs:
+            - cube : the resulting SparseTradeCube
+        -------
+
+        """
+        long_data = MeltTradeData(data, years)
+        exporters = pd.Index(countries).get_indexer(long_data['exporter'])
+        importers = pd.Index(countries).get_indexer(long_data['importer'])
+        values = long_data['value'].to_numpy(dtype=np.float64)
+        keep = (exporters >= 0) & (importers >= 0) & ~np.isnan(values) & (values != 0)
+        year_positions = long_data['year'].to_numpy()
+
+        matrices = []
+        for year in years:
+            in_year = keep & (year_positions == year)
+            matrices.append(sparse.csr_matrix((values[in_year], (exporters[in_year], importers[in_year])),
+                                              shape=(len(countries), len(countries))))
+        return cls(matrices, years, countries)
+
+    @classmethod
+    def from_cube(cls, cube):
+        return cls(list(cube.values), cube.years, cube.countries)
+
+    @classmethod
+    def from_frame(cls, dataframe, fill_value=0.0):
+        return cls.from_cube(TradeCube.from_frame(dataframe, fill_value=fill_value))
+
+    def to_cube(self):
+        return TradeCube(np.stack([matrix.toarray() for matrix in self.matrices]),
+                         self.years, self.countries)
+
+    def to_frame(self):
+        return self.to_cube().to_frame()
+
+    @property
+    def shape(self):
+        return (len(self.years), len(self.countries), len(self.countries))
+
+    @property
+    def nnz(self):
+        return sum(matrix.nnz for matrix in self.matrices)
+
+    @property
+    def loc(self):
+        """
+        Label based selection: cube.loc[year] gives the CSR matrix of that
+        year, cube.loc[year, exporter] a (1 x countries) CSR row and
+        cube.loc[year, exporter, importer] a single value.
+        """
+        return _SparseTradeCubeLocIndexer(self)
+
+    def shares(self):
+        """
+        Returns a new SparseTradeCube in which every exporter row is divided
+        by its total exports in that year. Rows without exports stay empty.
+        """
+        matrices = []
+        for matrix in self.matrices:
+            totals = np.asarray(matrix.sum(axis=1)).ravel()
+            inverse = np.divide(1.0, totals, out=np.zeros_like(totals), where=totals != 0)
+            matrices.append(sparse.diags(inverse) @ matrix)
+        return SparseTradeCube(matrices, self.years, self.countries)
+
+    def transfers(self, year, export_emissions):
+        """
+        -------
+
+        Allocates the emissions embodied in the exports of every country to
+        its importers, in proportion to the trade shares of the given year.
+
+        -------
+        Inputs:
+            - year             : the year of the trade shares
+            - export_emissions : the emissions for export of every exporter,
+                                 in the order of cube.countries
+        -------
+        Outputs:
+            - transfers : CSR matrix (exporters x importers) with the
+                          transferred emissions
+        -------
+
+        """
+        matrix = self.matrices[self.year_index[year]]
+        totals = np.asarray(matrix.sum(axis=1)).ravel()
+        scale = np.divide(np.asarray(export_emissions, dtype=np.float64), totals,
+                          out=np.zeros_like(totals), where=totals != 0)
+        return sparse.csr_matrix(sparse.diags(scale) @ matrix)
+
+    def nonzero_per_exporter(self):
+        """
+        Returns a dataframe with the number of trade partners of every
+        exporter (rows) in every year (columns).
+        """
+        counts = np.column_stack([matrix.getnnz(axis=1) for matrix in self.matrices])
+        return pd.DataFrame(counts, index=self.countries, columns=self.years)
+
+    def copy(self):
+        return SparseTradeCube([matrix.copy() for matrix in self.matrices], self.years, self.countries)
+
+    def __repr__(self):
+        return 'SparseTradeCube(%d years x %d exporters x %d importers, %d stored values)' % \
+            (self.shape+(self.nnz,))
+
+
+class _SparseTradeCubeLocIndexer(object):
+
+    def __init__(self, cube):
+        self.cube = cube
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        matrix = self.cube.matrices[self.cube.year_index[key[0]]]
+        if len(key) == 1:
+            return matrix
+        row = matrix[self.cube.country_index[key[1]]]
+        if len(key) == 2:
+            return row
+        return row[0, self.cube.country_index[key[2]]]
+
+
+class _TradeCubeLocIndexer(object):
+
+    def __init__(self, cube):
+        self.cube = cube
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise KeyError('too many indexers for a TradeCube: %d' % len(key))
+
+        axes = [(self.cube.years, self.cube.year_index),
+                (self.cube.countries, self.cube.country_index),
+                (self.cube.countries, self.cube.country_index)]
+        positions = [_position(label, labels, index) for label, (labels, index) in zip(key, axes)]
+        positions += [slice(None)]*(3-len(positions))
+
+        # index one axis at a time, so that lists select an outer product
+        values = self.cube.values
+        for axis in reversed(range(3)):
+            values = values[(slice(None),)*axis+(positions[axis],)]
+        if all(not isinstance(position, (int, np.integer)) for position in positions) \
+                and positions[1] == positions[2]:
+            return TradeCube(values, np.asarray(self.cube.years, dtype=object)[positions[0]],
+                             np.asarray(self.cube.countries, dtype=object)[positions[1]])
+        return values
+
+
+def _position(label, labels, index):
+    """
+    Translates a label, label slice or list of labels into a position,
+    a positional slice or a list of positions.
+    """
+    if isinstance(label, slice):
+        start = 0 if label.start is None else index[label.start]
+        stop = len(labels) if label.stop is None else index[label.stop]+1
+        return slice(start, stop, label.step)
+    if isinstance(label, (list, np.ndarray, pd.Index)):
+        return [index[item] for item in label]
+    return index[label]
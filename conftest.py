@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the offline tests of the acquisition layer.
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def local_data():
+    # the GHG and export indicators of three countries, 2010-2016, in the
+    # layout of the World Bank API (years as strings), with gaps so the
+    # latest year differs
+    countries = ['Aland', 'Borduria', 'Carpania']
+    years = [str(year) for year in range(2010, 2017)]
+    index = pd.MultiIndex.from_product([countries, years], names=['country', 'date'])
+    values = np.arange(len(index)*2, dtype=np.float64).reshape(len(index), 2)
+    data = pd.DataFrame(values, index=index, columns=['EN.ATM.GHGT.KT.CE', 'NE.EXP.GNFS.ZS'])
+    data.loc[('Aland', '2016'), 'EN.ATM.GHGT.KT.CE'] = np.nan
+    data.loc[('Borduria', '2015'):('Borduria', '2016'), 'NE.EXP.GNFS.ZS'] = np.nan
+    data.loc['Carpania', 'NE.EXP.GNFS.ZS'] = np.nan
+    return data
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline checks of the World Bank acquisition layer, with LocalWBSource as
+stand-in for the API. Run with: python -m pytest test_acquisition.py
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+import DataSources
+
+from DataCache import ReadExcelCached, WBCache
+from DataFunctions import (POPULATION_BUCKETS, FillByIncomeWB, FillByRegionAndIncomeWB, FillByRegionWB, FillWithMeanWB,
+                           GetDataWB, PopulationRangesWB)
+from DataSources import CallWithRetry, FetchRangeWB, LocalWBSource
+from Imputation import DEFAULT_LEVELS, LEVEL_LABELS, ImputeByGroups, SplitSourceColumns, WithSourceColumns
+
+
+INDICATORS = {'EN.ATM.GHGT.KT.CE': 'GHG', 'NE.EXP.GNFS.ZS': 'Exports'}
+
+
+def assert_same_data(batched, per_year):
+    # the per-year loop marks missing sources with None, the batched path
+    # with NaN
+    per_year = per_year.sort_index()[batched.columns]
+    batched = batched.sort_index()
+    pd.testing.assert_frame_equal(batched.astype(object).where(batched.notnull(), None),
+                                  per_year.astype(object).where(per_year.notnull(), None))
+
+
+def test_retry_on_connection_error(local_data):
+    source = LocalWBSource(local_data, failures=2)
+    dataframe = FetchRangeWB(INDICATORS, 2014, 2016, source, backoff=0.001)
+    assert len(source.calls) == 3
+    assert dataframe.shape == (9, 2)
+
+
+def test_no_retry_on_type_error():
+    calls = []
+
+    def wrong_call():
+        calls.append(1)
+        raise TypeError("get_dataframe() got an unexpected keyword argument 'data_date'")
+
+    with pytest.raises(TypeError):
+        CallWithRetry(wrong_call, backoff=10.0)
+    assert len(calls) == 1
+
+
+def test_batched_equals_per_year(local_data):
+    source = LocalWBSource(local_data)
+    batched = GetDataWB(INDICATORS, 2011, 2016, source=source)
+    per_year = GetDataWB(INDICATORS, 2011, 2016, source=source, batched=False)
+    assert_same_data(batched, per_year)
+    assert batched.loc['Aland', 'GHG source'] == 'WB data 2015'
+    assert batched.loc['Borduria', 'Exports source'] == 'WB data 2014'
+
+
+def test_year1_equals_year2(local_data):
+    source = LocalWBSource(local_data)
+    batched = GetDataWB(INDICATORS, 2015, 2015, source=source)
+    per_year = GetDataWB(INDICATORS, 2015, 2015, source=source, batched=False)
+    assert len(batched) == 3
+    assert_same_data(batched, per_year)
+
+
+class UnsafeSource(LocalWBSource):
+    # raises when two threads are in get_dataframe at once, like the shelve
+    # cache of the module-level wbdata client can
+    def __init__(self, data):
+        LocalWBSource.__init__(self, data)
+        self.active = 0
+
+    def get_dataframe(self, *args, **kwargs):
+        self.active += 1
+        try:
+            if self.active > 1:
+                raise RuntimeError('UnsafeSource: concurrent request')
+            time.sleep(0.01)
+            return LocalWBSource.get_dataframe(self, *args, **kwargs)
+        finally:
+            self.active -= 1
+
+
+def test_wbdata_module_is_serialized(monkeypatch, tmp_path, local_data):
+    indicators = dict(INDICATORS, **{'EXTRA.%d' % i: 'Extra %d' % i for i in range(6)})
+    data = local_data
+    for i in range(6):
+        data['EXTRA.%d' % i] = float(i)
+    expected = FetchRangeWB(indicators, 2014, 2016, LocalWBSource(data))
+    options = dict(workers=4, rate_limiter=DataSources.RateLimiter(rate=1e6))
+
+    # a source that is not thread-safe itself fails with several workers
+    with pytest.raises(RuntimeError):
+        FetchRangeWB(indicators, 2014, 2016, UnsafeSource(data), **options)
+
+    # the wbdata module is used by one thread at a time, also by a cache
+    unsafe = UnsafeSource(data)
+    monkeypatch.setattr(DataSources, 'wbdata', unsafe)
+    pd.testing.assert_frame_equal(FetchRangeWB(indicators, 2014, 2016, **options), expected)
+    pd.testing.assert_frame_equal(FetchRangeWB(indicators, 2014, 2016, unsafe, **options), expected)
+    cache = WBCache(str(tmp_path))
+    pd.testing.assert_frame_equal(FetchRangeWB(indicators, 2014, 2016, cache, **options).sort_index(),
+                                  expected.sort_index())
+    assert len(unsafe.calls) == 3*len(indicators)
+
+
+def test_cache_hit_and_miss(tmp_path, local_data):
+    source = LocalWBSource(local_data)
+    cache = WBCache(str(tmp_path), source=source)
+    first = FetchRangeWB(INDICATORS, 2014, 2016, cache)
+    assert (cache.hits, cache.misses, len(source.calls)) == (0, 6, 1)
+    second = FetchRangeWB(INDICATORS, 2014, 2016, cache)
+    assert (cache.hits, cache.misses, len(source.calls)) == (6, 6, 1)
+    pd.testing.assert_frame_equal(first.sort_index(), second.sort_index())
+
+    # a wider range and another batching only fetch the missing year
+    wider = FetchRangeWB(INDICATORS, 2013, 2016, cache, workers=2)
+    assert (cache.hits, cache.misses, len(source.calls)) == (12, 8, 3)
+    assert all(calls[1][0].year == calls[1][1].year == 2013 for calls in source.calls[1:])
+    pd.testing.assert_frame_equal(wider.sort_index(),
+                                  FetchRangeWB(INDICATORS, 2013, 2016, LocalWBSource(local_data)).sort_index())
+
+
+def test_excel_cache_keyed_on_prepare(tmp_path):
+    workbook = str(tmp_path/'sheet.xlsx')
+    pd.DataFrame({'a': [1.0, 2.0], 'b': [3.0, 4.0]}).to_excel(workbook, index=False)
+
+    def prepare(dataframe):
+        return dataframe*2
+
+    first = ReadExcelCached(workbook, cache_dir=str(tmp_path/'cache'), prepare=prepare)
+    assert first['a'].tolist() == [2.0, 4.0]
+
+    # an edited prepare step with the same name parses the sheet again
+    def edited(dataframe):
+        return dataframe*3
+    edited.__qualname__ = prepare.__qualname__
+    second = ReadExcelCached(workbook, cache_dir=str(tmp_path/'cache'), prepare=edited)
+    assert second['a'].tolist() == [3.0, 6.0]
+    assert ReadExcelCached(workbook, cache_dir=str(tmp_path/'cache'), prepare=prepare).equals(first)
+
+
+def population_frame():
+    # A: consistent; B: male and female add up to more than the total; C: the
+    # ranges add up to more than the total; D: no age data; E: the sexes are
+    # 5000 over the total
+    countries = ['A', 'B', 'C', 'D', 'E']
+    frame = pd.DataFrame({'Population, total': 1e6, 'Population, male': 5e5, 'Population, female': 5e5,
+                          'Population, ages 0-14, total': 2e5,
+                          'Population ages 65 and above (% of total)': 10.0}, index=countries)
+    for bucket in ('Population15to34', 'Population35to64'):
+        for column in POPULATION_BUCKETS[bucket]['male']+POPULATION_BUCKETS[bucket]['female']:
+            frame[column] = 5.0
+    frame.loc['B', ['Population, male', 'Population, female']] = 6e5
+    frame.loc['C', 'Population, ages 0-14, total'] = 5e5
+    frame.loc['C', 'Population ages 65 and above (% of total)'] = 30.0
+    frame.loc['D', frame.columns[3:]] = np.nan
+    frame.loc['E', 'Population, male'] = 5.05e5
+    return frame
+
+
+def test_population_ranges():
+    tabnames = {}
+    ranges, tabnames, report = PopulationRangesWB(population_frame(), tabnames, report=True)
+    expected = pd.DataFrame({'Population0to14': [2e5, 2e5, 5e5/1.3, np.nan, 2e5],
+                             'Population15to34': [2e5, 2e5, 2e5, 0, 2.01e5],
+                             'Population35to64': [3e5, 3e5, 3e5, 0, 3.015e5],
+                             'PopulationOver65': [1e5, 1e5, 3e5/1.3, np.nan, 1e5]}, index=ranges.index)
+    pd.testing.assert_frame_equal(ranges[list(expected.columns)], expected)
+    assert ranges.loc['B', ['Population, male', 'Population, female']].tolist() == [5e5, 5e5]
+    assert list(ranges.columns) == ['Population, total', 'Population, male', 'Population, female']+list(expected.columns)
+    assert set(tabnames) == set(expected.columns)
+    assert report['Sexes rescaled'].tolist() == [False, True, False, False, False]
+    assert report['Ranges rescaled'].tolist() == [False, False, True, False, False]
+    # only the rescalable ranges of C are scaled down, so C stays over the total
+    np.testing.assert_allclose(report['Difference'], [-2e5, -2e5, 8e5/1.3+5e5-1e6, -1e6, -1.975e5])
+
+    # a smaller tolerance also rescales the sexes of E
+    ranges, _, report = PopulationRangesWB(population_frame(), {}, tolerance=1000, report=True)
+    assert report['Sexes rescaled'].tolist() == [False, True, False, False, True]
+    assert ranges.loc['E', 'Population, male']+ranges.loc['E', 'Population, female'] == pytest.approx(1e6)
+    assert ranges.loc['E', 'Population15to34'] == pytest.approx(2e5)
+
+
+def imputation_frame():
+    # every level of the cascade is needed for some value; the region means
+    # include the values filled by region and income before
+    frame = pd.DataFrame({'Region': ['N', 'N', 'N', 'N', 'S', 'S', 'S', 'W'],
+                          'IncomeGroup': ['H', 'H', 'M', 'L', 'H', 'H', 'L', 'X'],
+                          'GHG': [1, np.nan, 4, np.nan, 6, np.nan, np.nan, np.nan],
+                          'Exports': [10, 20, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan]},
+                         index=['a', 'x', 'b', 'c', 'd', 'e', 'f', 'h'])
+    for column in ('GHG', 'Exports'):
+        frame[column+' source'] = np.where(frame[column].notnull(), 'WB data 2015', None)
+    return frame
+
+
+def test_imputation_cascade_matches_chained_calls():
+    frame = imputation_frame()
+    filled, provenance = ImputeByGroups(frame)
+
+    # the chained calls of the notebooks, with source columns and with a
+    # provenance dataframe
+    chained = FillWithMeanWB(FillByIncomeWB(FillByRegionWB(FillByRegionAndIncomeWB(frame))))
+    pd.testing.assert_frame_equal(chained[frame.columns], WithSourceColumns(filled, provenance)[frame.columns])
+    values, chained_provenance = SplitSourceColumns(frame)
+    for step in (FillByRegionAndIncomeWB, FillByRegionWB, FillByIncomeWB, FillWithMeanWB):
+        values, chained_provenance = step(values, provenance=chained_provenance)
+    pd.testing.assert_frame_equal(values, filled.drop(['GHG source', 'Exports source'], axis=1))
+    assert (chained_provenance.astype(str) == provenance.astype(str)).all().all()
+
+    # a plain loop over the levels, filling with the means so far
+    expected = frame[['GHG', 'Exports']].copy()
+    for level in DEFAULT_LEVELS:
+        for column in expected.columns:
+            means = expected[column].groupby([frame[key] for key in level]).transform('mean') if level \
+                else expected[column].mean()
+            expected[column] = expected[column].fillna(means)
+    pd.testing.assert_frame_equal(filled[['GHG', 'Exports']], expected)
+    assert filled.loc['c', 'GHG'] == 2.0 and filled.loc['f', 'Exports'] == 15.0
+
+    labels = {key: LEVEL_LABELS[tuple(level)] for key, level in zip('RrIM', DEFAULT_LEVELS)}
+    labels['W'] = 'WB data 2015'
+    expected_labels = pd.DataFrame({'GHG': list('WRWrWRrM'), 'Exports': list('WWrrIIIM')}, index=frame.index)
+    assert (provenance.astype(str) == expected_labels.replace(labels)).all().all()
+
+
+def test_provenance_after_reordering_join(local_data):
+    source = LocalWBSource(local_data)
+    values, provenance = GetDataWB(INDICATORS, 2011, 2016, source=source, provenance=True)
+    # reversed order and one extra country compared to the provenance
+    regions = pd.DataFrame({'Region': ['North', 'North', 'South', 'South'],
+                            'IncomeGroup': ['High', 'High', 'Low', 'Low']},
+                           index=['Zembla', 'Carpania', 'Borduria', 'Aland'])
+    frame = regions.join(values)
+
+    filled, filled_provenance = FillByRegionAndIncomeWB(frame, provenance=provenance)
+    assert list(filled_provenance.index) == list(frame.index)
+    assert filled_provenance.loc['Aland', 'GHG'] == 'WB data 2015'
+    assert filled_provenance.loc['Borduria', 'GHG'] == 'WB data 2016'
+    assert filled_provenance.loc['Borduria', 'Exports'] == 'WB data 2014'
+    assert pd.isnull(filled_provenance.loc['Carpania', 'Exports'])
+    assert filled_provenance.loc['Zembla', 'GHG'] == 'Estimation based on region and income'
+    assert filled.loc['Zembla', 'GHG'] == values.loc['Carpania', 'GHG']
+
+
+def test_provenance_without_a_column(local_data):
+    source = LocalWBSource(local_data)
+    values, provenance = GetDataWB(INDICATORS, 2011, 2016, source=source, provenance=True)
+    regions = pd.DataFrame({'Region': ['North', 'North', 'North'],
+                            'IncomeGroup': ['High', 'High', 'High'],
+                            'Population': [1.0, np.nan, 3.0]},
+                           index=['Aland', 'Borduria', 'Carpania'])
+    frame = regions.join(values)
+
+    filled, filled_provenance = FillByRegionAndIncomeWB(frame, provenance=provenance)
+    assert filled.loc['Borduria', 'Population'] == 2.0
+    assert filled_provenance.loc['Borduria', 'Population'] == 'Estimation based on region and income'
+    assert pd.isnull(filled_provenance.loc['Aland', 'Population'])
+    assert filled_provenance.loc['Aland', 'GHG'] == 'WB data 2015'
+
+
+def test_retry_only_transport_errors():
+    def failing(error):
+        calls = []
+
+        def function():
+            calls.append(1)
+            raise error
+        return function, calls
+
+    def http_error(status):
+        response = requests.Response()
+        response.status_code = status
+        return requests.HTTPError('%d error' % status, response=response)
+
+    for error, attempts in ((requests.ConnectionError('refused'), 3),
+                            (requests.Timeout('slow'), 3),
+                            (http_error(503), 3),
+                            (http_error(400), 1),
+                            (PermissionError('cache'), 1),
+                            (FileNotFoundError('cache'), 1)):
+        function, calls = failing(error)
+        with pytest.raises(type(error)):
+            CallWithRetry(function, retries=2, backoff=0.001)
+        assert len(calls) == attempts, error
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline checks of the asynchronous sources, against the local HTTP stand-in
+of the World Bank API and the Nominatim geocoder. Run with:
+python -m pytest test_async_sources.py
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import asyncio
+
+import aiohttp
+import numpy as np
+import pytest
+
+from AsyncSources import OpenSession, fetch_wb, fetch_wb_indicator, geocode_many
+from DataSources import LocalHTTPStandIn
+from Geocoding import GeocodeCache
+
+
+INDICATORS = {'EN.ATM.GHGT.KT.CE': 'GHG', 'NE.EXP.GNFS.ZS': 'Exports'}
+PLACES = {'Aland': (60.2, 20.0), 'Borduria': (47.5, 19.0)}
+
+
+def run(coroutine_function, *args, **kwargs):
+    async def main():
+        async with OpenSession(rates={}) as session:
+            return await coroutine_function(session, *args, **kwargs)
+    return asyncio.run(main())
+
+
+def test_fetch_wb(local_data):
+    with LocalHTTPStandIn(wb_data=local_data) as stand_in:
+        dataframe = run(fetch_wb, INDICATORS, 2012, 2016, base_url=stand_in.wb_url)
+    assert list(dataframe.columns) == ['GHG', 'Exports']
+    assert len(dataframe) == 15
+    assert np.isnan(dataframe.loc[('Aland', 2016), 'GHG'])
+    assert np.isnan(dataframe.loc[('Borduria', 2015), 'Exports'])
+    assert dataframe.loc[('Carpania', 2013), 'GHG'] == local_data.loc[('Carpania', '2013'), 'EN.ATM.GHGT.KT.CE']
+
+
+def test_pagination(local_data):
+    with LocalHTTPStandIn(wb_data=local_data) as stand_in:
+        series = run(fetch_wb_indicator, 'NE.EXP.GNFS.ZS', 2010, 2016, base_url=stand_in.wb_url, per_page=4)
+        pages = len(stand_in.requests)
+    assert pages == 6
+    assert len(series) == 21
+    assert not series.index.duplicated().any()
+
+
+def test_error_payload(local_data):
+    with LocalHTTPStandIn(wb_data=local_data) as stand_in:
+        with pytest.raises(RuntimeError, match='NOT.AN.INDICATOR'):
+            run(fetch_wb_indicator, 'NOT.AN.INDICATOR', 2010, 2016, base_url=stand_in.wb_url)
+
+
+def test_retry_on_server_error(local_data):
+    with LocalHTTPStandIn(wb_data=local_data, failures=2) as stand_in:
+        series = run(fetch_wb_indicator, 'NE.EXP.GNFS.ZS', 2015, 2016, base_url=stand_in.wb_url)
+        assert len(stand_in.requests) == 3
+    assert len(series) == 6
+
+
+def test_no_retry_on_client_error(local_data):
+    with LocalHTTPStandIn(wb_data=local_data) as stand_in:
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            run(fetch_wb_indicator, 'NE.EXP.GNFS.ZS', 2015, 2016, base_url=stand_in.url+'/unknown')
+        assert error.value.status == 404
+        assert len(stand_in.requests) == 1
+
+
+def test_geocode_many_deduplicates():
+    with LocalHTTPStandIn(places=PLACES) as stand_in:
+        coordinates = run(geocode_many, ['Aland', 'Borduria', 'Aland', 'Atlantis', 'Atlantis'],
+                          base_url=stand_in.geocode_url)
+        assert len(stand_in.requests) == 3
+    assert coordinates == {'Aland': (60.2, 20.0), 'Borduria': (47.5, 19.0), 'Atlantis': None}
+
+
+def test_geocode_many_cache(tmp_path):
+    cache = GeocodeCache(str(tmp_path / 'geocode.sqlite'))
+    with LocalHTTPStandIn(places=PLACES) as stand_in:
+        first = run(geocode_many, ['Aland', 'Atlantis'], base_url=stand_in.geocode_url, cache=cache)
+        requests = len(stand_in.requests)
+        second = run(geocode_many, ['Atlantis', 'Aland', 'Borduria'], base_url=stand_in.geocode_url,
+                     cache=cache)
+        assert requests == 2
+        assert len(stand_in.requests) == 3
+    assert first == {'Aland': (60.2, 20.0), 'Atlantis': None}
+    assert second == {'Atlantis': None, 'Aland': (60.2, 20.0), 'Borduria': (47.5, 19.0)}
+    assert len(cache) == 3
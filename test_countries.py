@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks of the country matching: the country registry and its readers, and
+the keyed join of MergeDataFrames against the loops of the original code.
+Run with: python -m pytest test_countries.py
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import struct
+
+import numpy as np
+import pandas as pd
+
+import ProjectFunctions as pf
+from CountryRegistry import (KNOWN_ALIASES, OUTDATED_CODES, BuildCountryRegistry, CountryRegistry,
+                             ReadBordersTable, ReadWITSReporters)
+
+
+WB_CODES = {'Aland': 'ALA', 'Borduria': 'BOR', 'Serbia': 'SRB', 'Sudan': 'SDN', 'Carpania': 'CAR'}
+
+# an alias of Borduria with the same code, an outdated code of Serbia that
+# is converted by name, and a name that matches nothing
+TRADE_CODES = {'Aland': 'ALA', 'Borduria Rep.': 'BOR', 'Serbia, FR(Serbia/Montenegro)': 'SER', 'Sudan': 'SUD',
+               'Atlantis': 'ATL'}
+CONVERSION = {'Serbia, FR(Serbia/Montenegro)': 'SRB'}
+
+
+def baseline_matches(wb_names, trade_names, country_dic_wb, country_dic_trade, conversion_dic):
+    # the matching of the original triple loop of MergeDataFrames: the last
+    # World Bank country that matches on name, code or converted code wins
+    matches = {}
+    for index in trade_names:
+        for index2 in wb_names:
+            if index == index2 or country_dic_trade[index] == country_dic_wb[index2]:
+                matches[index] = index2
+            elif index in conversion_dic and conversion_dic[index] == country_dic_wb[index2]:
+                matches[index] = index2
+    return matches
+
+
+def test_merge_matches_baseline():
+    wb = pd.DataFrame({'GHG': [1.0, 2.0, 3.0, 4.0, 5.0]}, index=list(WB_CODES))
+    trade = pd.DataFrame({'Exports': np.arange(5.0)}, index=list(TRADE_CODES))
+    merged, unmatched = pf.MergeDataFrames(wb, trade, WB_CODES, TRADE_CODES, CONVERSION, return_unmatched=True)
+
+    expected = baseline_matches(wb.index, trade.index, WB_CODES, TRADE_CODES, CONVERSION)
+    assert expected == {'Aland': 'Aland', 'Borduria Rep.': 'Borduria', 'Serbia, FR(Serbia/Montenegro)': 'Serbia',
+                        'Sudan': 'Sudan'}
+    matched = {name: wb.index[wb['GHG'] == value][0] for name, value in merged['GHG'].dropna().items()}
+    assert matched == expected
+    assert unmatched == [name for name in trade.index if name not in expected] == ['Atlantis']
+    assert list(merged.index) == list(trade.index)
+    assert merged['Exports'].tolist() == trade['Exports'].tolist()
+
+
+def write_dbf(file, fields, records):
+    # a dBASE III table like the one of the TM_WORLD_BORDERS shapefile;
+    # fields are (name, type, length) and records (deleted, values)
+    header_length = 32+32*len(fields)+1
+    record_length = 1+sum(length for name, field_type, length in fields)
+    content = struct.pack('<B3BIHH20x', 3, 117, 1, 1, len(records), header_length, record_length)
+    for name, field_type, length in fields:
+        content += struct.pack('<11sc4xBB14x', name.encode('ascii'), field_type.encode('ascii'), length, 0)
+    content += b'\r'
+    for deleted, values in records:
+        content += b'*' if deleted else b' '
+        for (name, field_type, length), value in zip(fields, values):
+            value = str(value)
+            content += (value.rjust(length) if field_type == 'N' else value.ljust(length)).encode('latin-1')
+    with open(file, 'wb') as dbf:
+        dbf.write(content+b'\x1a')
+
+
+def borders_file(tmp_path):
+    file = str(tmp_path/'borders.dbf')
+    write_dbf(file, [('ISO2', 'C', 2), ('ISO3', 'C', 3), ('NAME', 'C', 20), ('LAT', 'N', 8)],
+              [(False, ['RS', 'SRB', 'Serbia', 44.032]),
+               (True, ['XX', 'XXX', 'Deleted', 0]),
+               (False, ['CI', 'CIV', "C\xf4te d'Ivoire", 7.632]),
+               (False, ['TL', 'TLS', 'Timor-Leste', '']),
+               (False, ['SD', 'SDN', 'Sudan', 15.0])])
+    return file
+
+
+def test_read_borders_table(tmp_path):
+    borders = ReadBordersTable(borders_file(tmp_path))
+    assert list(borders.columns) == ['ISO2', 'ISO3', 'NAME', 'LAT']
+    assert borders['ISO3'].tolist() == ['SRB', 'CIV', 'TLS', 'SDN']
+    assert borders['NAME'].tolist() == ['Serbia', "C\xf4te d'Ivoire", 'Timor-Leste', 'Sudan']
+    np.testing.assert_array_equal(borders['LAT'], [44.032, 7.632, np.nan, 15.0])
+
+
+def test_read_wits_reporters(tmp_path):
+    header = 'Reporter,Partner,Product categories,Indicator Type,Indicator,2015\n'
+    (tmp_path/'en_SER_AllYears_WITS_Trade_Summary.CSV').write_text(
+        header+'"Serbia, FR(Serbia/Montenegro)",...,...,Export,Exports,1.0\n', encoding='ISO-8859-1')
+    (tmp_path/'en_EUN_AllYears_WITS_Trade_Summary.CSV').write_text(header, encoding='ISO-8859-1')
+    (tmp_path/'Readme.txt').write_text('not a summary')
+    assert ReadWITSReporters(str(tmp_path)) == {'SER': 'Serbia, FR(Serbia/Montenegro)'}
+
+
+def wits_registry(tmp_path):
+    # WITS reporters with outdated codes, an aggregate and blank names
+    trade_data = pd.DataFrame({'ReporterISO3': ['SER', 'SUD', 'MNT', 'TMP', 'WLD', 'EUN', 'OAS'],
+                               'ReporterName': ['Serbia, FR(Serbia/Montenegro)', 'Sudan', 'Montenegro',
+                                                'East Timor', 'World', '', np.nan]})
+    return BuildCountryRegistry(trade_data=trade_data, borders_file=borders_file(tmp_path))
+
+
+def test_outdated_codes_and_aliases(tmp_path):
+    registry = wits_registry(tmp_path)
+    for code, iso3 in OUTDATED_CODES.items():
+        assert registry.resolve(code) == iso3
+        assert registry.resolve(code.lower()) == iso3
+    for alias, iso3 in KNOWN_ALIASES.items():
+        assert registry.resolve(alias) == iso3
+    assert registry.resolve('Serbia, FR(Serbia/Montenegro)') == 'SRB'
+    assert registry.resolve('  serbia ') == registry.resolve('RS') == 'SRB'
+    assert registry.resolve('East   Timor') == registry.resolve('timor-leste') == 'TLS'
+    assert registry.resolve('Atlantis', default='?') == '?'
+    # the first registered name is the canonical name; outdated codes are
+    # registered under the current one
+    assert registry.name('SRB') == 'Serbia, FR(Serbia/Montenegro)'
+    assert registry.name('MNE') == 'Montenegro'
+    assert 'SER' not in registry.names
+    assert registry.resolve_many(['SUD', 'Sudan', 'SD', 'Atlantis']).tolist() == ['SDN', 'SDN', 'SDN', np.nan]
+
+
+def test_blank_and_aggregate_names(tmp_path):
+    registry = wits_registry(tmp_path)
+    # the aggregates keep their own code; blank names are no aliases
+    assert registry.resolve('World') == registry.resolve('WLD') == 'WLD'
+    assert registry.resolve('EUN') == 'EUN' and registry.name('EUN') is None
+    assert registry.resolve('OAS') == 'OAS' and registry.name('OAS') is None
+    assert registry.resolve('') is None and registry.resolve('  ') is None and registry.resolve(np.nan) is None
+    assert '' not in registry.aliases and 'nan' not in registry.aliases
+    assert registry.canonical_names(['SER', 'Europe & Central Asia']).tolist() == \
+        ['Serbia, FR(Serbia/Montenegro)', 'Europe & Central Asia']
+
+    empty = CountryRegistry()
+    empty.add('  ', 'Nowhere')
+    assert len(empty) == 0 and not empty.aliases
+
+
+def test_resolve_keys_with_registry(tmp_path):
+    # outdated codes of the dictionaries are normalized by the registry, and
+    # names that are not in the dictionaries are looked up in it
+    registry = wits_registry(tmp_path)
+    codes = pf.ResolveCountryKeys(['East Timor', 'Serbia', 'Sudan', 'Atlantis'],
+                                  {'East Timor': 'TMP', 'Serbia': 'SER'}, registry=registry)
+    assert codes.tolist() == ['TLS', 'SRB', 'SDN', np.nan]
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks of the indexed IEA extractor against the loops of the original
+CollectDataYearEIA and FillWithPreviousYearsEIA, on a small time series
+sheet. Run with: python -m pytest test_iea.py
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from DataFunctions import CoerceYearsEIA, CollectDataYearEIA, FillWithPreviousYearsEIA
+from IEAIndex import IEAIndex
+
+
+YEARS = list(range(2010, 2015))
+
+
+@pytest.fixture(scope='module')
+def sheet():
+    # two indicators for three countries and a region, with the IEA
+    # placeholders and gaps of different lengths
+    rows = [['Coal', 'Production', 'Aland', 1, 2, '..', 4, '..'],
+            ['Coal', 'Production', 'Borduria', 5, '..', '..', '..', '..'],
+            ['Coal', 'Production', 'World', 9, 9, 9, 9, 9],
+            ['Oil', 'Imports', 'Aland', 'x', 'x', 'x', 'x', 'x'],
+            ['Oil', 'Imports', 'Borduria', 7, 8, 'x', '..', 10],
+            ['Oil', 'Imports', 'Carpania', '..', 3, '..', '..', '..'],
+            ['Gas', 'Imports', 'Aland', 1, 1, 1, 1, 1]]
+    return pd.DataFrame(rows, columns=['Product', 'Flow', 'Country']+YEARS)
+
+
+@pytest.fixture(scope='module')
+def data_needed():
+    return pd.DataFrame([['Coal', 'Production', 'CoalProduction'], ['Oil', 'Imports', 'OilImports']])
+
+
+@pytest.fixture(scope='module')
+def countries():
+    # Dystopia is not in the IEA data
+    return pd.DataFrame({'Region': ['R1', 'R1', 'R2', 'R2']}, index=['Aland', 'Borduria', 'Carpania', 'Dystopia'])
+
+
+def baseline_year(data, data_needed, countries, year):
+    # the loops of the original CollectDataYearEIA
+    filled = pd.DataFrame(index=countries.index)
+    for i in data_needed.index:
+        df = data.loc[(data['Product'] == data_needed[0][i]) & (data['Flow'] == data_needed[1][i])]
+        df = df.set_index('Country')
+        column_name = data_needed[2][i]
+        filled[column_name] = None
+        for index in df.index:
+            for index2 in countries.index:
+                if index == index2:
+                    filled.loc[index2, column_name] = df[year][index]
+    return filled
+
+
+def baseline_fill(dataframe, data, data_needed, countries, year1, year2):
+    # the original FillWithPreviousYearsEIA: one pass per year
+    df_filled = dataframe
+    for year in range(year2, year1, -1):
+        df_filled = df_filled.combine_first(baseline_year(data, data_needed, countries, year))
+    return df_filled
+
+
+@pytest.mark.parametrize('year', YEARS)
+def test_collect_matches_baseline(sheet, data_needed, countries, year):
+    # the original code took the placeholders as values; GetDataFromExcelEIA
+    # now turns them into NaN first, so the baseline gets the coerced sheet
+    data = CoerceYearsEIA(sheet)
+    expected = baseline_year(data, data_needed, countries, year).astype(np.float64)
+    collected = CollectDataYearEIA(data, data_needed, countries, year=year)
+    assert list(collected.columns) == ['Region', 'CoalProduction', 'OilImports']
+    pd.testing.assert_frame_equal(collected[expected.columns], expected)
+
+
+@pytest.mark.parametrize('year1,year2', [(2009, 2014), (2011, 2014), (2012, 2013), (2013, 2014)])
+def test_fill_matches_baseline(sheet, data_needed, countries, year1, year2):
+    data = CoerceYearsEIA(sheet)
+    collected = CollectDataYearEIA(data, data_needed, countries, year=year2)
+    expected = baseline_fill(baseline_year(data, data_needed, countries, year2), data, data_needed, countries,
+                             max(year1, YEARS[0]-1), year2).astype(np.float64)
+    filled = FillWithPreviousYearsEIA(collected, data, data_needed, countries, year1=year1, year2=year2)
+    pd.testing.assert_frame_equal(filled[expected.columns], expected)
+
+
+def test_extract_years(sheet, data_needed, countries):
+    index = IEAIndex.from_frame(CoerceYearsEIA(sheet))
+    values, years = index.extract(data_needed, countries, year=2014, first_year=2011, return_years=True)
+    expected = pd.DataFrame({'CoalProduction': [4, np.nan, np.nan, np.nan], 'OilImports': [np.nan, 10, 3, np.nan]},
+                            index=countries.index, dtype=np.float64)
+    pd.testing.assert_frame_equal(values, expected)
+    expected = pd.DataFrame({'CoalProduction': [2013, np.nan, np.nan, np.nan],
+                             'OilImports': [np.nan, 2014, 2011, np.nan]}, index=countries.index, dtype=np.float64)
+    pd.testing.assert_frame_equal(years, expected)
+    # years of the range beyond the sheet are skipped
+    pd.testing.assert_frame_equal(index.extract(data_needed, countries, year=2016, first_year=2011), values)
+
+
+def test_missing_range(sheet, data_needed, countries):
+    index = IEAIndex.from_frame(CoerceYearsEIA(sheet))
+    with pytest.raises(KeyError, match='2016-2018.*2010-2014'):
+        index.extract(data_needed, countries, year=2018, first_year=2016)
+    with pytest.raises(KeyError):
+        CollectDataYearEIA(index, data_needed, countries, year=2015)
+    with pytest.raises(KeyError):
+        FillWithPreviousYearsEIA(countries, index, data_needed, countries, year1=2000, year2=2009)
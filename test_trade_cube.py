@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks of the TradeCube selections and conversions: scalars and slices are
+views of the cube, lists of labels are copies. Run with:
+python -m pytest test_trade_cube.py
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from TradeCube import TradeCube
+
+
+@pytest.fixture
+def cube():
+    values = np.arange(3*4*4, dtype=np.float64).reshape(3, 4, 4)
+    return TradeCube(values, [2012, 2013, 2014], ['A', 'B', 'C', 'D'])
+
+
+@pytest.mark.parametrize('key,expected', [(2013, np.s_[1]),
+                                          ((2013, 'B'), np.s_[1, 1]),
+                                          ((2013, 'B', 'C'), np.s_[1, 1, 2]),
+                                          ((2013, slice('B', 'D')), np.s_[1, 1:4]),
+                                          ((slice(None), 'A', slice('B', 'C')), np.s_[:, 0, 1:3])])
+def test_loc_views(cube, key, expected):
+    selection = cube.loc[key]
+    np.testing.assert_array_equal(selection, cube.values[expected])
+    if np.ndim(selection):
+        assert np.shares_memory(selection, cube.values)
+        # writing into the view changes the cube
+        selection[...] = -1
+        assert (cube.values[expected] == -1).all()
+
+
+def test_loc_sub_cube_is_view(cube):
+    sub = cube.loc[2013:2014, 'B':'D', 'B':'D']
+    assert isinstance(sub, TradeCube)
+    assert sub.years == [2013, 2014] and sub.countries == ['B', 'C', 'D']
+    assert np.shares_memory(sub.values, cube.values)
+    np.testing.assert_array_equal(sub.values, cube.values[1:3, 1:4, 1:4])
+
+
+def test_loc_lists_are_copies(cube):
+    selection = cube.loc[[2014, 2012], ['D', 'A']]
+    np.testing.assert_array_equal(selection, cube.values[[2, 0]][:, [3, 0]])
+    assert not np.shares_memory(selection, cube.values)
+
+    # lists select the outer product of the labels, in their order
+    sub = cube.loc[[2012], ['C', 'A'], ['C', 'A']]
+    assert isinstance(sub, TradeCube) and sub.countries == ['C', 'A']
+    np.testing.assert_array_equal(sub.values[0], [[cube.values[0, 2, 2], cube.values[0, 2, 0]],
+                                                 [cube.values[0, 0, 2], cube.values[0, 0, 0]]])
+    assert not np.shares_memory(sub.values, cube.values)
+    sub.values[...] = -1
+    assert (cube.values >= 0).all()
+
+    with pytest.raises(KeyError):
+        cube.loc[2015]
+    with pytest.raises(KeyError):
+        cube.loc[2012, ['A', 'E']]
+
+
+def test_to_frame_is_view(cube):
+    frame = cube.to_frame()
+    assert np.shares_memory(frame.to_numpy(), cube.values)
+    assert list(frame.index.names) == ['year', 'exporter']
+    assert frame.loc[(2013, 'B'), 'C'] == cube.loc[2013, 'B', 'C']
+
+    round_trip = TradeCube.from_frame(frame)
+    assert round_trip.years == cube.years and round_trip.countries == cube.countries
+    np.testing.assert_array_equal(round_trip.values, cube.values)
+
+
+def test_from_frame_fills_missing(cube):
+    frame = cube.to_frame().drop(index=(2013, 'C')).astype(object)
+    frame.iloc[0, 1] = None
+    round_trip = TradeCube.from_frame(frame, fill_value=0.0)
+    assert (round_trip.loc[2013, 'C'] == 0).all()
+    assert round_trip.loc[2012, 'A', 'B'] == 0
+    assert round_trip.loc[2014, 'D', 'D'] == cube.loc[2014, 'D', 'D']
+    assert round_trip.values.flags.c_contiguous and round_trip.values.dtype == np.float64
+    pd.testing.assert_index_equal(round_trip.to_frame().columns, pd.Index(['A', 'B', 'C', 'D']))
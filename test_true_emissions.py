@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks of the true emissions engines against the calculation of the
+notebooks (one "Percentage to" and "Emissions to" column per partner), on
+random trade cubes. Run with: python -m pytest test_true_emissions.py
+
+@author: Patrick Steinmann and Stefan Wigman
+"""
+
+import os
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ProjectFunctions as pf
+from CountryRegistry import CountryRegistry
+from DataSources import LocalWBSource
+from Imputation import MakeProvenance
+from TradeCube import SparseTradeCube, TradeCube
+
+
+COLUMNS = ['EmissionForExport', 'EmissionsToCountries', 'NewEmissions', 'EmissionDifference']
+
+# the notebook calculation adds one column at a time, and the Monte Carlo
+# percentiles of countries without trade data are all NaN
+pytestmark = [pytest.mark.filterwarnings('ignore::pandas.errors.PerformanceWarning'),
+              pytest.mark.filterwarnings('ignore:All-NaN slice:RuntimeWarning')]
+
+
+@pytest.fixture(scope='module')
+def trade():
+    rng = np.random.default_rng(6)
+    names = ['C%d' % i for i in range(60)]
+    years = list(range(2010, 2016))
+    values = rng.exponential(1, (len(years), 60, 60))*(rng.random((len(years), 60, 60)) < 0.3)
+    values[:, 7] = 0
+    return TradeCube(values, years, names)
+
+
+@pytest.fixture(scope='module')
+def wb_frame(trade):
+    # five countries without trade data and one without GHG data
+    rng = np.random.default_rng(7)
+    index = trade.countries[:55]+['X1', 'X2', 'X3', 'X4', 'X5']
+    frame = pd.DataFrame({pf.GHG_COLUMN: rng.uniform(1e3, 1e6, 60),
+                          pf.EXPORTS_COLUMN: rng.uniform(5, 80, 60)}, index=index)
+    frame.iloc[3, 0] = np.nan
+    return frame
+
+
+def notebook_true_emissions(trade, wb_frame, year):
+    # the calculation of "True Emissions Analysis - Master.ipynb"
+    names = trade.countries
+    data = wb_frame.join(pd.DataFrame(trade.loc[year], index=names, columns=names))
+    data['SumOfExports'] = data[names].sum(axis=1)
+    for name in names:
+        data['Percentage to '+name] = data[name]/data['SumOfExports']
+    data['EmissionForExport'] = data[pf.GHG_COLUMN]*(data[pf.EXPORTS_COLUMN]/100)
+    for name in names:
+        data['Emissions to '+name] = data['Percentage to '+name]*data['EmissionForExport']
+    received = data[['Emissions to '+name for name in names]].sum(axis=0)
+    received.index = names
+    data['EmissionsToCountries'] = received
+    data['NewEmissions'] = data['EmissionsToCountries']+(1-data[pf.EXPORTS_COLUMN]/100)*data[pf.GHG_COLUMN]
+    data['EmissionDifference'] = data['NewEmissions']-data[pf.GHG_COLUMN]
+    return data
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse', 'frame'])
+def test_compute_true_emissions_matches_notebook(trade, wb_frame, kind):
+    cube = {'dense': trade, 'sparse': SparseTradeCube.from_cube(trade), 'frame': trade.to_frame()}[kind]
+    expected = notebook_true_emissions(trade, wb_frame, 2014)
+    totals = pf.compute_true_emissions(cube, wb_frame, 2014)
+    np.testing.assert_allclose(totals[COLUMNS].to_numpy(), expected[COLUMNS].to_numpy(), rtol=1e-10)
+    assert totals.loc[['X1', 'X5'], 'NewEmissions'].isnull().all()
+
+
+def test_wide_matches_notebook(trade, wb_frame):
+    expected = notebook_true_emissions(trade, wb_frame, 2014)
+    wide = pf.compute_true_emissions(SparseTradeCube.from_cube(trade), wb_frame, 2014, wide=True)
+    emissions = ['Emissions to '+name for name in trade.countries]
+    # exporters without exports: the notebook divides by 0, the engine gives 0
+    rows = expected['SumOfExports'] != 0
+    np.testing.assert_allclose(wide.loc[rows, emissions].to_numpy(), expected.loc[rows, emissions].to_numpy(),
+                               rtol=1e-10)
+
+
+def test_total_is_conserved(trade):
+    # with WB data for every country of the cube, emissions only move; only
+    # the export emissions of a country without exports (C7) are lost
+    rng = np.random.default_rng(9)
+    frame = pd.DataFrame({pf.GHG_COLUMN: rng.uniform(1e3, 1e6, 60),
+                          pf.EXPORTS_COLUMN: rng.uniform(5, 80, 60)}, index=trade.countries)
+    totals = pf.compute_true_emissions(trade, frame, 2013)
+    expected = frame[pf.GHG_COLUMN].sum()-totals.loc['C7', 'EmissionForExport']
+    np.testing.assert_allclose(totals['NewEmissions'].sum(), expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse'])
+def test_panel_matches_years(trade, kind):
+    cube = trade if kind == 'dense' else SparseTradeCube.from_cube(trade)
+    rng = np.random.default_rng(8)
+    countries = trade.countries[:55]+['X1', 'X2']
+    index = pd.MultiIndex.from_product([countries, range(2005, 2016)], names=['country', 'year'])
+    wb_panel = pd.DataFrame({pf.GHG_COLUMN: rng.uniform(1e3, 1e6, len(index)),
+                             pf.EXPORTS_COLUMN: rng.uniform(5, 80, len(index))}, index=index)
+    wb_panel = wb_panel.mask(rng.random(wb_panel.shape) < 0.2)
+
+    panel = pf.compute_true_emissions_panel(cube, wb_panel)
+    assert list(panel.index.get_level_values('year').unique()) == trade.years
+    for year in trade.years:
+        # the latest observation up to the year, like fill_latest
+        earlier = wb_panel[wb_panel.index.get_level_values('year') <= year]
+        snapshot = earlier.sort_index(level=1, ascending=False).groupby(level=0, sort=False).first()
+        expected = pf.compute_true_emissions(cube, snapshot.reindex(countries), year)
+        np.testing.assert_allclose(panel.loc[year].loc[countries, COLUMNS].to_numpy(),
+                                   expected[COLUMNS].to_numpy(), rtol=1e-10)
+
+
+def test_emission_flow_edges():
+    names = ['A', 'B', 'C']
+    emissions = pd.DataFrame([[0, 0.1, 0.1001], [2, 0, 'x'], [np.nan, 5, 0]], index=names,
+                             columns=['Emissions to '+name for name in names])
+    coords = pd.DataFrame({'Longitude': [0.0, 10.0], 'Latitude': [1.0, 11.0]}, index=['A', 'B'])
+    # only transfers above the threshold; non-numeric cells are no transfers
+    edges = pf.EmissionFlowEdges(emissions, coords, threshold=0.1)
+    assert list(zip(edges['exporter'], edges['importer'], edges['emissions'])) == \
+        [('A', 'C', 0.1001), ('B', 'A', 2.0), ('C', 'B', 5.0)]
+    np.testing.assert_array_equal(edges['start_lon'], [0, 10, np.nan])
+    np.testing.assert_array_equal(edges['end_lon'], [np.nan, 0, 10])
+    # the 'to' edges start at the importer
+    edges = pf.EmissionFlowEdges(emissions, coords, direction='to', threshold=0.1)
+    np.testing.assert_array_equal(edges['start_lon'], [np.nan, 0, 10])
+    np.testing.assert_array_equal(edges['end_lon'], [0, 10, np.nan])
+    with pytest.raises(ValueError):
+        pf.EmissionFlowEdges(emissions, coords, direction='both')
+
+
+def test_emission_flow_traces():
+    # classes of a tenth of the largest transfer each, with the upper bound
+    # inclusive; the smallest transfers are in the first class
+    emissions = np.array([10, 9.0001, 9, 5, 1.0001, 1, 0.5, 0, 3])
+    coords = pd.DataFrame({'start_lon': np.arange(9.0), 'start_lat': 0.0, 'end_lon': 1.0, 'end_lat': 2.0,
+                           'emissions': emissions})
+    coords.loc[8, 'end_lat'] = np.nan
+    traces = pf.EmissionFlowTraces(coords, classes=10)
+    assert [trace['line']['width'] for trace in traces] == [0.5, 1.0, 2.5, 4.5, 5.0]
+    assert [trace['opacity'] for trace in traces] == [0.1, 0.2, 0.5, 0.9, 1.0]
+    starts = [trace['lon'][0::3] for trace in traces]
+    assert starts == [[5.0, 6.0, 7.0], [4.0], [3.0], [2.0], [0.0, 1.0]]
+    for trace in traces:
+        assert trace['lon'][2::3] == trace['lat'][2::3] == [None]*(len(trace['lon'])//3)
+        assert trace['lon'][1::3] == [1.0]*(len(trace['lon'])//3)
+    # one trace per class that has transfers, at most classes traces
+    assert len(pf.EmissionFlowTraces(coords, classes=2)) == 2
+    many = pd.DataFrame({'start_lon': 0.0, 'start_lat': 0.0, 'end_lon': 1.0, 'end_lat': 1.0,
+                         'emissions': np.linspace(0.01, 1, 1000)})
+    assert len(pf.EmissionFlowTraces(many, classes=10)) == 10
+    assert pf.EmissionFlowTraces(coords.iloc[:0]) == []
+
+
+def test_render_all_flow_maps(tmp_path, monkeypatch):
+    serbia = 'Serbia, FR(Serbia/Montenegro)'
+    names = ['A', 'B', serbia]
+    emissions = pd.DataFrame([[0, 5, 3], [2, 0, 0], [0, 0.05, 0]], index=names,
+                             columns=['Emissions to '+name for name in names], dtype=float)
+    coords = pd.DataFrame({'Longitude': [0.0, 10.0, 20.0], 'Latitude': [1.0, 11.0, 21.0]}, index=names)
+    written = {}
+    write = pf._WriteFlowMap
+
+    def record(task):
+        written[os.path.basename(task[2])] = task[0]
+        return write(task)
+    monkeypatch.setattr(pf, '_WriteFlowMap', record)
+
+    maps = pf.render_all_flow_maps(emissions, coords, str(tmp_path))
+    files = ['EmissionFlows'+direction+name+'.html' for direction in ('From', 'To')
+             for name in ['A', 'B', 'Serbia, FR(Serbia_Montenegro)']]
+    assert sorted(map(os.path.basename, maps['file'])) == sorted(files)
+    assert all((tmp_path/name).exists() for name in files)
+    assert maps.set_index(['country', 'direction']).loc[(serbia, 'to'), 'file'].endswith(
+        'EmissionFlowsToSerbia, FR(Serbia_Montenegro).html')
+
+    def ends(name):
+        edges = written[name]
+        return sorted(zip(zip(edges['start_lon'], edges['end_lon']), edges['emissions']))
+    # the 'from' maps start at the exporter, the 'to' maps at the importer
+    assert ends('EmissionFlowsFromA.html') == [((0, 10), 5), ((0, 20), 3)]
+    assert ends('EmissionFlowsFromB.html') == [((10, 0), 2)]
+    assert ends('EmissionFlowsToA.html') == [((0, 10), 2)]
+    assert ends('EmissionFlowsToB.html') == [((10, 0), 5)]
+    assert ends('EmissionFlowsToSerbia, FR(Serbia_Montenegro).html') == [((20, 0), 3)]
+    assert ends('EmissionFlowsFromSerbia, FR(Serbia_Montenegro).html') == []
+
+    # unchanged maps are not written again
+    written.clear()
+    assert not pf.render_all_flow_maps(emissions, coords, str(tmp_path))['rendered'].any()
+    assert not written
+
+
+@pytest.fixture(scope='module')
+def mrio_inputs():
+    rng = np.random.default_rng(10)
+    n = 50
+    names = ['C%d' % i for i in range(n)]
+    gdp = rng.lognormal(24, 2, n)
+    # trade in 1000 USD, small enough compared to GDP for a productive economy
+    values = rng.exponential(1, (2, n, n))*(rng.random((2, n, n)) < 0.3)*gdp.mean()/1000/n*0.5
+    for year in range(2):
+        np.fill_diagonal(values[year], 0)
+    frame = pd.DataFrame({pf.GHG_COLUMN: rng.uniform(1e3, 1e6, n), pf.GDP_COLUMN: gdp,
+                          pf.EXPORTS_COLUMN: 30.0}, index=names)
+    frame.iloc[5, 1] = np.nan
+    return TradeCube(values, [2013, 2014], names), frame
+
+
+def dense_leontief(trade, frame, year):
+    # the textbook calculation with the explicit Leontief inverse
+    valid = frame[pf.GDP_COLUMN].notnull().to_numpy()
+    Z = trade.loc[year][valid][:, valid]*1000
+    x = frame[pf.GDP_COLUMN].to_numpy()[valid]+Z.sum(axis=0)
+    A = Z/x
+    f = frame[pf.GHG_COLUMN].to_numpy()[valid]/x
+    multipliers = f @ np.linalg.inv(np.eye(len(x))-A)
+    return multipliers*(x-Z.sum(axis=1))
+
+
+@pytest.mark.parametrize('kind,method', [('dense', 'lu'), ('sparse', 'lu'), ('sparse', 'iterative'),
+                                         ('dense', 'iterative')])
+def test_mrio_matches_dense_inverse(mrio_inputs, kind, method):
+    trade, frame = mrio_inputs
+    cube = trade if kind == 'dense' else SparseTradeCube.from_cube(trade)
+    totals = pf.compute_mrio_emissions(cube, frame, 2014, method=method, tol=1e-13)
+    np.testing.assert_allclose(totals['NewEmissions'].dropna().to_numpy(), dense_leontief(trade, frame, 2014),
+                               rtol=1e-8)
+    assert np.isnan(totals.loc['C5', 'NewEmissions'])
+    # the emissions of the countries in the model are only reallocated
+    np.testing.assert_allclose(totals['NewEmissions'].sum(), frame[pf.GHG_COLUMN].drop('C5').sum(), rtol=1e-8)
+
+
+def test_mrio_unknown_method(mrio_inputs):
+    trade, frame = mrio_inputs
+    with pytest.raises(ValueError):
+        pf.compute_mrio_emissions(trade, frame, 2014, method='inverse')
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse'])
+def test_percentages_inplace(trade, kind):
+    cube = trade.copy() if kind == 'dense' else SparseTradeCube.from_cube(trade)
+    expected = pf.CalculatePercentages(cube, [2012, 2014])
+    memory = cube.values if kind == 'dense' else cube.matrices[2].data
+    tracemalloc.start()
+    result = pf.CalculatePercentages(cube, [2012, 2014], inplace=True)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # the cube is converted in its own memory, with temporary arrays of
+    # about one year at a time
+    assert result is cube
+    assert np.shares_memory(memory, cube.values if kind == 'dense' else cube.matrices[2].data)
+    assert peak < 2*trade.values.nbytes/len(trade.years)
+    np.testing.assert_array_equal(cube.to_frame().to_numpy(), expected.to_frame().to_numpy())
+    np.testing.assert_array_equal(cube.loc[2013] if kind == 'dense' else cube.loc[2013].toarray(), trade.loc[2013])
+
+
+def test_percentages_frame_not_inplace(trade):
+    frame = trade.to_frame()
+    with pytest.raises(ValueError):
+        pf.CalculatePercentages(frame, [2012, 2014], inplace=True)
+
+
+@pytest.fixture(scope='module')
+def scenario_inputs(mrio_inputs):
+    # a (country, year) WB panel in which only the GDP of C5 comes from 2013
+    trade, frame = mrio_inputs
+    earlier = frame.copy()
+    earlier[pf.GDP_COLUMN] = earlier[pf.GDP_COLUMN].fillna(1e10)
+    wb_panel = pd.concat({2013: earlier, 2014: frame}, names=['year', 'country']).swaplevel().sort_index()
+    regions = pd.DataFrame({'Region': 'R', 'IncomeGroup': ['High', 'Low']*25}, index=trade.countries)
+    return trade, wb_panel, regions
+
+
+def test_run_scenarios(scenario_inputs):
+    trade, wb_panel, regions = scenario_inputs
+    scenarios = {'direct': {}, 'removed': {'countries_to_remove': ['C1', 'C2']}, 'mrio': {'mode': 'mrio'}}
+    scenarios = {name: dict(scenario, year1=2012, year2=2014) for name, scenario in scenarios.items()}
+    single = pf.run_scenarios(scenarios, trade, wb_panel, regions)
+    pooled = pf.run_scenarios(scenarios, trade, wb_panel, regions, workers=2)
+    pd.testing.assert_frame_equal(single, pooled)
+    assert not pf._scenario_inputs
+
+    latest = pf.LatestObservationsWB(wb_panel)
+    latest = latest[[column for column in latest.columns if not column.endswith(' source')]]
+    assert latest.notnull().all().all()
+    results = {name: group.set_index('country') for name, group in single.groupby('scenario')}
+
+    expected = pf.compute_true_emissions(trade, latest, 2014)
+    np.testing.assert_allclose(results['direct']['NewEmissions'], expected.loc[results['direct'].index, 'NewEmissions'],
+                               rtol=1e-10)
+
+    # the removed countries are neither exporter nor importer
+    kept = [name for name in trade.countries if name not in ('C1', 'C2')]
+    values = trade.loc[2014].copy()
+    values[[1, 2]] = 0
+    values[:, [1, 2]] = 0
+    expected = pf.compute_true_emissions(TradeCube(values[np.newaxis], [2014], trade.countries), latest.loc[kept],
+                                         2014)
+    assert sorted(results['removed'].index) == sorted(kept)
+    np.testing.assert_allclose(results['removed']['NewEmissions'],
+                               expected.loc[results['removed'].index, 'NewEmissions'], rtol=1e-10)
+
+    expected = pf.compute_mrio_emissions(trade, latest, 2014)
+    np.testing.assert_allclose(results['mrio']['NewEmissions'], expected.loc[results['mrio'].index, 'NewEmissions'],
+                               rtol=1e-10)
+
+
+def test_run_scenarios_builds_shared_inputs(scenario_inputs):
+    # the runner loads the WB data and builds the trade cube itself, from
+    # data in which C1 is called by an alias
+    trade, wb_panel, regions = scenario_inputs
+    registry = CountryRegistry()
+    for position, name in enumerate(trade.countries):
+        registry.add('K%02d' % position, name, aliases=['Country One'] if name == 'C1' else ())
+    names = ['Country One' if name == 'C1' else name for name in trade.countries]
+
+    exporters, importers = np.meshgrid(names+['Atlantis'], names+['Atlantis'], indexing='ij')
+    trade_data = pd.DataFrame({'ReporterName': importers.ravel(), 'PartnerName': exporters.ravel()})
+    for year in (2013, 2014, 2015):
+        values = np.zeros((len(names)+1, len(names)+1))
+        values[:-1, :-1] = trade.loc[min(year, 2014)]
+        values[-1] = 1.0
+        trade_data[str(year)+' in 1000 USD '] = values.ravel()
+
+    indicators = {'CODE%d' % position: column for position, column in enumerate(wb_panel.columns)}
+    local = wb_panel.rename(columns={column: code for code, column in indicators.items()})
+    countries = local.index.get_level_values('country').map(dict(zip(trade.countries, names)))
+    local.index = pd.MultiIndex.from_arrays([countries, local.index.get_level_values('year').astype(str)],
+                                            names=['country', 'date'])
+    source = LocalWBSource(local)
+
+    scenarios = pf.scenario_grid(countries_to_remove=[[], ['C1', 'C2']], mode=['direct', 'mrio'], year1=[2012],
+                              year2=[2014])
+    inputs = pf.prepare_scenario_inputs(scenarios, trade_data=trade_data, indicators=indicators, source=source,
+                                        regions=regions, registry=registry)
+    assert isinstance(inputs['trade_cube'], SparseTradeCube)
+    assert inputs['trade_cube'].years == [2013, 2014] and inputs['trade_cube'].countries == trade.countries
+    np.testing.assert_allclose(inputs['trade_cube'].loc[2014].toarray(), trade.loc[2014])
+
+    source.calls.clear()
+    built = pf.run_scenarios(scenarios, trade_data=trade_data, indicators=indicators, source=source,
+                             regions=regions, registry=registry)
+    # one request for the years of all scenarios
+    assert len(source.calls) == 1
+    pd.testing.assert_frame_equal(built, pf.run_scenarios(scenarios, trade, wb_panel, regions), rtol=1e-10)
+
+
+def provenance_of(wb_frame, seed):
+    rng = np.random.default_rng(seed)
+    columns = [pf.GHG_COLUMN, pf.EXPORTS_COLUMN]
+    codes = rng.integers(0, 2, (len(wb_frame), len(columns)))
+    return MakeProvenance(codes, ['WB data 2014', 'Estimation based on region'], wb_frame.index, columns)
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse'])
+def test_monte_carlo_without_uncertainty(trade, wb_frame, kind):
+    # zero widths give every sample the deterministic result
+    cube = trade if kind == 'dense' else SparseTradeCube.from_cube(trade)
+    bands = pf.monte_carlo_true_emissions(cube, wb_frame, 2014, provenance=provenance_of(wb_frame, 11),
+                                          n_samples=20, trade_sigma=0,
+                                          widths={'WB data': 0, 'Estimation': 0}, seed=1, chunk_size=8)
+    expected = pf.compute_true_emissions(cube, wb_frame, 2014)
+    for percentile in (5, 50, 95):
+        for name in ('NewEmissions', 'EmissionDifference'):
+            np.testing.assert_allclose(bands[name+' p%d' % percentile].to_numpy(), expected[name].to_numpy(),
+                                       rtol=1e-10)
+
+
+def test_monte_carlo_independent_of_workers(trade, wb_frame, monkeypatch):
+    # a pool of two processes also on a machine with one CPU
+    monkeypatch.setattr(pf, '_UsableCPUs', lambda: 2)
+    provenance = provenance_of(wb_frame, 12)
+    single = pf.monte_carlo_true_emissions(trade, wb_frame, 2014, provenance=provenance, n_samples=60, seed=3,
+                                           chunk_size=16)
+    pooled = pf.monte_carlo_true_emissions(trade, wb_frame, 2014, provenance=provenance, n_samples=60, seed=3,
+                                           chunk_size=16, workers=2)
+    pd.testing.assert_frame_equal(single, pooled)
+    # the bands are not degenerate, and another seed gives other samples
+    assert (single['NewEmissions p95'] > single['NewEmissions p5']).sum() > 40
+    other = pf.monte_carlo_true_emissions(trade, wb_frame, 2014, provenance=provenance, n_samples=60, seed=4,
+                                          chunk_size=16)
+    assert not np.allclose(single.dropna().to_numpy(), other.dropna().to_numpy())
+    assert not pf._monte_carlo_inputs
+
+
+def test_monte_carlo_workers_limited_to_cpus(trade, wb_frame, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError('no pool is needed on one CPU')
+    monkeypatch.setattr(pf, '_UsableCPUs', lambda: 1)
+    monkeypatch.setattr(pf, 'ProcessPoolExecutor', no_pool)
+    provenance = provenance_of(wb_frame, 12)
+    bands = pf.monte_carlo_true_emissions(trade, wb_frame, 2014, provenance=provenance, n_samples=40, seed=3,
+                                          chunk_size=16, workers=4)
+    assert bands.shape == (len(wb_frame), 6)